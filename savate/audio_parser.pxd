@@ -4,7 +4,7 @@ cdef class AbstractAudioParser:
     cdef int parsing_state
     cdef int frame_length
     cdef int max_frame_length
-    cdef bytes buffer
+    cdef readonly bytes buffer
     cdef object frames
     cdef int lower_bound
     cdef int upper_bound
@@ -13,7 +13,10 @@ cdef class AbstractAudioParser:
     # needed for error recovery
     cdef int error_back_ref
     cdef int error_frames
-    cdef object error_message
+    cdef readonly object error_message
+
+    # statistics
+    cdef readonly int resyncs
 
     # methods
     cdef handle_error(self)
@@ -24,6 +24,7 @@ cdef class AbstractAudioParser:
         self.lower_bound = 0
         self.upper_bound = 0
         self.buffer_length = 0
+        self.resyncs = 0
 
     def __init__(self):
         self.buffer = b''
@@ -48,6 +49,7 @@ cdef class AbstractAudioParser:
                     self.parsing_state = PARSE_ERROR
                     self.error_frames = 0
                     self.error_message = str(exc)
+                    self.resyncs += 1
                     # ignore previous frame (as header size was wrong)
                     self.frames.append(self.buffer[self.lower_bound:(
                         self.upper_bound - self.frame_length)])
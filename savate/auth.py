@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 
 import base64
-import collections
+import functools
 import hashlib
+import hmac
+import socket
 import time
+import urlparse
 
-from savate.helpers import HTTPResponse
+from savate import callout
+from savate import helpers
+from savate.configuration import BadConfig
+from savate.helpers import PrebuiltHTTPResponse, ExpiringLRUCache
 
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for char_a, char_b in zip(a, b):
+            result |= ord(char_a) ^ ord(char_b)
+        return result == 0
 
-AUTH_SUCCESS = HTTPResponse(200, b'OK')
+
+AUTH_SUCCESS = PrebuiltHTTPResponse(200, b'OK')
 # FIXME: make the authorization realm configurable ?
-AUTH_REQUEST = HTTPResponse(401, b'Unauthorized', {b'WWW-Authenticate' : b'Basic realm="savate"'})
-AUTH_FAILURE = HTTPResponse(403, b'Forbidden')
+AUTH_REQUEST = PrebuiltHTTPResponse(401, b'Unauthorized', {b'WWW-Authenticate' : b'Basic realm="savate"'})
+AUTH_FAILURE = PrebuiltHTTPResponse(403, b'Forbidden')
 
 
 class AbstractAuthorization(object):
@@ -27,6 +45,25 @@ class AbstractAuthorization(object):
         # None: I don't know, move on to next auth handler
         return None
 
+    def route_settings(self, mount_config):
+        """
+        Return this handler's settings for the requests routed to
+        mount_config (None outside of any configured mount), computed
+        once when the server routes are built. Returning None means
+        this handler never has a say about such requests, and leaves
+        it out of their authorization chain.
+        """
+        return self.config
+
+    def authorize_route(self, client_address, client_request, settings):
+        # settings is what route_settings() returned for the request's
+        # route
+        return self.authorize(client_address, client_request)
+
+    def find_route_settings(self, client_request):
+        return self.route_settings(
+            self.server.routes.find(client_request.request_path).mount_config)
+
 
 class AbstractBasicAuthorization(AbstractAuthorization):
     """
@@ -37,19 +74,23 @@ class AbstractBasicAuthorization(AbstractAuthorization):
         AbstractAuthorization.__init__(self, server, server_config, **config_dict)
         self.global_user = config_dict.get(self.USER_ITEM)
         self.global_password = config_dict.get(self.PASSWORD_ITEM)
-        self.protected_paths = collections.defaultdict(lambda: {'user': self.global_user,
-                                                                'password': self.global_password})
-        for mount_config in self.server_config.get('mounts', []):
-            self.protected_paths[mount_config['path']] = {
-                'user': mount_config.get(self.USER_ITEM, self.global_user),
-                'password': mount_config.get(self.PASSWORD_ITEM, self.global_password),
-                }
+
+    def route_settings(self, mount_config):
+        mount_config = mount_config or {}
+        protected = (mount_config.get(self.USER_ITEM, self.global_user),
+                     mount_config.get(self.PASSWORD_ITEM, self.global_password))
+        if protected == (None, None):
+            # Not protected
+            return None
+        return protected
 
     def authorize(self, client_address, client_request):
-        path = client_request.request_path
-        protected_user = self.protected_paths[path]['user']
-        protected_password = self.protected_paths[path]['password']
-        if (protected_user, protected_password) != (None, None):
+        return self.authorize_route(client_address, client_request,
+                                    self.find_route_settings(client_request))
+
+    def authorize_route(self, client_address, client_request, settings):
+        if settings is not None:
+            protected_user, protected_password = settings
             # This path is protected, did the client provide a correct
             # Authorization header ?
             auth_header = client_request.headers.get(b'Authorization')
@@ -100,39 +141,102 @@ class BasicAuthorization(AbstractAuthorization):
         self.source_auth = SourceBasicAuthorization(server, server_config, **config_dict)
         self.client_auth = ClientBasicAuthorization(server, server_config, **config_dict)
 
+    def route_settings(self, mount_config):
+        settings = (self.source_auth.route_settings(mount_config),
+                    self.client_auth.route_settings(mount_config))
+        if settings == (None, None):
+            return None
+        return settings
+
     def authorize(self, client_address, client_request):
+        return self.authorize_route(client_address, client_request,
+                                    self.find_route_settings(client_request))
+
+    def authorize_route(self, client_address, client_request, settings):
+        if settings is None:
+            return None
+        source_settings, client_settings = settings
         if client_request.request_method in [b'PUT', b'SOURCE', b'POST']:
-            return self.source_auth.authorize(client_address, client_request)
+            return self.source_auth.authorize_route(client_address, client_request,
+                                                    source_settings)
         elif client_request.request_method in [b'GET']:
-            return self.client_auth.authorize(client_address, client_request)
+            return self.client_auth.authorize_route(client_address, client_request,
+                                                    client_settings)
         else:
             return None
 
 
 class TokenAuthorization(AbstractAuthorization):
+    """
+    Token-protected paths, of the form /prefix/token/timestamp/path,
+    timestamp being hex-encoded. The token is computed from a secret,
+    the path and the timestamp, with one of the SCHEMES.
+
+    Several secrets can be given as a list, any of them being accepted,
+    to allow for key rotation. Validated tokens are cached until they
+    expire, so that mass reconnections are cheap.
+    """
+
+    SCHEMES = ('md5', 'hmac-sha256')
+
+    # Maximum number of validated tokens kept
+    CACHE_SIZE = 10000
 
     def __init__(self, server, server_config, **config_dict):
         AbstractAuthorization.__init__(self, server, server_config, **config_dict)
         self.global_secret = config_dict.get('secret')
         self.global_timeout = config_dict.get('timeout')
         self.global_prefix = config_dict.get('prefix', '')
-        self.protected_paths = collections.defaultdict(lambda: {'secret': self.global_secret,
-                                                                'timeout': self.global_timeout,
-                                                                'prefix': self.global_prefix,
-                                                                })
-        for mount_config in self.server_config.get('mounts', []):
-            self.protected_paths[mount_config['path']] = {
-                'secret': mount_config.get('secret', self.global_secret),
-                'timeout': mount_config.get('token_timeout', self.global_timeout),
-                'prefix': mount_config.get('token_prefix', self.global_prefix),
-                }
+        self.global_scheme = config_dict.get('scheme', 'md5')
+        # (route settings, token, timestamp, path) -> True
+        self.validated_tokens = ExpiringLRUCache(
+            int(config_dict.get('cache_size', self.CACHE_SIZE)))
+
+    def route_settings(self, mount_config):
+        mount_config = mount_config or {}
+        secret = mount_config.get('secret', self.global_secret)
+        if secret is None:
+            # Not token-protected
+            return None
+        # hmac needs bytes, and JSON gives us unicode strings
+        if isinstance(secret, basestring):
+            secrets = (helpers.to_bytes(secret),)
+        else:
+            secrets = tuple(helpers.to_bytes(item) for item in secret)
+        scheme = mount_config.get('token_scheme', self.global_scheme)
+        if scheme not in self.SCHEMES:
+            raise BadConfig('Unknown token scheme %s, should be one of %s' %
+                            (scheme, ', '.join(self.SCHEMES)))
+        return (secrets,
+                mount_config.get('token_timeout', self.global_timeout),
+                helpers.to_bytes(mount_config.get('token_prefix', self.global_prefix)),
+                scheme)
+
+    @staticmethod
+    def compute_token(scheme, secret, path, timestamp):
+        if scheme == 'hmac-sha256':
+            return hmac.new(secret, '/' + path + timestamp, hashlib.sha256).hexdigest()
+        else:
+            return hashlib.md5(secret + '/' + path + timestamp).hexdigest()
+
+    def check_token(self, secrets, scheme, token, path, timestamp):
+        valid = False
+        # Check against every secret, so that the time taken does not
+        # tell which one matched
+        for secret in secrets:
+            if compare_digest(self.compute_token(scheme, secret, path, timestamp),
+                              token):
+                valid = True
+        return valid
 
     def authorize(self, client_address, client_request):
+        return self.authorize_route(client_address, client_request,
+                                    self.find_route_settings(client_request))
+
+    def authorize_route(self, client_address, client_request, settings):
         path = client_request.request_path
-        secret = self.protected_paths[path]['secret']
-        timeout = self.protected_paths[path]['timeout']
-        prefix = self.protected_paths[path]['prefix']
-        if secret != None:
+        if settings is not None:
+            secrets, timeout, prefix, scheme = settings
             # This path is token-protected
             if not path.startswith(prefix):
                 # Incorrect prefix
@@ -148,13 +252,24 @@ class TokenAuthorization(AbstractAuthorization):
                     return AUTH_FAILURE
                 # Split into token, timestamp, and path
                 token, timestamp, path = path.split('/', 2)
-                # Check the token is valid
-                if token != hashlib.md5(secret + '/' + path + timestamp).hexdigest():
-                    # Invalid token
-                    return AUTH_FAILURE
-                # Check the timeout is not expired, if needed
-                if timeout and (int(time.time()) - timeout) > int(timestamp, 16):
-                    return AUTH_FAILURE
+                now = time.time()
+                cache_key = (settings, token, timestamp, path)
+                if not self.validated_tokens.get(cache_key, now):
+                    # Check the token is valid
+                    if not self.check_token(secrets, scheme, token, path, timestamp):
+                        # Invalid token
+                        return AUTH_FAILURE
+                    # Check the timeout is not expired, if needed
+                    if timeout:
+                        try:
+                            expires_at = int(timestamp, 16) + timeout + 1
+                        except ValueError:
+                            return AUTH_FAILURE
+                        if expires_at <= now:
+                            return AUTH_FAILURE
+                    else:
+                        expires_at = None
+                    self.validated_tokens.set(cache_key, True, expires_at)
 
                 # We have to remove the token and timestamp from the original
                 # path or else the server won't find the correct handler
@@ -163,3 +278,122 @@ class TokenAuthorization(AbstractAuthorization):
                 return AUTH_SUCCESS
 
         return None
+
+
+class ExternalAuthorization(AbstractAuthorization):
+    """
+    Delegates authorization decisions to an external HTTP service,
+    without blocking: requests are parked until it answers.
+
+    The service is sent a GET request on its URL, with the method,
+    path and client IP as query string parameters, and the token
+    header forwarded. A 2xx status authorizes the request, 401 and 403
+    deny it. Anything else, including no answer within timeout
+    seconds, is handled according to the failure policy: open
+    (authorized) or closed (denied).
+
+    Decisions are cached for cache_ttl seconds, keyed by token (by
+    client IP for requests without one) or by client IP, and the
+    request method and path. Concurrent requests with the same key share the same
+    callout.
+    """
+
+    CACHE_SIZE = 10000
+
+    FAILURE_POLICIES = ('open', 'closed')
+    CACHE_KEYS = ('token', 'ip')
+
+    def __init__(self, server, server_config, **config_dict):
+        AbstractAuthorization.__init__(self, server, server_config, **config_dict)
+        self.url = config_dict['url']
+        self.parsed_url = urlparse.urlparse(self.url)
+        self.timeout = float(config_dict.get('timeout', 2))
+        self.cache_ttl = float(config_dict.get('cache_ttl', 60))
+        self.token_header = config_dict.get('token_header', 'Authorization')
+        self.cache_key = config_dict.get('cache_key', 'token')
+        if self.cache_key not in self.CACHE_KEYS:
+            raise BadConfig('Unknown cache_key %s, should be one of %s' %
+                            (self.cache_key, ', '.join(self.CACHE_KEYS)))
+        failure_policy = config_dict.get('failure_policy', 'closed')
+        if failure_policy not in self.FAILURE_POLICIES:
+            raise BadConfig('Unknown failure_policy %s, should be one of %s' %
+                            (failure_policy, ', '.join(self.FAILURE_POLICIES)))
+        self.failure_result = AUTH_SUCCESS if failure_policy == 'open' else AUTH_FAILURE
+
+        # Resolved once, so that callouts never block on DNS
+        self.address_info = socket.getaddrinfo(self.parsed_url.hostname,
+                                               self.parsed_url.port or 80,
+                                               socket.AF_UNSPEC,
+                                               socket.SOCK_STREAM,
+                                               socket.IPPROTO_TCP)[0]
+
+        # ('token' or 'ip', token or IP, method, path) -> authorization result
+        self.decisions = ExpiringLRUCache(int(config_dict.get('cache_size', self.CACHE_SIZE)))
+        # ('token' or 'ip', token or IP, method, path) -> (HTTPCallout, Deferred)
+        self.callouts = {}
+
+    def route_settings(self, mount_config):
+        if not (mount_config or {}).get('external_auth', True):
+            return None
+        return self.config
+
+    def build_request(self, client_address, client_request, token):
+        headers = {}
+        if token is not None:
+            headers[self.token_header] = token
+        return callout.build_get_request(self.parsed_url,
+                                         [('method', client_request.request_method),
+                                          ('path', client_request.request_path),
+                                          ('ip', client_address[0])],
+                                         headers)
+
+    def authorize_route(self, client_address, client_request, settings):
+        token = client_request.headers.get(self.token_header)
+        if self.cache_key == 'ip' or token is None:
+            # Requests without a token must not share their decision
+            cache_key = ('ip', client_address[0], client_request.request_method,
+                         client_request.request_path)
+        else:
+            cache_key = ('token', token, client_request.request_method,
+                         client_request.request_path)
+
+        decision = self.decisions.get(cache_key, self.server.loop.now())
+        if decision is not None:
+            return decision
+
+        if cache_key not in self.callouts:
+            deferred = helpers.Deferred()
+            try:
+                http_callout = callout.HTTPCallout(
+                    self.server, self.url, self.address_info,
+                    self.build_request(client_address, client_request, token),
+                    self.timeout,
+                    functools.partial(self.callout_done, cache_key))
+            except (IOError, socket.error):
+                self.server.logger.exception('Cannot reach authorization service %s:',
+                                             self.url)
+                return self.failure_result
+            self.callouts[cache_key] = (http_callout, deferred)
+        return self.callouts[cache_key][1]
+
+    def callout_done(self, cache_key, status_code, _body):
+        deferred = self.callouts.pop(cache_key)[1]
+        if status_code in (401, 403):
+            result = AUTH_FAILURE
+        elif status_code is not None and 200 <= status_code < 300:
+            result = AUTH_SUCCESS
+        else:
+            if status_code is not None:
+                self.server.logger.error('Unexpected status %d from authorization service %s',
+                                         status_code, self.url)
+            # Failures are not cached, the next request will try again
+            deferred.resolve(self.failure_result)
+            return
+        self.decisions.set(cache_key, result,
+                           self.server.loop.now() + self.cache_ttl)
+        deferred.resolve(result)
+
+    def close(self):
+        # Pending requests get the failure policy
+        for http_callout, deferred in self.callouts.values():
+            http_callout.close()
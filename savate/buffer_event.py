@@ -1,66 +1,405 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import errno
 import collections
+import fcntl
+import mmap
+import os
+import socket
+import struct
+
+# Note that memfd_create() requires Linux >= 3.17 and glibc >= 2.27
+try:
+    from savate import memfd
+except ImportError:
+    # Not built, see configure's --enable-memfd
+    memfd = None
+
+# Note that MSG_ZEROCOPY requires Linux >= 4.14
+try:
+    from savate import zerocopy
+except ImportError:
+    # Not built, see configure's --enable-zerocopy
+    zerocopy = None
 
 
 class QueueSizeExceeded(Exception):
     pass
 
+# Linux values, missing from the socket module
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+SIOCOUTQNSD = 0x894B
+SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE', 47)
+
+
+def unsent_bytes(sock):
+    """
+    Return the number of bytes of sock's kernel send queue which
+    have not been sent yet, or None if the kernel cannot tell.
+    """
+    try:
+        result = fcntl.ioctl(sock.fileno(), SIOCOUTQNSD, struct.pack('i', 0))
+    except (IOError, socket.error):
+        return None
+    return struct.unpack('i', result)[0]
+
+
+def set_max_pacing_rate(sock, rate):
+    """Have the kernel send at most rate bytes/s on sock."""
+    sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, min(int(rate), 2**32 - 1))
+
+
+class SocketOptions(object):
+    """
+    Send side options for the sockets of streaming clients. With
+    TCP_NOTSENT_LOWAT, the kernel only reports the socket writable,
+    and accepts more data, once less than notsent_lowat bytes are
+    waiting to be sent, which bounds the data held by the kernel on
+    top of our own queue.
+
+    When zerocopy_threshold is set, the buffers of at least that
+    size are sent with MSG_ZEROCOPY, see
+    BufferOutputHandler.enable_zerocopy().
+
+    burst_pacing is the maximum send rate of a client, as a multiple
+    of its stream's bitrate, so that the bursts of many new clients
+    do not all go out at once. It is enforced by the kernel
+    (SO_MAX_PACING_RATE) if possible, unless userland_pacing is set,
+    else by the client itself, see StreamClient.flush().
+    """
+
+    def __init__(self, notsent_lowat = None, send_buffer = None,
+                 burst_pacing = None, userland_pacing = False,
+                 zerocopy_threshold = None):
+        self.notsent_lowat = notsent_lowat
+        self.send_buffer = send_buffer
+        self.burst_pacing = burst_pacing
+        self.userland_pacing = userland_pacing
+        self.zerocopy_threshold = zerocopy_threshold
+
+    def apply(self, sock):
+        if self.notsent_lowat is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, self.notsent_lowat)
+        if self.send_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+
 # FIXME: should this be a method of BufferEvent below ?
 try:
     memoryview
     def make_buffer(data):
         return memoryview(data)
-    def buffer_slice(buff, offset):
-        return buff[offset:]
+    def buffer_slice(buff, offset, size = None):
+        if size is None:
+            return buff[offset:]
+        return buff[offset:offset + size]
 except NameError:
     def make_buffer(data):
         return buffer(data)
-    def buffer_slice(buff, offset):
-        return buffer(buff, offset)
+    def buffer_slice(buff, offset, size = None):
+        if size is None:
+            return buffer(buff, offset)
+        return buffer(buff, offset, size)
+
+
+class MemFDRing(object):
+    """
+    The data published by a source, in a ring buffer backed by a
+    memfd, so that clients can be sent it with sendfile() instead of
+    send(). Offsets are counted from the start of the stream: the data
+    at some offset stays available until write_offset - offset exceeds
+    size.
+
+    Requires the memfd module, see configure's --enable-memfd.
+    """
+
+    # Twice BufferOutputHandler.MAX_QUEUE_SIZE, see
+    # Server.publish_packet()
+    DEFAULT_SIZE = 48 * 2**20
+
+    # Many times the packets published by sources, see
+    # BufferedRawSource.TEMP_BUFFER_SIZE
+    MIN_SIZE = 2**20
+
+    def __init__(self, size, name = b'savate'):
+        self.size = size
+        # The memfd is closed once the ring and its file object are
+        # not referenced anymore, i.e. no client still reads from it
+        self.file = os.fdopen(memfd.memfd_create(name, memfd.MFD_CLOEXEC), 'r+b', 0)
+        os.ftruncate(self.file.fileno(), size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.write_offset = 0
+        # Start offsets of the packets still in the ring
+        self.packets = collections.deque()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, data):
+        """
+        Append data to the ring, return its offset. Raises ValueError
+        if data does not fit in the ring.
+        """
+        if len(data) > self.size:
+            raise ValueError('%d bytes packet for a %d bytes ring' %
+                             (len(data), self.size))
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        offset = self.write_offset
+        written = 0
+        while written < len(data):
+            position = (offset + written) % self.size
+            chunk = data[written:written + self.size - position]
+            self.map.seek(position)
+            self.map.write(chunk)
+            written += len(chunk)
+        self.write_offset += len(data)
+        self.packets.append(offset)
+        while self.write_offset - self.packets[0] > self.size:
+            self.packets.popleft()
+        return offset
+
+    def packet_end(self, offset):
+        """Return the end offset of the packet holding offset."""
+        index = bisect.bisect_right(self.packets, offset)
+        if index < len(self.packets):
+            return self.packets[index]
+        return self.write_offset
+
+
+class RingSegment(object):
+    """Queued data from start to end in a :class:`MemFDRing`."""
+
+    __slots__ = (
+        'ring',
+        'start',
+        'end',
+    )
+
+    def __init__(self, ring, start, end):
+        self.ring = ring
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def send(self, sock, max_bytes = None):
+        """Send as much of our data as sock takes, return the number of bytes sent."""
+        ring = self.ring
+        if ring.write_offset - self.start > ring.size:
+            raise QueueSizeExceeded('Ring overrun, %d > %d' %
+                                    (ring.write_offset - self.start, ring.size))
+        sent_bytes = 0
+        while self.start < self.end:
+            position = self.start % ring.size
+            count = min(self.end - self.start, ring.size - position)
+            if max_bytes is not None:
+                count = min(count, max_bytes - sent_bytes)
+            try:
+                sent = memfd.sendfile(sock.fileno(), ring.fileno(), position, count)
+            except IOError as exc:
+                if exc.errno == errno.EAGAIN and sent_bytes:
+                    break
+                raise
+            self.start += sent
+            sent_bytes += sent
+            if sent < count or sent_bytes == max_bytes:
+                break
+        return sent_bytes
 
 
 class BufferOutputHandler(object):
 
-    # FIXME: make this configurable
+    __slots__ = (
+        'sock',
+        'ready',
+        'buffer_queue',
+        'size',
+        'max_size',
+        'zerocopy_threshold',
+        'zerocopy_pending',
+        'zerocopy_sent',
+        'send_pending',
+    )
+
+    # Default maximum queue size, None meaning no limit
     MAX_QUEUE_SIZE = 24 * 2**20
 
     def __init__(self, sock, initial_buffer_queue = ()):
         self.sock = sock
         self.ready = True
         self.buffer_queue = collections.deque(make_buffer(buff) for buff in initial_buffer_queue)
+        # Running total of queued bytes, to avoid walking the queue
+        self.size = sum(len(buff) for buff in self.buffer_queue)
+        self.max_size = self.MAX_QUEUE_SIZE
+        # Zero-copy sends, see enable_zerocopy()
+        self.zerocopy_threshold = None
+        self.zerocopy_pending = None
+        self.zerocopy_sent = 0
+        # Whether our first buffer is being sent, see submit_send()
+        self.send_pending = False
 
     def add_buffer(self, buff):
         self.buffer_queue.append(buff)
+        self.size += len(buff)
 
     def empty(self):
         return len(self.buffer_queue) == 0
 
     def queue_size(self):
-        return sum(len(buf) for buf in self.buffer_queue)
+        return self.size
+
+    def add_ring_data(self, ring, offset, length):
+        """Queue length bytes from offset in ring."""
+        if self.buffer_queue:
+            last = self.buffer_queue[-1]
+            if last.__class__ is RingSegment and last.ring is ring and last.end == offset:
+                # The common case: the data following our last segment
+                last.end += length
+                self.size += length
+                return
+        self.buffer_queue.append(RingSegment(ring, offset, offset + length))
+        self.size += length
+
+    def truncate(self):
+        """
+        Drop every queued buffer but the first one, which may have
+        been partially sent. Return the number of dropped bytes.
+        """
+        dropped_bytes = 0
+        while len(self.buffer_queue) > 1:
+            dropped_bytes += len(self.buffer_queue.pop())
+        if self.buffer_queue and self.buffer_queue[0].__class__ is RingSegment:
+            # Only keep the rest of the packet being sent
+            segment = self.buffer_queue[0]
+            end = min(segment.end, segment.ring.packet_end(segment.start))
+            dropped_bytes += segment.end - end
+            segment.end = end
+        self.size -= dropped_bytes
+        return dropped_bytes
+
+    def enable_zerocopy(self, threshold):
+        """
+        Send the buffers of at least threshold bytes with MSG_ZEROCOPY,
+        the kernel then reading them directly instead of copying them.
+        Raise socket.error if this is not supported.
+        """
+        if zerocopy is None:
+            raise socket.error(errno.ENOPROTOOPT, 'MSG_ZEROCOPY support not built')
+        self.sock.setsockopt(socket.SOL_SOCKET, zerocopy.SO_ZEROCOPY, 1)
+        self.zerocopy_threshold = threshold
+        # (send number, buffer) for the sends not completed yet
+        self.zerocopy_pending = collections.deque()
 
-    def flush(self):
+    def send_zerocopy(self, buff):
+        if len(buff) < self.zerocopy_threshold:
+            return self.sock.send(buff)
+        try:
+            sent_bytes = self.sock.send(buff, zerocopy.MSG_ZEROCOPY)
+        except IOError as exc:
+            if exc.errno != errno.ENOBUFS:
+                raise
+            # Out of memory for pinned pages, copy this one
+            return self.sock.send(buff)
+        # The kernel reads buff until this send is completed, so we
+        # keep a reference to it until then
+        self.zerocopy_pending.append((self.zerocopy_sent, buff))
+        self.zerocopy_sent = (self.zerocopy_sent + 1) & 0xffffffff
+        return sent_bytes
+
+    def reap_zerocopy(self):
+        """
+        Release the buffers of the zero-copy sends the kernel is done
+        with. Return whether there were completions to read on the
+        socket error queue.
+        """
+        completions = zerocopy.recv_completions(self.sock.fileno())
+        pending = self.zerocopy_pending
+        for first, last, copied in completions:
+            # Sends are counted on 32 bits, and completed in order
+            count = (last - first) & 0xffffffff
+            while pending and (pending[0][0] - first) & 0xffffffff <= count:
+                pending.popleft()
+            if copied:
+                # The kernel had to copy our data anyway, e.g. for
+                # loopback or a device without scatter-gather
+                self.zerocopy_threshold = None
+        return bool(completions)
+
+    def can_submit_send(self):
+        """Whether our first buffer may be sent with submit_send()."""
+        return (not self.send_pending and self.zerocopy_threshold is None and
+                bool(self.buffer_queue) and self.buffer_queue[0].__class__ is not RingSegment)
+
+    def submit_send(self, loop, handler):
+        """
+        Have loop send our first buffer, see IOLoop.submit_send().
+        Nothing else may be sent until send_done() is called with the
+        result.
+        """
+        loop.submit_send(handler, self.buffer_queue[0])
+        self.send_pending = True
+
+    def send_done(self, sent_bytes):
+        self.send_pending = False
+        self.size -= sent_bytes
+        if sent_bytes < len(self.buffer_queue[0]):
+            self.buffer_queue[0] = buffer_slice(self.buffer_queue[0], sent_bytes)
+        else:
+            self.buffer_queue.popleft()
+
+    def flush(self, max_bytes = None):
+        """
+        Send as much queued data as the socket accepts, but at most
+        max_bytes if not None.
+        """
         self.ready = True
         total_sent_bytes = 0
         try:
             while self.buffer_queue:
-                sent_bytes = self.sock.send(self.buffer_queue[0])
+                if self.buffer_queue[0].__class__ is RingSegment:
+                    segment = self.buffer_queue[0]
+                    sent_bytes = segment.send(self.sock, max_bytes and max_bytes - total_sent_bytes)
+                    total_sent_bytes += sent_bytes
+                    self.size -= sent_bytes
+                    if segment.start < segment.end:
+                        if max_bytes is None or total_sent_bytes < max_bytes:
+                            # We assume we can't send any more data
+                            self.ready = False
+                        break
+                    self.buffer_queue.popleft()
+                    if max_bytes is not None and total_sent_bytes >= max_bytes:
+                        break
+                    continue
+                buff = self.buffer_queue[0]
+                if max_bytes is not None and len(buff) > max_bytes - total_sent_bytes:
+                    # Only send our share of it
+                    buff = buffer_slice(buff, 0, max_bytes - total_sent_bytes)
+                if self.zerocopy_threshold is None:
+                    sent_bytes = self.sock.send(buff)
+                else:
+                    sent_bytes = self.send_zerocopy(buff)
                 total_sent_bytes += sent_bytes
+                self.size -= sent_bytes
                 if sent_bytes < len(self.buffer_queue[0]):
                     # One of the buffers was partially sent
                     self.buffer_queue[0] = buffer_slice(self.buffer_queue[0], sent_bytes)
-                    # We assume we can't send any more data
-                    self.ready = False
+                    if sent_bytes < len(buff):
+                        # We assume we can't send any more data
+                        self.ready = False
                     break
                 else:
                     self.buffer_queue.popleft()
+                if max_bytes is not None and total_sent_bytes >= max_bytes:
+                    # Our share is used, the socket is still writable
+                    break
         except IOError as exc:
             if exc.errno == errno.EAGAIN:
                 self.ready = False
             else:
                 raise
-        if self.queue_size() > self.MAX_QUEUE_SIZE:
+        if self.max_size is not None and self.size > self.max_size:
             raise QueueSizeExceeded('%d > %d' %
-                                    self.queue_size(), self.MAX_QUEUE_SIZE)
+                                    (self.size, self.max_size))
         return total_sent_bytes
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+import urllib
+
+import cyhttp11
+
+from savate import buffer_event
+from savate import helpers
+from savate import looping
+
+
+def build_get_request(parsed_url, query = (), headers = None):
+    """
+    Build an HTTP/1.0 GET request for parsed_url, with some more
+    query string parameters and headers.
+    """
+    selector = parsed_url.path or b'/'
+    query_string = b'&'.join(part for part in (parsed_url.query, urllib.urlencode(query))
+                             if part)
+    if query_string:
+        selector = b'?'.join([selector, query_string])
+    request_line = b'GET %s HTTP/1.0' % selector
+    all_headers = {b'Host': parsed_url.netloc}
+    all_headers.update(headers or {})
+    headers_lines = helpers.build_http_headers(all_headers, b'')
+    return b'\r\n'.join([request_line, headers_lines, b''])
+
+
+class HTTPCallout(looping.BaseIOEventHandler):
+    """
+    A non-blocking HTTP request to another server, run on our loop.
+    Once done, callback(status_code, body) is called, status_code
+    being None if the request failed or timed out. The body is only
+    read if read_body is True, until the server closes the connection.
+    """
+
+    RESPONSE_MAX_SIZE = 4096
+    BODY_MAX_SIZE = 2**20
+
+    def __init__(self, server, url, address_info, request, timeout, callback,
+                 read_body = False):
+        self.server = server
+        self.url = url
+        self.callback = callback
+        self.read_body = read_body
+
+        self.sock = socket.socket(address_info[0], address_info[1], address_info[2])
+        self.sock.setblocking(0)
+        error = self.sock.connect_ex(address_info[4])
+        if error and error != errno.EINPROGRESS:
+            self.sock.close()
+            raise socket.error(error, errno.errorcode[error])
+
+        self.output_buffer = buffer_event.BufferOutputHandler(self.sock, (request,))
+        self.response_buffer = b''
+        self.response_size = 0
+        self.response_parser = None
+        self.body_chunks = []
+        self.body_size = 0
+
+        self.handle_event = self.handle_connect
+        self.server.loop.register(self, looping.POLLOUT)
+        self.server.timeouts.reset_timeout(self, self.server.loop.now() + timeout,
+                                           self.handle_timeout)
+
+    def __str__(self):
+        return '<%s for %s>' % (self.__class__.__name__, self.url)
+
+    def handle_connect(self, eventmask):
+        if eventmask & looping.POLLOUT:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.server.logger.error('Cannot connect to %s: %s', self.url,
+                                         errno.errorcode[error])
+                self.close()
+                return
+            self.handle_event = self.handle_request
+            self.handle_event(eventmask)
+        else:
+            self.server.logger.error('Cannot connect to %s', self.url)
+            self.close()
+
+    def handle_request(self, eventmask):
+        if eventmask & looping.POLLOUT:
+            self.output_buffer.flush()
+            if self.output_buffer.empty():
+                self.server.loop.register(self, looping.POLLIN)
+                self.response_parser = cyhttp11.HTTPClientParser()
+                self.handle_event = self.handle_response
+        else:
+            self.close()
+
+    def handle_response(self, eventmask):
+        if eventmask & looping.POLLIN:
+            while True:
+                previous_size = self.response_size
+                tmp_buffer = helpers.recv_http_headers(self.sock, self.response_buffer,
+                                                       self.RESPONSE_MAX_SIZE)
+                if tmp_buffer == None:
+                    # EAGAIN, we'll come back later
+                    break
+                elif tmp_buffer == b'':
+                    raise helpers.HTTPError('Unexpected end of stream from %s' % self.url)
+                self.response_buffer = tmp_buffer
+                self.response_size = len(tmp_buffer)
+                if not helpers.http_headers_complete(self.response_buffer, previous_size):
+                    if self.response_size >= self.RESPONSE_MAX_SIZE:
+                        raise helpers.HTTPParseError('Oversized HTTP response from %s' %
+                                                     self.url)
+                    continue
+                self.response_parser.execute(self.response_buffer)
+                if self.response_parser.has_error() or not self.response_parser.is_finished():
+                    raise helpers.HTTPParseError('Invalid HTTP response from %s' % self.url)
+                if self.read_body:
+                    self.add_body_chunk(self.response_parser.body)
+                    self.handle_event = self.handle_body
+                    self.handle_event(eventmask)
+                else:
+                    self.finish(self.response_parser.status_code)
+                break
+        else:
+            self.close()
+
+    def add_body_chunk(self, chunk):
+        self.body_size += len(chunk)
+        if self.body_size > self.BODY_MAX_SIZE:
+            raise helpers.HTTPParseError('Oversized HTTP response body from %s' % self.url)
+        self.body_chunks.append(chunk)
+
+    def handle_body(self, eventmask):
+        if eventmask & (looping.POLLIN | looping.POLLHUP):
+            while True:
+                chunk = helpers.handle_eagain(self.sock.recv, self.BODY_MAX_SIZE)
+                if chunk == None:
+                    break
+                elif chunk == b'':
+                    self.finish(self.response_parser.status_code,
+                                b''.join(self.body_chunks))
+                    break
+                self.add_body_chunk(chunk)
+        else:
+            self.close()
+
+    def handle_timeout(self):
+        self.server.logger.error('Timeout for HTTP request to %s', self.url)
+        self.close()
+
+    def finish(self, status_code, body = b''):
+        if self.sock is None:
+            return
+        self.server.timeouts.remove_timeout(self)
+        self.server.loop.unregister(self)
+        looping.BaseIOEventHandler.close(self)
+        self.callback(status_code, body)
+
+    def close(self):
+        self.finish(None)
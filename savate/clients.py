@@ -1,25 +1,114 @@
 # -*- coding: utf-8 -*-
 
-from savate.looping import POLLOUT
-from savate.helpers import HTTPEventHandler, HTTPResponse, Buffer
+import errno
+import math
+import os
+import socket
+
+from savate import buffer_event
+from savate import limits
+from savate.looping import POLLOUT, POLLERR
+from savate.helpers import HTTPEventHandler, Buffer
 from savate.sources import ShoutcastSource
 
 
 class StreamClient(HTTPEventHandler):
 
+    __slots__ = (
+        'source',
+        'timeout_state',
+        'mount_metrics',
+        'reported_queue_size',
+        'queue_bucket',
+        'resyncing',
+        'resyncs',
+        'skipped_bytes',
+        'pacing',
+    )
+
+    # Depth of the userland pacing token bucket, in seconds of sending
+    PACING_BURST_DURATION = 0.1
+
+    # Shortest wait for pacing tokens, so that we send in chunks
+    # instead of waking up for every few bytes; pacing deadlines are
+    # also rounded up to multiples of it, so that paused clients share
+    # their timeouts
+    PACING_MIN_DELAY = 0.01
+
     def __init__(self, server, source, sock, address, request_parser,
                  content_type, http_response = None):
         if http_response is None:
-            http_response = HTTPResponse(
-                200, b'OK',
-                {b'Content-Length': None, b'Content-Type': content_type},
-            )
+            http_response = source.client_response()
 
         HTTPEventHandler.__init__(self, server, sock, address, request_parser,
                                   http_response)
         self.source = source
         self.timeout_state = False
         self.server.remove_inactivity_timeout(self)
+        socket_options = server.socket_options(source.path)
+        try:
+            socket_options.apply(sock)
+        except socket.error as exc:
+            server.logger.error('Cannot set socket options for %s: %s', self, exc)
+        if socket_options.zerocopy_threshold is not None:
+            try:
+                self.output_buffer.enable_zerocopy(socket_options.zerocopy_threshold)
+            except socket.error as exc:
+                server.logger.debug('Cannot enable MSG_ZEROCOPY for %s: %s', self, exc)
+        # The mount point is kept even if our source goes away
+        # (keepalive) or is replaced (source migration)
+        self.mount_metrics = server.get_mount_metrics(source.path)
+        # Userland send rate limit, see start_pacing()
+        self.pacing = None
+        if socket_options.burst_pacing is not None:
+            self.start_pacing(socket_options)
+        # Our lag is bounded by the mount's lag policy, see
+        # lag_exceeded()
+        self.output_buffer.max_size = None
+        # Whether we wait for a sync point to resume streaming
+        self.resyncing = False
+        self.resyncs = 0
+        # Bytes of stream we dropped or skipped while resyncing
+        self.skipped_bytes = 0
+
+        self.reported_queue_size = self.output_buffer.queue_size()
+        self.queue_bucket = self.mount_metrics.client_connected(self.reported_queue_size)
+        if server.accept_limits is not None:
+            server.accept_limits.stream_started(address[0])
+
+    def start_pacing(self, socket_options):
+        now = self.server.loop.now()
+        ingest = self.source.ingest
+        # The 10 seconds bitrate is underestimated by a new source
+        bitrate = max(ingest.bitrate(1, now), ingest.bitrate(10, now))
+        if bitrate:
+            self.mount_metrics.last_bitrate = bitrate
+        else:
+            # A restarted source has no bitrate yet, the mount's
+            # previous one is our best guess
+            bitrate = self.mount_metrics.last_bitrate
+        if not bitrate:
+            # We cannot tell our stream's rate yet
+            return
+        rate = socket_options.burst_pacing * bitrate / 8
+        if not socket_options.userland_pacing:
+            try:
+                buffer_event.set_max_pacing_rate(self.sock, rate)
+                return
+            except socket.error as exc:
+                self.server.logger.debug('Cannot set SO_MAX_PACING_RATE for %s: %s',
+                                         self, exc)
+        self.pacing = limits.TokenBucket(rate, rate * self.PACING_BURST_DURATION, now)
+
+    def resume_pacing(self):
+        if not self.closed:
+            self.server.loop.register(self, POLLOUT)
+
+    def update_queue_metrics(self):
+        queue_size = self.output_buffer.queue_size()
+        self.queue_bucket = self.mount_metrics.queue_size_changed(
+            self.queue_bucket, self.reported_queue_size, queue_size)
+        self.reported_queue_size = queue_size
 
     @property
     def closed(self):
@@ -30,58 +119,179 @@ class StreamClient(HTTPEventHandler):
             self.timeout_state = True
             self.server.reset_inactivity_timeout(self)
 
-    def add_packet(self, packet):
-        self.output_buffer.add_buffer(packet)
+    def add_packet(self, packet, sync_point = True, ring_offset = None):
+        if self.resyncing:
+            if not sync_point:
+                self.skipped_bytes += len(packet)
+                return
+            self.resyncing = False
+        if ring_offset is not None:
+            # Sent from our source's memfd ring, see MemFDRing
+            self.output_buffer.add_ring_data(self.source.ring, ring_offset, len(packet))
+        else:
+            self.output_buffer.add_buffer(packet)
+        self.update_queue_metrics()
         self.activate_timeout()
-        self.server.loop.register(self, POLLOUT)
+        if self.output_buffer.send_pending:
+            # We go on once it completes, see send_done()
+            return
+        if self.can_submit_send():
+            self.submit_send()
+        else:
+            self.server.loop.register(self, POLLOUT)
+
+    def can_submit_send(self):
+        return (self.server.loop.batched_sends and self.pacing is None and
+                self.output_buffer.can_submit_send())
+
+    def submit_send(self):
+        # Submitted along with the sends to the other clients, instead
+        # of waiting for POLLOUT to send() it ourselves
+        self.server.loop.register(self, 0)
+        self.output_buffer.submit_send(self.server.loop, self)
+
+    def send_done(self, result):
+        """Handle the result of a send queued by submit_send()."""
+        if self.closed:
+            # Cancelled by our close()
+            return
+        if result < 0:
+            if -result in (errno.EPIPE, errno.ECONNRESET):
+                self.server.logger.error('Connection closed by %s', self)
+                self.close()
+                return
+            if -result not in (errno.EAGAIN, errno.EINTR):
+                raise IOError(-result, os.strerror(-result))
+            result = 0
+        self.output_buffer.send_done(result)
+        if result:
+            self.server.update_activity(self)
+            self.bytes_sent += result
+            self.mount_metrics.bytes_out += result
+        self.update_queue_metrics()
+        if self.output_buffer.empty():
+            self.server.remove_inactivity_timeout(self)
+            self.timeout_state = False
+        elif result and self.can_submit_send():
+            self.submit_send()
+        else:
+            self.server.loop.register(self, POLLOUT)
+
+    def can_resync(self):
+        """Whether we can drop queued data without corrupting our stream."""
+        return True
+
+    def lag_exceeded(self, lag_policy, max_lag):
+        if lag_policy.action == lag_policy.RESYNC and self.can_resync():
+            self.skipped_bytes += self.output_buffer.truncate()
+            self.update_queue_metrics()
+            self.resyncing = True
+            self.resyncs += 1
+            self.mount_metrics.client_resynced()
+            self.server.logger.debug('Client lag exceeded for %s, resyncing', self)
+        else:
+            self.server.logger.info('Client lag exceeded for %s: %d > %d',
+                                    self, self.output_buffer.queue_size(), max_lag)
+            self.mount_metrics.client_dropped('max_lag')
+            self.close()
 
     def close(self):
+        self.mount_metrics.client_disconnected(self.queue_bucket,
+                                               self.reported_queue_size)
+        if self.server.accept_limits is not None:
+            self.server.accept_limits.stream_stopped(self.address[0])
+        if self.pacing is not None:
+            self.server.timeouts.remove_timeout(self)
         self.server.remove_client(self)
         HTTPEventHandler.close(self)
 
+    def handle_event(self, eventmask):
+        if eventmask & POLLERR and self.output_buffer.zerocopy_pending is not None:
+            # Zero-copy completions are signalled as errors; a real
+            # error will still be there on the next loop iteration
+            if self.output_buffer.reap_zerocopy():
+                eventmask &= ~POLLERR
+                if not eventmask:
+                    return
+        HTTPEventHandler.handle_event(self, eventmask)
+
     def finish(self):
         # This is a no-op, since we never really know when we end the
         # connection (it's up to the stream source)
         pass
 
     def flush(self):
-        HTTPEventHandler.flush(self)
-        if self.output_buffer.ready:
+        if self.output_buffer.send_pending:
+            # See send_done()
+            self.server.loop.register(self, 0)
+            return
+        max_bytes = self.server.write_quantum
+        if self.pacing is not None:
+            allowed = self.pacing.available(self.server.loop.now())
+            if allowed <= 0:
+                self.pause_pacing()
+                return
+            if max_bytes is None or allowed < max_bytes:
+                max_bytes = allowed
+        bytes_sent = self.bytes_sent
+        HTTPEventHandler.flush(self, max_bytes)
+        if self.closed:
+            return
+        self.mount_metrics.bytes_out += self.bytes_sent - bytes_sent
+        self.update_queue_metrics()
+        if self.pacing is not None:
+            self.pacing.consume(self.bytes_sent - bytes_sent)
+        if self.output_buffer.empty():
             # De-activate handler to avoid unnecessary notifications
             self.server.loop.register(self, 0)
             # deactivate timer if output_buffer is empty
             self.server.remove_inactivity_timeout(self)
             self.timeout_state = False
+        elif self.pacing is not None and self.pacing.tokens < 1:
+            self.pause_pacing()
+
+    def pause_pacing(self):
+        # Stop our POLLOUT notifications until we may send again,
+        # though new packets re-register us, see add_packet()
+        self.server.loop.register(self, 0)
+        delay = max(self.pacing.delay(), self.PACING_MIN_DELAY)
+        expiration = math.ceil((self.server.loop.now() + delay) /
+                               self.PACING_MIN_DELAY) * self.PACING_MIN_DELAY
+        self.server.timeouts.reset_timeout(self, expiration, self.resume_pacing)
 
 
 class ShoutcastClient(StreamClient):
 
-    ICY_META_INTERVAL = 32 * 2 ** 10
+    __slots__ = (
+        'metadata',
+        'bytes_count',
+    )
+
+    ICY_META_INTERVAL = ShoutcastSource.ICY_META_INTERVAL
 
     def __init__(self, server, source, sock, address, request_parser,
                  content_type):
-        headers = {b'Content-Length': None, b'Content-Type': content_type}
-        for header in source.ICY_HEADERS:
-            if header == 'metaint':
-                continue
-
-            header_value = getattr(source, 'icy_%s' % header)
-            if header_value:
-                headers[b'icy-%s' % header] = header_value
-
         # did client asked for metadata ?
+        self.metadata = None
         if request_parser.headers.get('Icy-Metadata') == b'1' and hasattr(
             source, 'metadata'):
             self.metadata = b''
             self.bytes_count = 0
-            self.add_packet = self.add_packet_with_metadata
-            headers[b'icy-metaint'] = b'%s' % self.ICY_META_INTERVAL
 
         StreamClient.__init__(self, server, source, sock, address, request_parser,
-                              content_type, HTTPResponse(
-                                  200, b'OK',
-                                  headers,
-                              ))
+                              content_type,
+                              source.client_response(self.metadata is not None))
+
+    def add_packet(self, packet, sync_point = True, ring_offset = None):
+        if self.metadata is None:
+            StreamClient.add_packet(self, packet, sync_point, ring_offset)
+        else:
+            self.add_packet_with_metadata(packet)
+
+    def can_resync(self):
+        # Dropping data would shift the metadata blocks our client
+        # expects every ICY_META_INTERVAL bytes
+        return self.metadata is None
 
     def add_packet_with_metadata(self, packet):
         packet_cuts = []
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import functools
+import hashlib
+import socket
+import urlparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from savate import callout
+from savate import helpers
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class Peer(object):
+
+    def __init__(self, url, status_path):
+        # Used in Location headers, which are bytes
+        self.url = helpers.to_bytes(url).rstrip(b'/')
+        self.status_url = self.url + helpers.to_bytes(status_path)
+        self.parsed_status_url = urlparse.urlparse(self.status_url)
+        # Last known cluster status, None if unknown or unreachable
+        self.status = None
+        self.last_update = None
+        self.callout = None
+        # Resolved once, so that gossip never blocks on DNS
+        self.address_info = socket.getaddrinfo(self.parsed_status_url.hostname,
+                                               self.parsed_status_url.port or 80,
+                                               socket.AF_UNSPEC,
+                                               socket.SOCK_STREAM,
+                                               socket.IPPROTO_TCP)[0]
+
+    def available(self, path, now, max_age):
+        """Whether we can send the clients of path to this peer."""
+        return (self.status is not None and now - self.last_update <= max_age and
+                not self.status.get('overloaded') and
+                path in self.status.get('mounts', ()))
+
+    def __str__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.url)
+
+
+class Cluster(object):
+    """
+    Other savate nodes we redirect clients to when we are overloaded,
+    or when we do not carry the mount they ask for.
+
+    Peers are picked by consistent hashing of the mount path, skipping
+    the ones which are unreachable, overloaded or do not carry the
+    mount, so that the clients of a mount gather on a few nodes. The
+    peers status comes from polling their cluster status handler every
+    gossip_interval seconds.
+    """
+
+    # Points per peer on the hash ring, for an even distribution
+    VIRTUAL_NODES = 64
+
+    STATUS_PATH = '/cluster.json'
+
+    def __init__(self, server, peers, status_path = STATUS_PATH,
+                 gossip_interval = 5, timeout = 2):
+        self.server = server
+        self.status_path = status_path
+        self.gossip_interval = gossip_interval
+        self.timeout = timeout
+        # A status older than this is not trusted anymore
+        self.max_age = 3 * gossip_interval
+
+        self.peers = [Peer(url, status_path) for url in peers]
+        ring = sorted((ring_hash('%s#%d' % (peer.url, index)), peer)
+                      for peer in self.peers for index in xrange(self.VIRTUAL_NODES))
+        self.ring_hashes = [point for point, peer in ring]
+        self.ring_peers = [peer for point, peer in ring]
+
+        self.gossip()
+
+    def gossip(self):
+        for peer in self.peers:
+            if peer.callout is not None:
+                # Still waiting for the previous answer
+                continue
+            try:
+                peer.callout = callout.HTTPCallout(
+                    self.server, peer.status_url, peer.address_info,
+                    callout.build_get_request(peer.parsed_status_url),
+                    self.timeout, functools.partial(self.gossip_done, peer),
+                    read_body = True)
+            except (IOError, socket.error):
+                self.server.logger.exception('Cannot reach cluster peer %s:', peer)
+                peer.status = None
+        self.server.timeouts.reset_timeout(self,
+                                           self.server.loop.now() + self.gossip_interval,
+                                           self.gossip)
+
+    def gossip_done(self, peer, status_code, body):
+        peer.callout = None
+        if status_code != 200:
+            if peer.status is not None:
+                self.server.logger.error('Lost cluster peer %s', peer)
+            peer.status = None
+            return
+        try:
+            peer.status = json.loads(body)
+        except ValueError:
+            self.server.logger.error('Invalid cluster status from %s', peer)
+            peer.status = None
+            return
+        peer.last_update = self.server.loop.now()
+
+    def choose_peer(self, path):
+        """
+        Return the peer the clients of path should be sent to, or
+        None if there is none available.
+        """
+        if not self.ring_peers:
+            return None
+        now = self.server.loop.now()
+        index = bisect.bisect(self.ring_hashes, ring_hash(path))
+        seen = set()
+        for offset in xrange(len(self.ring_peers)):
+            peer = self.ring_peers[(index + offset) % len(self.ring_peers)]
+            if peer in seen:
+                continue
+            if peer.available(path, now, self.max_age):
+                return peer
+            seen.add(peer)
+            if len(seen) == len(self.peers):
+                break
+        return None
+
+    def close(self):
+        self.server.timeouts.remove_timeout(self)
+        for peer in self.peers:
+            if peer.callout is not None:
+                peer.callout.close()
@@ -7,6 +7,15 @@ import socket
 import sys
 import re
 
+from savate import buffer_event
+from savate import cluster
+from savate import limits
+from savate import looping
+from savate import outputs
+from savate import routing
+from savate import status
+from savate.helpers import PrebuiltHTTPResponse, to_bytes
+
 
 SIZE_REGEXP = re.compile(r'^\d+k?$')
 
@@ -51,14 +60,19 @@ class ServerConfiguration(object):
         self.configure_stats()
         self.configure_authorization()
         self.configure_status()
+        self.configure_cluster()
+        self.configure_routes()
         self.configure_relays()
+        self.configure_outputs()
         self.configure_limits()
+        self.configure_loop()
+        self.configure_accept()
 
     def reconfigure(self, config_dict):
         self.config_dict = config_dict
         # authorization, status and statistics handlers may have a close method
         for handler in itertools.chain(self.server.auth_handlers,
-                                       self.server.status_handlers,
+                                       self.server.status_handlers.itervalues(),
                                        self.server.statistics_handlers):
             if callable(getattr(handler, 'close', None)):
                 handler.close()
@@ -74,6 +88,8 @@ class ServerConfiguration(object):
         self.configure_authorization()
         self.configure_status()
         self.configure_stats()
+        self.configure_cluster()
+        self.configure_routes()
 
         # Here comes the tricky part: identifying which relays we need
         # to drop
@@ -142,7 +158,10 @@ class ServerConfiguration(object):
 
         # Take new configuration into account
         self.configure_relays()
+        self.configure_outputs()
         self.configure_limits()
+        self.configure_loop()
+        self.configure_accept()
 
     def configure_relays(self):
         conf = self.config_dict
@@ -174,7 +193,7 @@ class ServerConfiguration(object):
             path = mount_conf['path']
             for source_url in mount_conf['source_urls']:
                 parsed_url = urlparse.urlparse(source_url)
-                if parsed_url.scheme in ('udp', 'multicast'):
+                if parsed_url.scheme in ('udp', 'multicast', 'rtp'):
                     if (source_url, path, None) not in relay_index:
                         server.logger.info('Trying to relay %s', source_url)
                         server.add_relay(source_url, path,
@@ -227,6 +246,35 @@ class ServerConfiguration(object):
             handler_instance = handler_class(server, conf, **status_handler)
             server.add_status_handler(handler_path, handler_instance)
 
+    def configure_cluster(self):
+        if self.server.cluster is not None:
+            self.server.cluster.close()
+            self.server.cluster = None
+
+        cluster_conf = self.config_dict.get('cluster')
+        if not cluster_conf:
+            return
+
+        self_url = cluster_conf.get('self_url')
+        peers = [url for url in cluster_conf.get('peers', []) if url != self_url]
+        status_path = cluster_conf.get('status_path', cluster.Cluster.STATUS_PATH)
+        try:
+            self.server.cluster = cluster.Cluster(
+                self.server, peers, status_path,
+                float(cluster_conf.get('gossip_interval', 5)),
+                float(cluster_conf.get('timeout', 2)))
+        except (ValueError, TypeError, socket.error):
+            raise BadConfig('Bad cluster configuration.')
+        # Serve our own status to our peers
+        self.server.add_status_handler(status_path, status.ClusterStatusClient(
+            self.server, self.config_dict, handler = 'savate.status.ClusterStatusClient',
+            cache_ttl = 1))
+
+    def configure_routes(self):
+        self.server.routes = routing.RouteTable(self.config_dict.get('mounts', []),
+                                                self.server.status_handlers,
+                                                self.server.auth_handlers)
+
     def configure_stats(self):
         conf = self.config_dict
         server = self.server
@@ -239,6 +287,50 @@ class ServerConfiguration(object):
             handler_instance = handler_class(server, **stat_handler)
             self.server.add_stats_handler(handler_instance)
 
+    def configure_outputs(self):
+        # Outputs whose configuration did not change are kept, so
+        # that they go on feeding their destination
+        current_outputs = dict(((output.path, output.url), output)
+                               for mount_outputs in self.server.outputs.itervalues()
+                               for output in mount_outputs)
+        global_pacing = self.config_dict.get('output_pacing')
+        mounts_outputs = {}
+        for mount_conf in self.config_dict.get('mounts', []):
+            if not mount_conf.get('outputs'):
+                continue
+            path = routing.normalize_path(mount_conf['path'])
+            if path.endswith(routing.WILDCARD_SUFFIX):
+                raise BadConfig('Outputs are not supported for wildcard mount %s.' % path)
+            try:
+                pacing = mount_conf.get('output_pacing', global_pacing)
+                if pacing is not None:
+                    pacing = float(pacing)
+                    if pacing < 1:
+                        raise BadConfig('output_pacing must be at least 1.')
+            except (ValueError, TypeError, BadConfig):
+                raise BadConfig('Bad output_pacing for %s.' % path)
+            for url in mount_conf['outputs']:
+                output = current_outputs.pop((path, url), None)
+                if output is None:
+                    try:
+                        output = outputs.UDPOutput(self.server, url, path, pacing)
+                    except (ValueError, socket.error) as exc:
+                        raise BadConfig('Bad output %s for %s: %s' % (url, path, exc))
+                    self.server.logger.info('Sending %s to %s', path, url)
+                else:
+                    output.pacing_factor = pacing
+                    if pacing is None:
+                        output.pacing = None
+                mounts_outputs.setdefault(path, []).append(output)
+        for output in current_outputs.itervalues():
+            self.server.logger.info('Dropping output %s, it has been removed '
+                                    'from configuration', output)
+            output.close()
+        self.server.outputs = mounts_outputs
+        if outputs.sendmmsg is None and mounts_outputs:
+            self.server.logger.warning('savate was built without sendmmsg() support, '
+                                       'outputs will send datagrams one by one')
+
     def configure_limits(self):
         # set limits for maximum simultaneous clients
         try:
@@ -246,3 +338,188 @@ class ServerConfiguration(object):
             self.server.logger.info('Set client limit to %d', self.server.clients_limit)
         except (ValueError, TypeError):
             self.server.clients_limit = None
+
+        # Keyed like the routes, see Server.admission_check()
+        mount_clients_limits = {}
+        for mount_conf in self.config_dict.get('mounts', []):
+            if mount_conf.get('clients_limit') is None:
+                continue
+            path = routing.normalize_path(mount_conf['path'])
+            try:
+                mount_clients_limits[path] = int(mount_conf['clients_limit'])
+            except (ValueError, TypeError):
+                raise BadConfig('Bad clients_limit for %s, should be a number of clients.' %
+                                path)
+        self.server.mount_clients_limits = mount_clients_limits
+
+        try:
+            self.server.max_egress_bps = int(self.config_dict.get('max_egress_bps'))
+            self.server.logger.info('Set egress limit to %d bits/s', self.server.max_egress_bps)
+        except (ValueError, TypeError):
+            self.server.max_egress_bps = None
+
+        # Location headers are bytes, and JSON gives us unicode strings
+        self.server.overload_redirect = to_bytes(self.config_dict.get('overload_redirect'))
+        # Keyed like the routes, see Server.overload_response()
+        self.server.overload_redirects = dict(
+            (routing.normalize_path(mount_conf['path']), to_bytes(mount_conf['overload_redirect']))
+            for mount_conf in self.config_dict.get('mounts', [])
+            if 'overload_redirect' in mount_conf)
+        try:
+            retry_after = int(self.config_dict.get('retry_after', 10))
+        except (ValueError, TypeError):
+            raise BadConfig('retry_after must be a number of seconds.')
+        self.server.overload_unavailable = PrebuiltHTTPResponse(
+            503, b'Cannot handle response. Too many clients.',
+            {b'Retry-After': retry_after})
+
+        self.configure_lag_policies()
+        self.configure_client_sockets()
+        self.configure_output_backends()
+
+    def lag_policy(self, conf, default):
+        try:
+            max_lag_seconds = conf.get('max_lag_seconds', default.max_seconds)
+            return limits.LagPolicy(
+                convert_burst_size(conf.get('max_lag', default.max_bytes)),
+                float(max_lag_seconds) if max_lag_seconds is not None else None,
+                conf.get('lag_policy', default.action))
+        except (ValueError, TypeError, BadConfig):
+            raise BadConfig('Bad lag policy configuration for %s.' %
+                            conf.get('path', 'the server'))
+
+    def configure_lag_policies(self):
+        default = self.lag_policy(self.config_dict, limits.LagPolicy())
+        self.server.default_lag_policy = default
+        # Keyed like the routes, see Server.lag_policy()
+        self.server.lag_policies = dict(
+            (routing.normalize_path(mount_conf['path']), self.lag_policy(mount_conf, default))
+            for mount_conf in self.config_dict.get('mounts', []))
+
+    def socket_options(self, conf, default):
+        try:
+            burst_pacing = conf.get('burst_pacing', default.burst_pacing)
+            if burst_pacing is not None:
+                burst_pacing = float(burst_pacing)
+                if burst_pacing <= 1:
+                    raise BadConfig('burst_pacing must be greater than 1.')
+            return buffer_event.SocketOptions(
+                convert_burst_size(conf.get('tcp_notsent_lowat', default.notsent_lowat)),
+                convert_burst_size(conf.get('tcp_send_buffer', default.send_buffer)),
+                burst_pacing,
+                bool(conf.get('userland_pacing', default.userland_pacing)),
+                convert_burst_size(conf.get('zerocopy_threshold',
+                                            default.zerocopy_threshold)))
+        except (ValueError, TypeError, BadConfig):
+            raise BadConfig('Bad client socket options for %s.' %
+                            conf.get('path', 'the server'))
+
+    def configure_client_sockets(self):
+        default = self.socket_options(self.config_dict, buffer_event.SocketOptions())
+        self.server.default_client_socket_options = default
+        if buffer_event.zerocopy is None and (default.zerocopy_threshold is not None or any(
+                'zerocopy_threshold' in mount_conf
+                for mount_conf in self.config_dict.get('mounts', []))):
+            self.server.logger.warning('zerocopy_threshold is set, but savate was '
+                                       'built without MSG_ZEROCOPY support')
+        self.server.client_socket_options = dict(
+            (routing.normalize_path(mount_conf['path']), self.socket_options(mount_conf, default))
+            for mount_conf in self.config_dict.get('mounts', []))
+
+    OUTPUT_BACKENDS = ('buffers', 'memfd')
+
+    def ring_size(self, conf, default):
+        output_backend = conf.get('output_backend',
+                                  'buffers' if default is None else 'memfd')
+        if output_backend not in self.OUTPUT_BACKENDS:
+            raise BadConfig('Unknown output backend %r for %s.' %
+                            (output_backend, conf.get('path', 'the server')))
+        if output_backend == 'buffers':
+            return None
+        try:
+            ring_size = convert_burst_size(conf.get('ring_size',
+                                                    default or buffer_event.MemFDRing.DEFAULT_SIZE))
+        except (ValueError, TypeError, BadConfig):
+            raise BadConfig('Bad ring_size for %s.' % conf.get('path', 'the server'))
+        if ring_size is None or ring_size < buffer_event.MemFDRing.MIN_SIZE:
+            raise BadConfig('ring_size for %s should be at least %d bytes.' %
+                            (conf.get('path', 'the server'), buffer_event.MemFDRing.MIN_SIZE))
+        return ring_size
+
+    def configure_output_backends(self):
+        default = self.ring_size(self.config_dict, None)
+        # Keyed like the routes, see Server.ring_size()
+        ring_sizes = dict(
+            (routing.normalize_path(mount_conf['path']), self.ring_size(mount_conf, default))
+            for mount_conf in self.config_dict.get('mounts', []))
+        if buffer_event.memfd is None and (default is not None or any(
+                ring_size is not None for ring_size in ring_sizes.values())):
+            self.server.logger.warning('output_backend is memfd, but savate was built '
+                                       'without memfd support, using buffers')
+            default = None
+            ring_sizes = {}
+        self.server.default_ring_size = default
+        self.server.ring_sizes = ring_sizes
+
+    def loop_backend(self):
+        """Return the event loop backend, see Server.create_loop()."""
+        loop_backend = self.config_dict.get('loop_backend', 'epoll')
+        if loop_backend not in looping.IOLoop.BACKENDS:
+            raise BadConfig('Unknown loop_backend %r.' % loop_backend)
+        return loop_backend
+
+    def configure_loop(self):
+        # Only checked here, changing the backend requires a restart
+        self.loop_backend()
+
+        # optional event loop instrumentation
+        if self.config_dict.get('loop_statistics', False):
+            self.server.loop.enable_statistics(
+                float(self.config_dict.get('slow_callback_threshold', 0.1)))
+        else:
+            self.server.loop.disable_statistics()
+
+        # optional fair write scheduling
+        try:
+            write_budget = self.config_dict.get('write_budget')
+            self.server.loop.set_write_budget(
+                float(write_budget) if write_budget is not None else None)
+            self.server.write_quantum = convert_burst_size(
+                self.config_dict.get('write_quantum'))
+        except (ValueError, TypeError, BadConfig):
+            raise BadConfig('Bad write_budget or write_quantum.')
+
+    def configure_accept(self):
+        try:
+            self.server.accept_batch_size = max(1, int(self.config_dict.get(
+                'accept_batch_size', self.server.ACCEPT_BATCH_SIZE)))
+        except (ValueError, TypeError):
+            self.server.accept_batch_size = self.server.ACCEPT_BATCH_SIZE
+        self.server.set_defer_accept(self.config_dict.get('tcp_defer_accept', 0))
+        self.configure_accept_limits()
+
+    def configure_accept_limits(self):
+        limits_conf = self.config_dict.get('accept_limits')
+        if not limits_conf:
+            self.server.accept_limits = None
+            return
+
+        try:
+            accept_limits = limits.AcceptLimits(
+                limits_conf.get('rate'),
+                limits_conf.get('burst'),
+                limits_conf.get('prefix_rate'),
+                limits_conf.get('prefix_burst'),
+                limits_conf.get('max_streams'),
+                limits_conf.get('prefix_max_streams'),
+                int(limits_conf.get('table_size', limits.AcceptLimits.TABLE_SIZE)),
+            )
+        except (ValueError, TypeError):
+            raise BadConfig('Bad accept_limits configuration.')
+        # Account for the streams we are already serving
+        for client in itertools.chain(self.server.all_clients(),
+                                      itertools.chain.from_iterable(
+                                          self.server.keepalived.itervalues())):
+            if not client.closed:
+                accept_limits.stream_started(client.address[0])
+        self.server.accept_limits = accept_limits
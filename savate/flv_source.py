@@ -29,6 +29,9 @@ class FLVSource(StreamSource):
         self.got_initial_meta = self.got_initial_audio = self.got_initial_video = False
         # Our current packets group
         self.packets_group = collections.deque()
+        # Whether it starts at a sync point, i.e. it is not the
+        # partial group we got before the first one
+        self.packets_group_synced = False
         # Our current "burst" packets groups list
         self.burst_groups = collections.deque()
         # List of buffers for the "burst" packets
@@ -42,6 +45,7 @@ class FLVSource(StreamSource):
         self.got_initial_meta = self.got_initial_audio = self.got_initial_video = False
         self.initial_tags.clear()
         self.packets_group.clear()
+        self.packets_group_synced = False
         self.burst_groups.clear()
         self.burst_groups_data.clear()
         self.handle_data = self.handle_header
@@ -60,6 +64,17 @@ class FLVSource(StreamSource):
         for group_data in self.burst_groups_data:
             client.add_packet(group_data)
 
+    def memory_status(self):
+        # Burst groups keep the parsed tags around, on top of the
+        # joined data sent to new clients
+        burst_bytes = sum(len(group_data) for group_data in self.burst_groups_data)
+        burst_bytes += sum(len(tag.raw_data) + len(tag.body)
+                           for group in self.burst_groups for tag in group)
+        burst_bytes += sum(len(tag.raw_data) + len(tag.body) for tag in self.initial_tags)
+        parser_bytes = len(self.buffer_data)
+        parser_bytes += sum(len(tag.raw_data) + len(tag.body) for tag in self.packets_group)
+        return {'burst_bytes': burst_bytes, 'parser_bytes': parser_bytes}
+
     def handle_packet(self, packet):
         self.buffer_data = self.buffer_data + packet
         while self.handle_data():
@@ -139,11 +154,13 @@ class FLVSource(StreamSource):
             # packets. It seems buffering is needed to avoid a
             # skyrocketing CPU consumption, hence the ''.join()
             self.publish_packet(b''.join(
-                    itertools.chain.from_iterable((tag.raw_data, tag.body) for tag in self.packets_group)))
+                    itertools.chain.from_iterable((tag.raw_data, tag.body) for tag in self.packets_group)),
+                                self.packets_group_synced)
             # And add it to the burst packets groups list
             self.add_to_burst_groups(self.packets_group)
             # Reset the current packets group
             self.packets_group = collections.deque()
+            self.packets_group_synced = True
         self.packets_group.append(flv_tag)
 
     def add_to_burst_groups(self, group):
@@ -28,6 +28,48 @@ def loop_for_eagain(func, *args, **kwargs):
         else:
             raise
 
+def to_bytes(value, encoding = 'utf-8'):
+    """Encode value if it is a unicode string, e.g. from a JSON configuration."""
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    return value
+
+HTTP_HEADERS_END = b'\r\n\r\n'
+
+# Receive buffer shared by every recv_http_headers() call
+_headers_recv_buffer = bytearray(4096)
+
+def recv_http_headers(sock, previous_data, max_size):
+    """
+    Receive the next segment of an HTTP message's headers, at most
+    max_size bytes in total. Returns None on EAGAIN, b'' at end of
+    stream, or else all the data received so far. The data is received
+    in a shared buffer, so that only incomplete messages keep memory
+    around, and only headers split over several segments need a
+    concatenation.
+    """
+    global _headers_recv_buffer
+    if len(_headers_recv_buffer) < max_size:
+        _headers_recv_buffer = bytearray(max_size)
+    nbytes = handle_eagain(sock.recv_into, _headers_recv_buffer,
+                           max_size - len(previous_data))
+    if nbytes is None:
+        return None
+    elif nbytes == 0:
+        return b''
+    data = memoryview(_headers_recv_buffer)[:nbytes].tobytes()
+    if previous_data:
+        data = previous_data + data
+    return data
+
+def http_headers_complete(data, previous_size = 0):
+    """
+    Whether data contains the end of the HTTP headers, knowing that
+    its first previous_size bytes did not.
+    """
+    search_start = max(0, previous_size - len(HTTP_HEADERS_END) + 1)
+    return data.find(HTTP_HEADERS_END, search_start) != -1
+
 def build_http_headers(headers, body):
     default_headers = {
         b'Connection': b'close',
@@ -58,19 +100,93 @@ class HTTPParseError(HTTPError):
     pass
 
 
+class RequestSummary(object):
+    """
+    The parts of an HTTP request we keep once it has been routed,
+    i.e. what logging and statistics handlers need. It quacks like the
+    request parser it is built from for these uses, without keeping
+    the parser, its buffers and all the request headers around.
+    """
+
+    __slots__ = (
+        'request_method',
+        'request_path',
+        'http_version',
+        'headers',
+    )
+
+    KEPT_HEADERS = ('Referer', 'User-Agent')
+
+    def __init__(self, request_parser):
+        self.request_method = request_parser.request_method
+        self.request_path = request_parser.request_path
+        self.http_version = request_parser.http_version
+        self.headers = dict((header, request_parser.headers[header])
+                            for header in self.KEPT_HEADERS
+                            if header in request_parser.headers)
+
+
+class Deferred(object):
+    """
+    A result which is not known yet. Callbacks added through
+    add_callback() are called with the result as their last argument
+    once it is known, i.e. when resolve() is called, or right away if
+    it already was.
+    """
+
+    __slots__ = (
+        'callbacks',
+        'resolved',
+        'result',
+    )
+
+    def __init__(self):
+        self.callbacks = []
+        self.resolved = False
+        self.result = None
+
+    def add_callback(self, callback, *args):
+        if self.resolved:
+            callback(*(args + (self.result,)))
+        else:
+            self.callbacks.append((callback, args))
+
+    def resolve(self, result):
+        self.resolved = True
+        self.result = result
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            callback(*(args + (result,)))
+
+
 class HTTPEventHandler(BaseIOEventHandler):
 
+    __slots__ = (
+        'server',
+        'sock',
+        'address',
+        'request_parser',
+        'output_buffer',
+        'status',
+        'connect_time',
+        'bytes_sent',
+    )
+
     def __init__(self, server, sock, address, request_parser, response):
         self.server = server
         self.sock = sock
         self.address = address
-        self.request_parser = request_parser
+        self.request_parser = RequestSummary(request_parser)
 
+        if response is not None:
+            initial_buffer_queue = (response.as_bytes(),)
+        else:
+            initial_buffer_queue = ()
         self.output_buffer = buffer_event.BufferOutputHandler(sock,
-                                                              (response.as_bytes(),))
+                                                              initial_buffer_queue)
 
         # statistics
-        self.status = response.status
+        self.status = response.status if response is not None else None
         self.connect_time = server.loop.now()
         self.bytes_sent = 0
 
@@ -81,19 +197,22 @@ class HTTPEventHandler(BaseIOEventHandler):
         self.server.loop.unregister(self)
         BaseIOEventHandler.close(self)
 
-    def flush(self):
+    def flush(self, max_bytes = None):
         try:
-            bytes_sent = self.output_buffer.flush()
+            bytes_sent = self.output_buffer.flush(max_bytes)
         except buffer_event.QueueSizeExceeded as exc:
-            self.server.logger.info('Client queue size exceeded for %s: %s' %
-                                    exc.message)
-            self.close()
+            self.handle_queue_size_exceeded(exc)
             return
 
         if bytes_sent:
             self.server.update_activity(self)
             self.bytes_sent += bytes_sent
 
+    def handle_queue_size_exceeded(self, exc):
+        self.server.logger.info('Client queue size exceeded for %s: %s',
+                                self, exc)
+        self.close()
+
     def finish(self):
         if self.output_buffer.empty():
             self.close()
@@ -124,6 +243,73 @@ class HTTPEventHandler(BaseIOEventHandler):
             )
 
 
+class DeferredHTTPEventHandler(HTTPEventHandler):
+    """
+    An HTTPEventHandler whose response is only known later on, and
+    provided through respond(). Until then, the handler does not ask
+    for POLLOUT notifications and has no inactivity timeout.
+    """
+
+    __slots__ = ('responded',)
+
+    # nginx-style status for requests closed before we responded
+    CLIENT_CLOSED_REQUEST = 499
+
+    def __init__(self, server, sock, address, request_parser):
+        HTTPEventHandler.__init__(self, server, sock, address,
+                                  request_parser, None)
+        self.responded = False
+
+    @property
+    def closed(self):
+        return self.sock is None
+
+    def respond(self, response):
+        self.status = response.status
+        self.output_buffer.add_buffer(buffer_event.make_buffer(response.as_bytes()))
+        self.responded = True
+        self.server.reset_inactivity_timeout(self)
+        self.server.loop.register(self, looping.POLLOUT)
+
+    def close(self):
+        if not self.responded:
+            self.status = self.CLIENT_CLOSED_REQUEST
+        HTTPEventHandler.close(self)
+
+    def finish(self):
+        if self.responded:
+            HTTPEventHandler.finish(self)
+        else:
+            # Nothing to send until respond() is called
+            self.server.remove_inactivity_timeout(self)
+            self.server.loop.register(self, 0)
+
+
+class StreamedHTTPEventHandler(HTTPEventHandler):
+    """
+    An HTTPEventHandler whose body is produced by an iterator, one
+    chunk at a time. The next chunk is only generated once the
+    previous one has been sent, so a large body is spread over
+    several loop iterations instead of being built in one go.
+    """
+
+    __slots__ = ('body_chunks',)
+
+    def __init__(self, server, sock, address, request_parser, response,
+                 body_chunks):
+        HTTPEventHandler.__init__(self, server, sock, address,
+                                  request_parser, response)
+        self.body_chunks = iter(body_chunks)
+
+    def finish(self):
+        if self.output_buffer.empty():
+            for chunk in self.body_chunks:
+                if chunk:
+                    self.output_buffer.add_buffer(buffer_event.make_buffer(chunk))
+                    return
+            self.close()
+
+
 class HTTPResponse(object):
 
     def __init__(self, status, reason, headers = None, body = b''):
@@ -138,6 +324,56 @@ class HTTPResponse(object):
         return b'\r\n'.join([status_line, headers_lines, self.body])
 
 
+class PrebuiltHTTPResponse(HTTPResponse):
+    """
+    An HTTPResponse rendered once and for all, for responses sent
+    over and over again. It must not be modified afterwards.
+    """
+
+    def __init__(self, status, reason, headers = None, body = b''):
+        HTTPResponse.__init__(self, status, reason, headers, body)
+        self.response_bytes = HTTPResponse.as_bytes(self)
+
+    def as_bytes(self):
+        return self.response_bytes
+
+
+class ExpiringLRUCache(object):
+    """
+    A mapping holding at most maxsize items, each one valid until its
+    expiry time (or forever if None). The least recently used item is
+    evicted to make room for new ones.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # key -> (value, expiry time)
+        self.items = collections.OrderedDict()
+
+    def get(self, key, now, default = None):
+        try:
+            value, expires_at = self.items.pop(key)
+        except KeyError:
+            return default
+        if expires_at is not None and expires_at <= now:
+            return default
+        # Move it to the most recently used end
+        self.items[key] = (value, expires_at)
+        return value
+
+    def set(self, key, value, expires_at = None):
+        self.items.pop(key, None)
+        self.items[key] = (value, expires_at)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last = False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
 class BurstQueue(collections.deque):
 
     def __init__(self, maxbytes, iterable = ()):
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import array
+import socket
+
+from savate import buffer_event
+
+
+def address_prefix(ip):
+    """Return the /24 (IPv4) or /64 (IPv6) network of ip."""
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)[:8]
+    return ip.rsplit('.', 1)[0]
+
+
+class TokenBuckets(object):
+    """
+    Token buckets in a fixed size table, indexed by the hash of their
+    key, so that memory usage does not depend on the number of keys.
+    Keys sharing a slot share their bucket, which can only make the
+    limit stricter for them.
+    """
+
+    def __init__(self, rate, burst, size):
+        # Tokens added per second, and maximum number of tokens
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = array.array('d', [self.burst]) * size
+        self.updated = array.array('d', [0]) * size
+
+    def consume(self, key, now):
+        """Take a token from key's bucket, return False if empty."""
+        slot = hash(key) % len(self.tokens)
+        tokens = min(self.burst,
+                     self.tokens[slot] + (now - self.updated[slot]) * self.rate)
+        self.updated[slot] = now
+        if tokens < 1:
+            self.tokens[slot] = tokens
+            return False
+        self.tokens[slot] = tokens - 1
+        return True
+
+
+class TokenBucket(object):
+    """A single token bucket, e.g. of bytes for a client's send rate."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def available(self, now):
+        """Return the number of tokens available at now."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return int(self.tokens)
+
+    def consume(self, count):
+        # Tokens may go negative, delaying the next refill
+        self.tokens -= count
+
+    def delay(self, count = 1):
+        """Return how long, in seconds, until count tokens are available."""
+        return max(0, (count - self.tokens) / self.rate)
+
+
+class Counters(object):
+    """Counters in a fixed size table, see :class:`TokenBuckets`."""
+
+    def __init__(self, size):
+        self.counts = array.array('l', [0]) * size
+
+    def get(self, key):
+        return self.counts[hash(key) % len(self.counts)]
+
+    def increment(self, key):
+        self.counts[hash(key) % len(self.counts)] += 1
+
+    def decrement(self, key):
+        slot = hash(key) % len(self.counts)
+        if self.counts[slot] > 0:
+            self.counts[slot] -= 1
+
+
+class AcceptLimits(object):
+    """
+    Limits checked for every new connection, before anything is
+    allocated for it: a new connections rate and a concurrent streams
+    cap, both per client IP and per client network (/24 or /64).
+    """
+
+    TABLE_SIZE = 65536
+
+    def __init__(self, rate = None, burst = None, prefix_rate = None,
+                 prefix_burst = None, max_streams = None,
+                 prefix_max_streams = None, table_size = TABLE_SIZE):
+        self.ip_buckets = self.prefix_buckets = None
+        if rate is not None:
+            self.ip_buckets = TokenBuckets(rate, burst or rate, table_size)
+        if prefix_rate is not None:
+            self.prefix_buckets = TokenBuckets(prefix_rate, prefix_burst or prefix_rate,
+                                               table_size)
+        self.max_streams = max_streams
+        self.prefix_max_streams = prefix_max_streams
+        self.ip_streams = Counters(table_size)
+        self.prefix_streams = Counters(table_size)
+
+    def check(self, ip, now):
+        """
+        Return why a new connection from ip should be rejected, or
+        None if it is accepted.
+        """
+        prefix = address_prefix(ip)
+        if self.max_streams is not None and self.ip_streams.get(ip) >= self.max_streams:
+            return 'ip_streams'
+        if self.prefix_max_streams is not None and (
+            self.prefix_streams.get(prefix) >= self.prefix_max_streams):
+            return 'prefix_streams'
+        if self.ip_buckets is not None and not self.ip_buckets.consume(ip, now):
+            return 'ip_rate'
+        if self.prefix_buckets is not None and not self.prefix_buckets.consume(prefix, now):
+            return 'prefix_rate'
+        return None
+
+    def stream_started(self, ip):
+        self.ip_streams.increment(ip)
+        self.prefix_streams.increment(address_prefix(ip))
+
+    def stream_stopped(self, ip):
+        self.ip_streams.decrement(ip)
+        self.prefix_streams.decrement(address_prefix(ip))
+
+
+class LagPolicy(object):
+    """
+    How far behind its source a streaming client may fall, in bytes
+    and/or in seconds of stream, and what to do with it once it is
+    further behind: disconnect it, or drop its queued data and resume
+    at the next sync point of the stream.
+    """
+
+    DISCONNECT = 'disconnect'
+    RESYNC = 'resync'
+    ACTIONS = (DISCONNECT, RESYNC)
+
+    # Used when no limit is set, or when the stream bitrate is not
+    # known yet for a limit in seconds
+    DEFAULT_MAX_LAG = buffer_event.BufferOutputHandler.MAX_QUEUE_SIZE
+
+    def __init__(self, max_bytes = None, max_seconds = None, action = DISCONNECT):
+        if action not in self.ACTIONS:
+            raise ValueError('Unknown lag policy %r' % action)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.action = action
+
+    def max_lag(self, bitrate):
+        """Return the maximum lag in bytes, for a stream at bitrate bits/s."""
+        max_lag = self.max_bytes
+        if self.max_seconds is not None and bitrate:
+            seconds_lag = int(self.max_seconds * bitrate / 8)
+            if max_lag is None or seconds_lag < max_lag:
+                max_lag = seconds_lag
+        if max_lag is None:
+            return self.DEFAULT_MAX_LAG
+        return max_lag
@@ -24,13 +24,21 @@ TFD_CLOEXEC = lllsfd._TFD_CLOEXEC
 TFD_TIMER_ABSTIME = lllsfd._TFD_TIMER_ABSTIME
 
 
+cdef void seconds_to_timespec(double seconds, lllsfd.timespec *value):
+    value.tv_sec = <lllsfd.time_t> seconds
+    value.tv_nsec = <long> ((seconds - value.tv_sec) * 1e9)
+
+cdef double timespec_to_seconds(lllsfd.timespec *value):
+    return value.tv_sec + value.tv_nsec / 1e9
+
+
 class TimerFD(object):
     '''
     A low-level interface to Linux' timerfd. Read the
     timerfd_create(2) manual page for a proper description of the
     underlying API / concepts.
 
-    Subsecond precision is not supported as of now.
+    Times are given in seconds, as floats for subsecond precision.
     '''
 
     EXPIRATIONS_UNPACKER = struct.Struct('=Q')
@@ -63,7 +71,8 @@ class TimerFD(object):
         if ret != 0:
             global errno
             raise IOError(errno, os.strerror(errno))
-        return curr_value.it_value.tv_sec, curr_value.it_interval.tv_sec
+        return (timespec_to_seconds(&curr_value.it_value),
+                timespec_to_seconds(&curr_value.it_interval))
 
     def settime(self, expiration, repeat = 0, flags = 0):
         '''
@@ -77,10 +86,8 @@ class TimerFD(object):
         '''
         cdef itimerspec new_value
 
-        new_value.it_value.tv_sec = expiration
-        new_value.it_value.tv_nsec = 0
-        new_value.it_interval.tv_sec = repeat
-        new_value.it_interval.tv_nsec = 0
+        seconds_to_timespec(expiration, &new_value.it_value)
+        seconds_to_timespec(repeat, &new_value.it_interval)
 
         ret = lllsfd.timerfd_settime(self._fd, flags, &new_value, NULL)
         if ret != 0:
@@ -5,6 +5,8 @@ import errno
 import select
 import logging
 
+from savate import metrics
+
 
 try:
     Poller = select.epoll
@@ -19,9 +21,19 @@ except (AttributeError, NameError):
     POLLERR = select.POLLERR
     POLLHUP = select.POLLHUP
 
+# io_uring requires Linux >= 5.1
+try:
+    from savate import uring
+except ImportError:
+    # Not built, see configure's --enable-io-uring
+    uring = None
+
 
 class BaseIOEventHandler(object):
 
+    # Allows subclasses to do without an instance __dict__
+    __slots__ = ()
+
     def close(self):
         self.sock.close()
         self.sock = None
@@ -34,12 +46,46 @@ class IOLoop(object):
 
     DEFAULT_TIMEOUT = 0.5
 
-    def __init__(self, logger = None):
-        self.poller = Poller()
+    BACKENDS = ('epoll', 'io_uring')
+
+    def __init__(self, logger = None, backend = None):
+        self.logger = logger or logging.getLogger('looping')
+        self.backend, self.poller = self.create_poller(backend)
+        # Whether handlers may use submit_send()
+        self.batched_sends = self.backend == 'io_uring' and self.poller.batched_sends
         self.handlers = {}
         self.injected_events = {}
-        self.logger = logger or logging.getLogger('looping')
         self._now = time.time()
+        # Time spent handling events during the last iteration, and
+        # in total since startup
+        self.lag = 0
+        self.busy_time = 0
+        # Optional instrumentation, see enable_statistics()
+        self.statistics = None
+        # Time budget, in seconds, for the handlers only waiting to
+        # write, see set_write_budget()
+        self.write_budget = None
+        # File descriptors left out by the last iteration's budget
+        self.deferred_writes = []
+        self.deferred_writes_total = 0
+
+    def create_poller(self, backend):
+        """
+        Return the name of the backend actually used, and its poller:
+        we fall back to epoll if io_uring is not available.
+        """
+        if backend == 'io_uring':
+            if uring is None:
+                self.logger.warning('savate was built without io_uring support, '
+                                    'falling back to epoll')
+            else:
+                try:
+                    return backend, uring.Poller()
+                except IOError as exc:
+                    self.logger.warning('Cannot use io_uring (%s), falling back to epoll', exc)
+        elif backend not in (None, 'epoll'):
+            raise ValueError('Unknown loop backend %r' % backend)
+        return ('poll' if Poller == select.poll else 'epoll'), Poller()
 
     def register(self, io_event_handler, eventmask):
         if io_event_handler.fileno() not in self.handlers:
@@ -48,6 +94,24 @@ class IOLoop(object):
             self.poller.modify(io_event_handler.fileno(), eventmask)
         self.handlers[io_event_handler.fileno()] = io_event_handler
 
+    def submit_send(self, io_event_handler, data):
+        """
+        Send data on the handler's socket, along with the sends of the
+        other handlers, by the next poll. Its send_done() method is
+        then called with the number of bytes sent, or minus the error
+        number. Only available when batched_sends is set.
+        """
+        self.poller.send(io_event_handler.fileno(), data, io_event_handler)
+
+    def handle_send_done(self, handler, result):
+        try:
+            handler.send_done(result)
+        except Exception:
+            self.logger.exception('Exception when handling send result %s for %s:',
+                                  result, handler)
+            self.unregister(handler)
+            handler.close()
+
     def inject_event(self, fd, eventmask):
         self.injected_events[fd] = self.injected_events.get(fd, 0) | eventmask
 
@@ -75,10 +139,47 @@ class IOLoop(object):
     def now(self):
         return self._now
 
+    def enable_statistics(self, slow_callback_threshold):
+        """
+        Start timing loop iterations and event handlers. Handlers
+        taking more than slow_callback_threshold seconds are logged.
+        """
+        if self.statistics is None:
+            self.statistics = metrics.LoopStatistics(slow_callback_threshold)
+        else:
+            self.statistics.slow_callback_threshold = slow_callback_threshold
+
+    def disable_statistics(self):
+        self.statistics = None
+
+    def set_write_budget(self, write_budget):
+        """
+        Service the handlers only waiting to write (POLLOUT) after
+        the others (e.g. sources and the listening socket), for at
+        most write_budget seconds per iteration. The ones left out
+        go first on the next iteration, so that every handler gets
+        its turn. None disables the budget.
+        """
+        self.write_budget = write_budget
+        if write_budget is None:
+            self.deferred_writes = []
+
+    def profile_event(self, handler, eventmask):
+        start = time.time()
+        try:
+            handler.handle_event(eventmask)
+        finally:
+            duration = time.time() - start
+            self.statistics.handler_called(handler.__class__.__name__, duration)
+            if duration > self.statistics.slow_callback_threshold:
+                self.statistics.slow_callbacks += 1
+                self.logger.warning('Slow handler %s: %.3f seconds for eventmask %s',
+                                    handler, duration, eventmask)
+
     def once(self, timeout = 0):
         while True:
             try:
-                if Poller == select.poll:
+                if self.backend == 'poll':
                     events_list = self.poller.poll(timeout * 1000)
                 else:
                     # We specify maxevents here, since the default -1
@@ -95,21 +196,67 @@ class IOLoop(object):
         # Update our idea of the current time
         self._now = time.time()
 
-        for fd, eventmask in self._merge_eventlists(dict(events_list)).items():
-            try:
-                handler = self.handlers[fd]
-            except KeyError as exc:
-                # There's a bug somewhere. Could be epoll, could be us.
-                self.logger.error('fd %d returned by epoll() is not in self.handlers !', fd)
-                try:
-                    self.poller.unregister(fd)
-                except:
-                    pass
-                continue
+        if self.batched_sends:
+            for handler, result in self.poller.send_completions():
+                self.handle_send_done(handler, result)
+
+        events = self._merge_eventlists(dict(events_list))
+        if self.write_budget is None:
+            for fd, eventmask in events.items():
+                self.handle_fd_event(fd, eventmask)
+        else:
+            self.handle_events_fairly(events)
+
+        self.lag = time.time() - self._now
+        self.busy_time += self.lag
+        if self.statistics is not None:
+            self.statistics.iteration_done(self.lag, len(events))
+
+    def handle_fd_event(self, fd, eventmask):
+        try:
+            handler = self.handlers[fd]
+        except KeyError:
+            # There's a bug somewhere. Could be epoll, could be us.
+            self.logger.error('fd %d returned by epoll() is not in self.handlers !', fd)
             try:
+                self.poller.unregister(fd)
+            except:
+                pass
+            return
+        try:
+            if self.statistics is None:
                 handler.handle_event(eventmask)
-            except Exception as exc:
-                # We're kinda hardcore
-                self.logger.exception('Exception when handling eventmask %s for fd %s:', eventmask, fd)
-                self.unregister(handler)
-                handler.close()
+            else:
+                self.profile_event(handler, eventmask)
+        except Exception:
+            # We're kinda hardcore
+            self.logger.exception('Exception when handling eventmask %s for fd %s:', eventmask, fd)
+            self.unregister(handler)
+            handler.close()
+
+    def handle_events_fairly(self, events):
+        writes = []
+        for fd, eventmask in events.items():
+            if eventmask == POLLOUT:
+                writes.append(fd)
+            else:
+                self.handle_fd_event(fd, eventmask)
+
+        # Round-robin: the handlers deferred by the last iteration are
+        # still writable, since epoll is level-triggered, and go first
+        if self.deferred_writes:
+            ready = set(writes)
+            deferred = [fd for fd in self.deferred_writes if fd in ready]
+            deferred_set = set(deferred)
+            writes = deferred + [fd for fd in writes if fd not in deferred_set]
+
+        deadline = time.time() + self.write_budget
+        for index, fd in enumerate(writes):
+            if index and time.time() >= deadline:
+                self.deferred_writes = writes[index:]
+                self.deferred_writes_total += len(self.deferred_writes)
+                break
+            if fd in self.handlers:
+                self.handle_fd_event(fd, POLLOUT)
+        else:
+            self.deferred_writes = []
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+cdef extern from 'sys/mman.h':
+
+        # Exported as a Python constant in the .pyx file
+        int c_MFD_CLOEXEC "MFD_CLOEXEC"
+
+        int _memfd_create "memfd_create"(char *name, unsigned int flags) nogil
+
+cdef extern from 'sys/sendfile.h':
+
+        ctypedef long off_t
+
+        ssize_t _sendfile "sendfile"(int out_fd, int in_fd, off_t *offset, size_t count) nogil
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+memfd_create() (Linux >= 3.17, glibc >= 2.27) and sendfile(), which
+Python 2's os module lacks, for the memfd output backend.
+"""
+
+cdef extern from 'errno.h':
+
+        cdef int errno
+
+import os
+
+from memfd cimport *
+
+
+MFD_CLOEXEC = c_MFD_CLOEXEC
+
+
+def memfd_create(name, unsigned int flags = 0):
+    """
+    Interface to memfd_create(2), return the new file descriptor.
+    """
+    cdef char *c_name = name
+    cdef int fd
+    with nogil:
+        fd = _memfd_create(c_name, flags)
+    if fd == -1:
+        raise IOError(errno, os.strerror(errno))
+    return fd
+
+
+def sendfile(int out_fd, int in_fd, off_t offset, size_t count):
+    """
+    Interface to sendfile(2), send count bytes from in_fd at offset
+    to out_fd. Return the number of bytes sent.
+    """
+    cdef ssize_t ret
+    with nogil:
+        ret = _sendfile(out_fd, in_fd, &offset, count)
+    if ret == -1:
+        raise IOError(errno, os.strerror(errno))
+    return ret
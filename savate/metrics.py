@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+
+class RateCounter(object):
+    """
+    Counts values over a rolling window, using one bucket per second.
+    Adding a value and computing a rate are both cheap, and memory
+    usage is fixed.
+    """
+
+    def __init__(self, size):
+        # One extra bucket for the current, incomplete, second
+        self.buckets = [0] * (size + 1)
+        self.current = None
+
+    def _advance(self, second):
+        if self.current is not None and second <= self.current:
+            # Same second, or the clock went backwards
+            return
+        if self.current is None or second - self.current >= len(self.buckets):
+            self.buckets = [0] * len(self.buckets)
+        else:
+            for tmp_second in xrange(self.current + 1, second + 1):
+                self.buckets[tmp_second % len(self.buckets)] = 0
+        self.current = second
+
+    def add(self, value, now):
+        self._advance(int(now))
+        self.buckets[self.current % len(self.buckets)] += value
+
+    def rate(self, window, now):
+        """
+        Return the average value per second over the last `window`
+        complete seconds.
+        """
+        if self.current is None:
+            return 0
+        self._advance(int(now))
+        return sum(self.buckets[(self.current - i) % len(self.buckets)]
+                   for i in xrange(1, window + 1)) / float(window)
+
+
+class IngestStatistics(object):
+    """
+    Rolling counters describing the health of a source's input.
+    """
+
+    # Windows, in seconds, over which the ingest bitrate is computed
+    BITRATE_WINDOWS = (1, 10, 60)
+
+    # Any gap in the input longer than this, in seconds, is counted
+    # as a stall
+    STALL_THRESHOLD = 1
+
+    def __init__(self, now):
+        self.bytes_in = 0
+        self.packets_in = 0
+        self.bytes_rate = RateCounter(max(self.BITRATE_WINDOWS))
+        self.last_input_time = now
+        self.stalls = 0
+        self.last_stall_time = None
+        self.last_stall_duration = 0
+
+    def data_in(self, bytes_count, now, packets_count = 1):
+        gap = now - self.last_input_time
+        if gap > self.STALL_THRESHOLD:
+            self.stalls += 1
+            self.last_stall_time = self.last_input_time
+            self.last_stall_duration = gap
+        self.last_input_time = now
+        self.bytes_in += bytes_count
+        self.packets_in += packets_count
+        self.bytes_rate.add(bytes_count, now)
+
+    def bitrate(self, window, now):
+        """Return the ingest bitrate over `window` seconds, in bits/s."""
+        return int(self.bytes_rate.rate(window, now) * 8)
+
+    def as_dict(self, now):
+        status_dict = {
+            'bytes_in': self.bytes_in,
+            'packets_in': self.packets_in,
+            'stalls': self.stalls,
+            'last_stall_time': self.last_stall_time,
+            'last_stall_duration': self.last_stall_duration,
+            'last_input_time': self.last_input_time,
+            }
+        for window in self.BITRATE_WINDOWS:
+            status_dict['bitrate_%ds' % window] = self.bitrate(window, now)
+        return status_dict
+
+
+class MountMetrics(object):
+    """
+    Counters and gauges for a mount point, maintained incrementally
+    as clients connect, disconnect and get data published and
+    flushed, so that reading them never requires walking the clients.
+    """
+
+    # Upper bounds of the client queue size histogram buckets, in bytes
+    QUEUE_SIZE_BUCKETS = (0, 4 * 2**10, 16 * 2**10, 64 * 2**10, 256 * 2**10,
+                          2**20, 4 * 2**20, 16 * 2**20, float('inf'))
+
+    def __init__(self):
+        self.listeners = 0
+        self.bytes_out = 0
+        self.bytes_published = 0
+        self.packets_published = 0
+        self.queued_bytes = 0
+        # Number of clients per queue size bucket (not cumulative)
+        self.queue_size_clients = [0] * len(self.QUEUE_SIZE_BUCKETS)
+        # Reason -> number of dropped clients
+        self.drops = {}
+        # Reason -> number of refused clients
+        self.rejections = {}
+        # Number of times a lagging client was resynced
+        self.resyncs = 0
+        # Last known ingest bitrate, in bits/s, kept across source
+        # restarts
+        self.last_bitrate = 0
+
+    def queue_size_changed(self, old_bucket, old_size, new_size):
+        """
+        Account for a client queue size change, returning the
+        client's new histogram bucket.
+        """
+        self.queued_bytes += new_size - old_size
+        new_bucket = bisect.bisect_left(self.QUEUE_SIZE_BUCKETS, new_size)
+        if new_bucket != old_bucket:
+            if old_bucket is not None:
+                self.queue_size_clients[old_bucket] -= 1
+            self.queue_size_clients[new_bucket] += 1
+        return new_bucket
+
+    def client_connected(self, queue_size):
+        self.listeners += 1
+        return self.queue_size_changed(None, 0, queue_size)
+
+    def client_disconnected(self, bucket, queue_size):
+        self.listeners -= 1
+        self.queued_bytes -= queue_size
+        if bucket is not None:
+            self.queue_size_clients[bucket] -= 1
+
+    def client_dropped(self, reason):
+        self.drops[reason] = self.drops.get(reason, 0) + 1
+
+    def client_rejected(self, reason):
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+
+    def client_resynced(self):
+        self.resyncs += 1
+
+    def packet_published(self, packet_size):
+        self.bytes_published += packet_size
+        self.packets_published += 1
+
+    def queue_size_histogram(self):
+        """Return the clients queue sizes as a Histogram."""
+        histogram = Histogram(self.QUEUE_SIZE_BUCKETS)
+        histogram.counts = list(self.queue_size_clients)
+        histogram.count = sum(self.queue_size_clients)
+        histogram.sum = self.queued_bytes
+        return histogram
+
+
+class Histogram(object):
+    """A fixed buckets histogram, with a count and sum of observations."""
+
+    def __init__(self, buckets):
+        # Buckets upper bounds, the last one should be float('inf')
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return a list of (upper bound, cumulative count)."""
+        histogram = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            histogram.append((bound, total))
+        return histogram
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            # JSON has no infinity, hence the string bounds
+            'buckets': [('%g' % bound, count) for bound, count in self.cumulative()],
+            }
+
+
+class LoopStatistics(object):
+    """
+    Event loop instrumentation: iteration durations, events per
+    iteration and time spent in each handler class.
+    """
+
+    DURATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                        1, float('inf'))
+    EVENTS_BUCKETS = (0, 1, 10, 100, 1000, 10000, float('inf'))
+
+    def __init__(self, slow_callback_threshold):
+        self.slow_callback_threshold = slow_callback_threshold
+        self.iteration_time = Histogram(self.DURATION_BUCKETS)
+        self.events_per_iteration = Histogram(self.EVENTS_BUCKETS)
+        # Handler class name -> Histogram
+        self.handlers_time = {}
+        self.slow_callbacks = 0
+
+    def handler_called(self, handler_class, duration):
+        try:
+            histogram = self.handlers_time[handler_class]
+        except KeyError:
+            histogram = self.handlers_time[handler_class] = Histogram(self.DURATION_BUCKETS)
+        histogram.observe(duration)
+
+    def iteration_done(self, duration, events_count):
+        self.iteration_time.observe(duration)
+        self.events_per_iteration.observe(events_count)
+
+    def as_dict(self):
+        return {
+            'slow_callback_threshold': self.slow_callback_threshold,
+            'slow_callbacks': self.slow_callbacks,
+            'iteration_time': self.iteration_time.as_dict(),
+            'events_per_iteration': self.events_per_iteration.as_dict(),
+            'handlers_time': dict((handler_class, histogram.as_dict())
+                                  for handler_class, histogram in self.handlers_time.items()),
+            }
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+import time
+import urlparse
+
+from savate import limits
+from savate import looping
+
+# Note that sendmmsg() requires Linux >= 3.0 and glibc >= 2.14
+try:
+    from savate.sendmmsg import sendmmsg
+except ImportError:
+    # Not built, see configure's --enable-sendmmsg
+    sendmmsg = None
+
+
+class UDPOutput(looping.BaseIOEventHandler):
+    """
+    Re-emits a mount as UDP datagrams, unicast or multicast depending
+    on the address of its udp:// URL, e.g. to feed a headend. It is
+    fed with the packets of one of the mount's sources, like a
+    streaming client, but is not counted as one.
+
+    Data is sent in datagrams of DATAGRAM_SIZE bytes (seven MPEG-TS
+    packets), batched with sendmmsg() when available. When pacing is
+    set, datagrams are sent at most at that multiple of the source's
+    ingest bitrate, instead of in bursts as they are published.
+    """
+
+    SCHEMES = ('udp',)
+
+    DATAGRAM_SIZE = 7 * 188
+
+    # Unsent data beyond this is dropped, oldest first
+    MAX_QUEUE_SIZE = 4 * 2**20
+
+    # Depth of the pacing token bucket, in seconds of sending
+    PACING_BURST_DURATION = 0.01
+
+    # Shortest wait for pacing tokens, below timer precision anyway
+    PACING_MIN_DELAY = 0.001
+
+    def __init__(self, server, url, path, pacing = None):
+        self.server = server
+        self.url = url
+        self.path = path
+        self.pacing_factor = pacing
+        self.pacing = None
+        # The source we're fed by, see Server.publish_packet()
+        self.source = None
+        # Unsent data, starting on a datagram boundary
+        self.data = bytearray()
+        self.bytes_sent = 0
+        self.datagrams_sent = 0
+        self.dropped_bytes = 0
+        # Whether we're waiting for POLLOUT or for pacing tokens
+        self.waiting = False
+
+        parsed_url = urlparse.urlparse(url)
+        if parsed_url.scheme not in self.SCHEMES or not parsed_url.port:
+            raise ValueError('Invalid UDP output URL %r' % url)
+        self.address = (parsed_url.hostname, parsed_url.port)
+        query = urlparse.parse_qs(parsed_url.query)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        if 'ttl' in query:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                                 int(query['ttl'][0]))
+        # So that neither sendmmsg() nor send() need the address
+        self.sock.connect(self.address)
+
+    def __str__(self):
+        return '<%s %s for %s>' % (self.__class__.__name__, self.url, self.path)
+
+    @property
+    def closed(self):
+        return self.sock is None
+
+    def add_packet(self, packet):
+        self.data += packet
+        if len(self.data) > self.MAX_QUEUE_SIZE:
+            excess = len(self.data) - self.MAX_QUEUE_SIZE
+            # Keep the datagrams (and MPEG-TS packets) boundaries
+            excess += -excess % self.DATAGRAM_SIZE
+            del self.data[:excess]
+            self.dropped_bytes += excess
+        if not self.waiting:
+            self.flush()
+
+    def update_pacing(self, now):
+        if self.pacing_factor is None or self.source is None:
+            return
+        ingest = self.source.ingest
+        bitrate = max(ingest.bitrate(1, now), ingest.bitrate(10, now))
+        if not bitrate:
+            # We cannot tell our stream's rate yet
+            return
+        rate = self.pacing_factor * bitrate / 8
+        burst = max(rate * self.PACING_BURST_DURATION, self.DATAGRAM_SIZE)
+        if self.pacing is None:
+            self.pacing = limits.TokenBucket(rate, burst, now)
+        else:
+            self.pacing.rate = rate
+            self.pacing.burst = burst
+
+    def flush(self):
+        if self.closed:
+            return
+        # Datagrams are paced at a finer grain than loop iterations
+        now = time.time()
+        self.update_pacing(now)
+        # Only whole datagrams, the rest waits for more data
+        count = len(self.data) - len(self.data) % self.DATAGRAM_SIZE
+        if self.pacing is not None:
+            allowed = self.pacing.available(now)
+            count = min(count, allowed - allowed % self.DATAGRAM_SIZE)
+        sent_bytes = 0
+        if count:
+            try:
+                sent_bytes = self.send(count)
+            except (IOError, socket.error) as exc:
+                if exc.args[0] not in (errno.EAGAIN, errno.ECONNREFUSED):
+                    raise
+                if exc.args[0] == errno.EAGAIN:
+                    self.waiting = True
+                    self.server.loop.register(self, looping.POLLOUT)
+                    return
+                # Nobody listening on a unicast destination, the
+                # datagrams are lost anyway
+                sent_bytes = count
+        del self.data[:sent_bytes]
+        self.bytes_sent += sent_bytes
+        self.datagrams_sent += sent_bytes // self.DATAGRAM_SIZE
+        if self.pacing is not None:
+            self.pacing.consume(sent_bytes)
+        if sent_bytes < count:
+            # The socket buffer is full
+            self.waiting = True
+            self.server.loop.register(self, looping.POLLOUT)
+        elif len(self.data) >= self.DATAGRAM_SIZE and self.pacing is not None:
+            self.waiting = True
+            self.server.loop.unregister(self)
+            # Timeouts run on the same wall clock as now, which is past
+            # the expiration of the timeout calling us if any: never
+            # re-arm it at that expiration, its callbacks would loop
+            delay = max(self.pacing.delay(self.DATAGRAM_SIZE), self.PACING_MIN_DELAY)
+            self.server.timeouts.reset_timeout(self, now + delay, self.resume)
+        else:
+            self.waiting = False
+            self.server.loop.unregister(self)
+
+    def send(self, count):
+        """Send count bytes of our data, return the number of bytes sent."""
+        data = memoryview(self.data)[:count]
+        sent_bytes = 0
+        try:
+            while sent_bytes < count:
+                try:
+                    if sendmmsg is not None:
+                        # Up to sendmmsg.MAX_DATAGRAMS at once
+                        sent = sendmmsg(self.sock.fileno(), data[sent_bytes:],
+                                        self.DATAGRAM_SIZE)
+                    else:
+                        sent = self.sock.send(data[sent_bytes:sent_bytes + self.DATAGRAM_SIZE])
+                except (IOError, socket.error) as exc:
+                    if exc.args[0] == errno.EAGAIN and sent_bytes:
+                        break
+                    raise
+                if not sent:
+                    break
+                sent_bytes += sent
+        finally:
+            # Even if an exception keeps our frame alive, self.data
+            # must not be exported anymore to be resized
+            del data
+        return sent_bytes
+
+    def resume(self):
+        self.waiting = False
+        self.flush()
+
+    def handle_event(self, eventmask):
+        if eventmask & looping.POLLERR:
+            # E.g. an ICMP port unreachable from a unicast destination,
+            # reading it clears it
+            self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.waiting = False
+        self.flush()
+
+    def status(self):
+        return {
+            'url': self.url,
+            'bytes_sent': self.bytes_sent,
+            'datagrams_sent': self.datagrams_sent,
+            'dropped_bytes': self.dropped_bytes,
+            'queue_size': len(self.data),
+            }
+
+    def close(self):
+        if self.closed:
+            return
+        self.server.timeouts.remove_timeout(self)
+        self.server.loop.unregister(self)
+        looping.BaseIOEventHandler.close(self)
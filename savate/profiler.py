@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import os
+import signal
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler, sampling the main thread's stack every
+    `interval` seconds of CPU time, using ITIMER_PROF and SIGPROF.
+
+    The samples are aggregated as collapsed stacks, as expected by
+    flamegraph.pl and compatible tools.
+    """
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        # Collapsed stack -> samples count
+        self.samples = collections.defaultdict(int)
+        self.previous_handler = None
+        self.running = False
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        # Restart interrupted system calls instead of failing with
+        # EINTR, so that sampling does not disturb our I/O
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+        self.running = False
+
+    def sample(self, _signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % (stack, count) for stack, count
+                       in sorted(self.samples.items()))
@@ -11,8 +11,9 @@ from savate import looping
 from savate import sources
 from savate import helpers
 from savate.helpers import HTTPError, HTTPParseError
-from savate.sources import MPEGTSSource
+from savate.sources import MPEGTSSource, RTPMPEGTSSource
 from savate import buffer_event
+from savate import rtp
 
 
 class Relay(looping.BaseIOEventHandler):
@@ -56,7 +57,7 @@ class UDPRelay(Relay):
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(self.udp_address)
         self.sock.setblocking(0)
-        if self.parsed_url.scheme == 'multicast':
+        if self.is_multicast():
             multicast_request = struct.pack('=4sl', socket.inet_aton(self.parsed_url.hostname), socket.INADDR_ANY)
             self.sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
             # The socket is now multicast ready
@@ -64,6 +65,9 @@ class UDPRelay(Relay):
         self.server.loop.register(self, looping.POLLIN)
         self.server.update_activity(self)
 
+    def is_multicast(self):
+        return self.parsed_url.scheme == 'multicast'
+
     def handle_event(self, eventmask):
         if eventmask & looping.POLLIN:
             # FIXME: this is basically a c/c from server.py's
@@ -75,7 +79,7 @@ class UDPRelay(Relay):
                     # EAGAIN, we'll come back later
                     break
                 else:
-                    self.initial_buffer_data = self.initial_buffer_data + tmp_buffer
+                    self.handle_datagram(tmp_buffer)
                 if len(self.initial_buffer_data) >= self.MIN_START_BUFFER:
                     # OK, this looks like a valid source (since there
                     # is some socket activity)
@@ -83,10 +87,50 @@ class UDPRelay(Relay):
                     fake_response_parser.body = self.initial_buffer_data
                     # FIXME: we're assuming an MPEG-TS source
                     fake_response_parser.headers['Content-Type'] = 'video/MP2T'
-                    self.server.add_source(self.path, self.sock, self.udp_address,
-                                           fake_response_parser, self.burst_size)
+                    self.start_source(fake_response_parser)
                     break
 
+    def handle_datagram(self, datagram):
+        self.initial_buffer_data = self.initial_buffer_data + datagram
+
+    def start_source(self, fake_response_parser):
+        self.server.add_source(self.path, self.sock, self.udp_address,
+                               fake_response_parser, self.burst_size)
+
+
+class RTPRelay(UDPRelay):
+    """
+    MPEG-TS over RTP input, possibly multicast. RTP headers are
+    stripped and packets reordered before being handed to the source.
+    """
+
+    def __init__(self, server, url, path, addr_info = None, burst_size = None):
+        self.rtp_buffer = rtp.RTPReorderBuffer(RTPMPEGTSSource.RTP_JITTER_WINDOW)
+        UDPRelay.__init__(self, server, url, path, addr_info, burst_size)
+
+    def is_multicast(self):
+        # Multicast is implied by the group address for rtp:// URLs
+        try:
+            first_octet = ord(socket.inet_aton(self.parsed_url.hostname)[0])
+        except socket.error:
+            return False
+        return 224 <= first_octet <= 239
+
+    def handle_datagram(self, datagram):
+        try:
+            sequence, payload = rtp.parse_rtp_packet(datagram)
+        except rtp.RTPError:
+            self.rtp_buffer.invalid += 1
+            return
+        for payload in self.rtp_buffer.push(sequence, payload):
+            self.initial_buffer_data = self.initial_buffer_data + payload
+
+    def start_source(self, fake_response_parser):
+        self.server.register_source(RTPMPEGTSSource(
+            self.server, self.sock, self.udp_address,
+            fake_response_parser.headers['Content-Type'], fake_response_parser,
+            self.path, self.burst_size, rtp_buffer = self.rtp_buffer))
+
 
 class HTTPRelay(Relay):
 
@@ -184,8 +228,9 @@ class HTTPRelay(Relay):
             # FIXME: this is basically a c/c from server.py's
             # HTTPRequest's handle_read
             while True:
-                tmp_buffer = helpers.handle_eagain(self.sock.recv,
-                                                   self.RESPONSE_MAX_SIZE - self.response_size)
+                previous_size = self.response_size
+                tmp_buffer = helpers.recv_http_headers(self.sock, self.response_buffer,
+                                                       self.RESPONSE_MAX_SIZE)
                 if tmp_buffer == None:
                     # EAGAIN, we'll come back later
                     break
@@ -193,8 +238,13 @@ class HTTPRelay(Relay):
                     raise HTTPError('Unexpected end of stream from %s, %s' %
                                     (self.url,
                                     (self.sock, self.address)))
-                self.response_buffer = self.response_buffer + tmp_buffer
-                self.response_size += len(tmp_buffer)
+                self.response_buffer = tmp_buffer
+                self.response_size = len(tmp_buffer)
+                if not helpers.http_headers_complete(self.response_buffer, previous_size):
+                    if self.response_size >= self.RESPONSE_MAX_SIZE:
+                        raise HTTPParseError('Oversized HTTP response from %s, %s' %
+                                             (self.sock, self.address))
+                    continue
                 self.response_parser.execute(self.response_buffer)
                 if self.response_parser.has_error():
                     raise HTTPParseError('Invalid HTTP response from %s, %s' %
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+
+SLASHES_REGEXP = re.compile(b'//+')
+
+# Mount paths ending with this match every path below them
+WILDCARD_SUFFIX = b'/*'
+
+
+def normalize_path(path):
+    """Squash any consecutive / into one."""
+    if b'//' in path:
+        return SLASHES_REGEXP.sub(b'/', path)
+    return path
+
+
+class Route(object):
+    """
+    Everything the server needs to know to serve requests for a path:
+    its mount configuration (None outside of any configured mount),
+    its status handler if any, and the authorization handlers which
+    may have a say about it, along with their settings for this route.
+    """
+
+    __slots__ = (
+        'path',
+        'mount_config',
+        'status_handler',
+        'auth_chain',
+    )
+
+    def __init__(self, path, mount_config, status_handler, auth_handlers):
+        self.path = path
+        self.mount_config = mount_config
+        self.status_handler = status_handler
+        chain = []
+        for auth_handler in auth_handlers:
+            settings = auth_handler.route_settings(mount_config)
+            if settings is not None:
+                chain.append((auth_handler, settings))
+        self.auth_chain = tuple(chain)
+
+    def __repr__(self):
+        return '<%s for %s>' % (self.__class__.__name__, self.path)
+
+
+class RouteTable(object):
+    """
+    Maps a normalized request path to its :class:`Route`, using
+    first the exact paths (mounts and status handlers), then the
+    wildcard mounts, the longest matching one winning.
+
+    Routes are computed once, when the configuration is (re)loaded.
+    """
+
+    def __init__(self, mounts = (), status_handlers = None, auth_handlers = ()):
+        status_handlers = status_handlers or {}
+        self.routes = {}
+        self.prefix_routes = {}
+        self.default_route = Route(None, None, None, auth_handlers)
+
+        for mount_config in mounts:
+            path = normalize_path(mount_config['path'])
+            if path.endswith(WILDCARD_SUFFIX):
+                # Keep the trailing / in the prefix
+                prefix = path[:-1]
+                self.prefix_routes[prefix] = Route(path, mount_config, None,
+                                                   auth_handlers)
+            else:
+                self.routes[path] = Route(path, mount_config,
+                                          status_handlers.get(path),
+                                          auth_handlers)
+
+        for path, status_handler in status_handlers.items():
+            path = normalize_path(path)
+            if path not in self.routes:
+                self.routes[path] = Route(path, None, status_handler,
+                                          auth_handlers)
+
+    def find(self, path):
+        try:
+            return self.routes[path]
+        except KeyError:
+            pass
+
+        if self.prefix_routes:
+            index = len(path)
+            while index > 0:
+                index = path.rfind(b'/', 0, index)
+                if index < 0:
+                    break
+                route = self.prefix_routes.get(path[:index + 1])
+                if route is not None:
+                    return route
+
+        return self.default_route
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+
+class RTPError(Exception):
+    pass
+
+
+# RTP fixed header (RFC 3550, section 5.1): V/P/X/CC, M/PT, sequence
+# number, timestamp, SSRC
+RTP_HEADER = struct.Struct('>BBHII')
+RTP_EXTENSION_HEADER = struct.Struct('>HH')
+RTP_PADDING_COUNT = struct.Struct('>B')
+
+RTP_VERSION = 2
+
+SEQUENCE_MODULO = 2 ** 16
+
+
+def parse_rtp_packet(datagram):
+    """
+    Parse an RTP datagram, returning a (sequence number, payload)
+    tuple. CSRC identifiers, header extensions and padding are
+    stripped from the payload.
+    """
+    datagram_length = len(datagram)
+    if datagram_length < RTP_HEADER.size:
+        raise RTPError('Datagram too short for an RTP header: %d bytes' %
+                       datagram_length)
+
+    flags, _payload_type, sequence, _timestamp, _ssrc = RTP_HEADER.unpack_from(datagram)
+    if (flags >> 6) != RTP_VERSION:
+        raise RTPError('Invalid RTP version %d' % (flags >> 6))
+
+    offset = RTP_HEADER.size + 4 * (flags & 0x0f)
+    if flags & 0x10:
+        # Header extension present
+        if datagram_length < offset + RTP_EXTENSION_HEADER.size:
+            raise RTPError('Truncated RTP header extension')
+        _profile, extension_length = RTP_EXTENSION_HEADER.unpack_from(datagram, offset)
+        offset += RTP_EXTENSION_HEADER.size + 4 * extension_length
+
+    end = datagram_length
+    if flags & 0x20:
+        # Padding present, its size is stored in the last octet
+        end -= RTP_PADDING_COUNT.unpack_from(datagram, datagram_length - 1)[0]
+
+    if offset > end:
+        raise RTPError('Invalid RTP header length %d for a %d bytes datagram' %
+                       (offset, datagram_length))
+
+    return sequence, datagram[offset:end]
+
+
+class RTPReorderBuffer(object):
+    """
+    Puts RTP payloads back in sequence number order.
+
+    Out of order packets are held for at most `window` packets; once
+    the window is exceeded, missing packets are considered lost and
+    skipped. Loss, reordering, duplicates and late packets are
+    counted. As suggested by RFC 3550, appendix A.1, very large
+    sequence jumps are treated as a sender restart rather than as
+    loss.
+    """
+
+    # Largest forward sequence jump still considered as packet loss
+    MAX_DROPOUT = 3000
+
+    def __init__(self, window = 32):
+        self.window = window
+        self.expected = None
+        self.pending = {}
+        # Statistics
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.late = 0
+        self.invalid = 0
+        self.resyncs = 0
+        self.consecutive_late = 0
+
+    def reset(self):
+        self.expected = None
+        self.pending.clear()
+        self.consecutive_late = 0
+
+    def push(self, sequence, payload):
+        """
+        Add a payload to the buffer, returning the list of payloads
+        that are now ready to be published, in order.
+        """
+        self.received += 1
+
+        if self.expected is None:
+            self.expected = sequence
+
+        delta = (sequence - self.expected) % SEQUENCE_MODULO
+
+        if delta >= SEQUENCE_MODULO / 2:
+            # Behind the expected sequence number: either a duplicate
+            # or a packet that arrived after we gave up waiting for it
+            self.late += 1
+            self.consecutive_late += 1
+            if self.consecutive_late > self.window:
+                # The sender probably restarted with a new sequence
+                # number base, follow it
+                self.resyncs += 1
+                self.reset()
+                return self.push(sequence, payload)
+            return []
+
+        self.consecutive_late = 0
+
+        if delta > self.MAX_DROPOUT:
+            # Sender restart, flush whatever we were waiting for
+            self.resyncs += 1
+            ready = [self.pending[seq] for seq in sorted(
+                self.pending, key = lambda seq: (seq - self.expected) % SEQUENCE_MODULO)]
+            self.reset()
+            self.expected = sequence
+            delta = 0
+        else:
+            ready = []
+
+        if delta == 0:
+            if self.pending:
+                # Later packets were received before this one
+                self.reordered += 1
+            ready.append(payload)
+            self.expected = (sequence + 1) % SEQUENCE_MODULO
+            self._drain(ready)
+        elif sequence in self.pending:
+            self.duplicates += 1
+        else:
+            self.pending[sequence] = payload
+            if len(self.pending) > self.window or delta > self.window:
+                self._skip(ready)
+
+        return ready
+
+    def _drain(self, ready):
+        while self.expected in self.pending:
+            ready.append(self.pending.pop(self.expected))
+            self.expected = (self.expected + 1) % SEQUENCE_MODULO
+
+    def _skip(self, ready):
+        # Give up waiting for the missing packets, jump to the next
+        # packet we have until we're back within the jitter window
+        while self.pending and (
+            len(self.pending) > self.window or
+            max((seq - self.expected) % SEQUENCE_MODULO for seq in self.pending) > self.window):
+            next_sequence = min(self.pending, key = lambda seq: (seq - self.expected) % SEQUENCE_MODULO)
+            self.lost += (next_sequence - self.expected) % SEQUENCE_MODULO
+            self.expected = next_sequence
+            self._drain(ready)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+cdef extern from 'sys/uio.h':
+
+        struct iovec:
+                void *iov_base
+                size_t iov_len
+
+cdef extern from 'sys/socket.h':
+
+        ctypedef long socklen_t
+
+        struct msghdr:
+                void *msg_name
+                socklen_t msg_namelen
+                iovec *msg_iov
+                size_t msg_iovlen
+                void *msg_control
+                size_t msg_controllen
+                int msg_flags
+
+        struct mmsghdr:
+                msghdr msg_hdr
+                unsigned int msg_len
+
+        int _sendmmsg "sendmmsg"(int fd, mmsghdr *vmessages, unsigned int vlen, int flags) nogil
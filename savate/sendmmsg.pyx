@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+from libc.string cimport memset
+
+cdef extern from 'errno.h':
+
+        cdef int errno
+
+import os
+
+from sendmmsg cimport _sendmmsg
+
+
+# The kernel sends at most UIO_MAXIOV messages per call
+MAX_DATAGRAMS = 1024
+
+
+def sendmmsg(int fd, object data, size_t datagram_size, int flags = 0):
+    """
+    Send data on the connected socket fd as datagrams of
+    datagram_size bytes (the last one may be shorter), in a single
+    system call. Return the number of bytes sent, which only covers
+    whole datagrams.
+    """
+    cdef iovec *iovectors = NULL
+    cdef mmsghdr *messages_vectors = NULL
+    cdef Py_buffer py_buffer
+    cdef size_t datagram_number
+    cdef size_t offset
+    cdef size_t sent_bytes
+    cdef int sent_messages
+    cdef char *buf
+
+    if datagram_size == 0:
+        raise ValueError('datagram_size must be positive')
+
+    PyObject_GetBuffer(data, &py_buffer, PyBUF_SIMPLE)
+    try:
+        datagram_number = min((py_buffer.len + datagram_size - 1) / datagram_size,
+                              MAX_DATAGRAMS)
+        if datagram_number == 0:
+            return 0
+
+        iovectors = <iovec *> PyMem_Malloc(datagram_number * sizeof(iovec))
+        messages_vectors = <mmsghdr *> PyMem_Malloc(datagram_number * sizeof(mmsghdr))
+
+        if not iovectors or not messages_vectors:
+            raise MemoryError
+
+        memset(messages_vectors, 0, datagram_number * sizeof(mmsghdr))
+
+        buf = <char *> py_buffer.buf
+        for i in range(datagram_number):
+            offset = i * datagram_size
+            iovectors[i].iov_base = buf + offset
+            iovectors[i].iov_len = min(datagram_size, py_buffer.len - offset)
+            # msg_name, msg_control and msg_flags are left to zero,
+            # since the socket is connected
+            messages_vectors[i].msg_hdr.msg_iov = &iovectors[i]
+            messages_vectors[i].msg_hdr.msg_iovlen = 1
+
+        with nogil:
+            sent_messages = _sendmmsg(fd, messages_vectors, datagram_number, flags)
+
+        if sent_messages == -1:
+            global errno
+            raise IOError(errno, os.strerror(errno))
+
+        sent_bytes = 0
+        for i in range(sent_messages):
+            sent_bytes += messages_vectors[i].msg_len
+        return sent_bytes
+
+    finally:
+        PyBuffer_Release(&py_buffer)
+        PyMem_Free(iovectors)
+        PyMem_Free(messages_vectors)
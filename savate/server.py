@@ -5,7 +5,6 @@ from datetime import datetime
 import logging
 import collections
 import random
-import re
 import itertools
 import errno
 import urlparse
@@ -20,15 +19,33 @@ from savate import buffer_event
 from savate import looping
 from savate import configuration
 from savate import helpers
+from savate import limits
+from savate import metrics
 from savate.helpers import HTTPError, HTTPParseError, HTTPResponse, find_signal_str
 from savate import clients
 from savate import sources
 from savate import relay
+from savate import routing
 from savate import timeouts
 
 
+# Responses sent as is to any number of clients
+METHOD_NOT_ALLOWED = helpers.PrebuiltHTTPResponse(405, b'Method Not Allowed')
+STREAM_NOT_FOUND = helpers.PrebuiltHTTPResponse(404, b'Stream Not Found')
+
+
 class HTTPRequest(looping.BaseIOEventHandler):
 
+    __slots__ = (
+        'server',
+        'sock',
+        'address',
+        'request_size',
+        'request_buffer',
+        'request_parser',
+        'auth_pending',
+    )
+
     REQUEST_MAX_SIZE = 4096
 
     def __init__(self, server, sock, address):
@@ -39,6 +56,8 @@ class HTTPRequest(looping.BaseIOEventHandler):
         self.request_size = 0
         self.request_buffer = b''
         self.request_parser = cyhttp11.HTTPParser()
+        # The helpers.Deferred authorization we are waiting for, if any
+        self.auth_pending = None
 
     def close(self):
         self.server.remove_inactivity_timeout(self)
@@ -48,19 +67,31 @@ class HTTPRequest(looping.BaseIOEventHandler):
     def handle_event(self, eventmask):
         if eventmask & looping.POLLIN:
             self.handle_read()
+        elif eventmask & (looping.POLLERR | looping.POLLHUP):
+            # Client went away while waiting for its authorization
+            self.server.logger.error('Connection closed by %s', self.address)
+            self.close()
 
     def handle_read(self):
         while True:
-            tmp_buffer = helpers.handle_eagain(self.sock.recv,
-                                               self.REQUEST_MAX_SIZE - self.request_size)
+            previous_size = self.request_size
+            tmp_buffer = helpers.recv_http_headers(self.sock, self.request_buffer,
+                                                   self.REQUEST_MAX_SIZE)
             if tmp_buffer == None:
                 # EAGAIN, we'll come back later
                 break
             elif tmp_buffer == b'':
                 raise HTTPError('Unexpected end of stream from %s, %s,' %
                                 (self.sock, self.address))
-            self.request_buffer = self.request_buffer + tmp_buffer
-            self.request_size += len(tmp_buffer)
+            self.request_buffer = tmp_buffer
+            self.request_size = len(tmp_buffer)
+            if not helpers.http_headers_complete(self.request_buffer, previous_size):
+                # Only run the parser once the headers are complete,
+                # instead of re-parsing a growing buffer on each segment
+                if self.request_size >= self.REQUEST_MAX_SIZE:
+                    raise HTTPParseError('Oversized HTTP request from %s, %s' %
+                                         (self.sock, self.address))
+                continue
             self.request_parser.execute(self.request_buffer)
             if self.request_parser.has_error():
                 raise HTTPParseError('Invalid HTTP request from %s, %s' %
@@ -68,13 +99,16 @@ class HTTPRequest(looping.BaseIOEventHandler):
             elif self.request_parser.is_finished():
                 # Transform this into the appropriate handler
                 self.transform_request()
+                if self.auth_pending is None:
+                    # The request has been routed, we don't need the
+                    # parser and its buffers anymore
+                    self.request_buffer = self.request_parser = None
                 break
             elif self.request_size >= self.REQUEST_MAX_SIZE:
                 raise HTTPParseError('Oversized HTTP request from %s, %s' %
                                      (self.sock, self.address))
 
     def transform_request(self):
-        loop = self.server.loop
         # FIXME: should we shutdown() read or write depending on what
         # we do here ? (i.e. SHUT_RD for GETs, SHUT_WD for sources)
 
@@ -86,33 +120,88 @@ class HTTPRequest(looping.BaseIOEventHandler):
                                 self.request_parser.headers)
 
         # Squash any consecutive / into one
-        self.request_parser.request_path = re.sub('//+', '/',
-                                                  self.request_parser.request_path)
+        path = routing.normalize_path(self.request_parser.request_path)
+        self.request_parser.request_path = path
 
         self.server.request_in(self.request_parser, self.sock)
 
-        # Authorization
-        for auth_handler in self.server.auth_handlers:
-            auth_result = auth_handler.authorize(self.address, self.request_parser)
-            if auth_result is None:
-                continue
-            elif not isinstance(auth_result, HTTPResponse):
-                # Wrong response from auth handler
-                raise RuntimeError('Wrong response from authorization handler %s' % auth_handler)
-            elif auth_result.status == 200:
-                # Request authorized
-                break
-            else:
+        self.authorize(self.server.routes.find(path), path)
+
+    def authorize(self, route, path, chain_index = 0):
+        """
+        Run the route's authorization chain from chain_index on, then
+        route the request if it has not been denied.
+        """
+        auth_chain = route.auth_chain
+        while chain_index < len(auth_chain):
+            auth_handler, auth_settings = auth_chain[chain_index]
+            auth_result = auth_handler.authorize_route(self.address, self.request_parser,
+                                                       auth_settings)
+            if isinstance(auth_result, helpers.Deferred):
+                # Park the request until the handler makes up its mind
+                self.auth_pending = auth_result
+                self.server.loop.register(self, 0)
+                auth_result.add_callback(self.resume_authorization, auth_handler,
+                                         route, path, chain_index)
+                return
+            elif not self.check_auth_result(auth_handler, auth_result):
                 # Access denied
-                loop.register(helpers.HTTPEventHandler(self.server,
-                                                       self.sock,
-                                                       self.address,
-                                                       self.request_parser,
-                                                       auth_result),
-                              looping.POLLOUT)
                 return
+            elif auth_result is not None:
+                # Request authorized
+                break
+            chain_index += 1
+
+        self.route_request(route, path)
+
+    def check_auth_result(self, auth_handler, auth_result):
+        """
+        Return whether the request may go on, answering it otherwise.
+        """
+        if auth_result is None:
+            return True
+        elif not isinstance(auth_result, HTTPResponse):
+            # Wrong response from auth handler
+            raise RuntimeError('Wrong response from authorization handler %s' % auth_handler)
+        elif auth_result.status == 200:
+            return True
+        else:
+            self.server.loop.register(helpers.HTTPEventHandler(self.server,
+                                                               self.sock,
+                                                               self.address,
+                                                               self.request_parser,
+                                                               auth_result),
+                                      looping.POLLOUT)
+            return False
 
-        path = self.request_parser.request_path
+    def resume_authorization(self, auth_handler, route, path, chain_index, auth_result):
+        self.auth_pending = None
+        if self.sock is None:
+            # The client went away in the meantime
+            return
+        try:
+            if self.check_auth_result(auth_handler, auth_result):
+                if auth_result is None:
+                    self.authorize(route, path, chain_index + 1)
+                else:
+                    self.route_request(route, path)
+        except Exception:
+            self.server.logger.exception('Error when handling request from %s:',
+                                         self.address)
+            self.close()
+            return
+        if self.auth_pending is None:
+            self.request_buffer = self.request_parser = None
+
+    def route_request(self, route, path):
+        loop = self.server.loop
+        # As requested, e.g. with its token, for redirections
+        requested_path = path
+
+        if self.request_parser.request_path != path:
+            # The path has been rewritten by an authorization handler
+            path = self.request_parser.request_path
+            route = self.server.routes.find(path)
 
         response = None
 
@@ -123,14 +212,14 @@ class HTTPRequest(looping.BaseIOEventHandler):
             # New client
 
             # Is our client asking for status ?
-            if path in self.server.status_handlers:
+            if route.status_handler is not None:
                 # FIXME: should we handle HEAD requests ?
                 if self.request_parser.request_method not in [b'GET']:
-                    response = HTTPResponse(405, b'Method Not Allowed')
+                    response = METHOD_NOT_ALLOWED
                 else:
-                    loop.register(self.server.status_handlers[path].get_status(self.sock,
-                                                                               self.address,
-                                                                               self.request_parser),
+                    loop.register(route.status_handler.get_status(self.sock,
+                                                                  self.address,
+                                                                  self.request_parser),
                                   looping.POLLOUT)
             else:
                 # New client for one of our sources
@@ -139,14 +228,11 @@ class HTTPRequest(looping.BaseIOEventHandler):
                     # before attempting playout
                     if self.request_parser.request_method in [b'HEAD']:
                         source = self.server.sources[path].keys()[0]
-                        response = HTTPResponse(200, b'OK', {b'Content-Type': source.content_type,
-                                                             b'Content-Length': None,
-                                                             b'Connection': b'close'})
-                    # Check for server clients limit
-                    elif self.server.clients_limit is not None and (
-                        self.server.clients_limit == self.server.clients_connected):
-                        response = HTTPResponse(503, b'Cannot handle response.'
-                                                b' Too many clients.')
+                        response = source.client_response()
+                    # Check for server and mount limits
+                    elif self.server.admission_check(route, path) is not None:
+                        response = self.server.overload_response(route, path,
+                                                                 requested_path)
                     else:
                         # FIXME: proper source selection
                         source = random.choice(self.server.sources[path].keys())
@@ -165,12 +251,14 @@ class HTTPRequest(looping.BaseIOEventHandler):
                         loop.register(new_client,
                                       looping.POLLOUT)
                 else:
-                    # Stream does not exist
-                    response = HTTPResponse(404, b'Stream Not Found')
+                    # Stream does not exist, maybe one of our peers
+                    # has it
+                    response = (self.server.peer_redirect(path, requested_path) or
+                                STREAM_NOT_FOUND)
 
         else:
             # Unknown HTTP request method
-            response = HTTPResponse(405, b'Method Not Allowed')
+            response = METHOD_NOT_ALLOWED
 
         if response is not None:
             loop.register(helpers.HTTPEventHandler(self.server,
@@ -196,6 +284,14 @@ class TCPServer(looping.BaseIOEventHandler):
 
     RESTART_DELAY = 1
 
+    # Maximum number of connections accepted per loop iteration, so
+    # that a reconnection storm does not starve everything else
+    ACCEPT_BATCH_SIZE = 256
+
+    # New connections are logged at DEBUG level, with an INFO summary
+    # every ACCEPT_LOG_INTERVAL seconds
+    ACCEPT_LOG_INTERVAL = 60
+
     STATE_RUNNING = 'RUNNING'
     STATE_STOPPED = 'STOPPED'
     STATE_SHUTTING_DOWN = 'SHUTTING_DOWN'
@@ -213,15 +309,62 @@ class TCPServer(looping.BaseIOEventHandler):
         self.auth_handlers = []
         self.status_handlers = {}
         self.statistics_handlers = []
+        # Built from the mounts, authorization and status handlers by
+        # the configuration
+        self.routes = routing.RouteTable()
         self.state = self.STATE_RUNNING
         self.reloading = False
         self.timeouts = None
         self.io_timeouts = None
         # keep a counter for limit on *streaming* clients
         self.clients_connected = 0
+        self.clients_limit = None
+        # mount path -> its own clients_limit
+        self.mount_clients_limits = {}
+        self.max_egress_bps = None
+        # Egress estimate, see estimated_egress_bps()
+        self.egress_estimate = 0
+        self.egress_estimate_time = None
+        # cluster.Cluster, if enabled
+        self.cluster = None
+        # Sent to refused clients, unless redirected
+        self.overload_redirect = None
+        # mount path -> its own overload_redirect
+        self.overload_redirects = {}
+        self.overload_unavailable = helpers.PrebuiltHTTPResponse(
+            503, b'Cannot handle response. Too many clients.')
+        # mount path -> limits.LagPolicy, for its streaming clients
+        self.lag_policies = {}
+        self.default_lag_policy = limits.LagPolicy()
+        # mount path -> buffer_event.SocketOptions, for its streaming
+        # clients
+        self.client_socket_options = {}
+        self.default_client_socket_options = buffer_event.SocketOptions()
+        # mount path -> list of outputs.UDPOutput
+        self.outputs = {}
+        # mount path -> size of the memfd ring its sources publish
+        # to, for mounts using the memfd output backend
+        self.ring_sizes = {}
+        self.default_ring_size = None
+        # Maximum bytes sent to a streaming client per loop iteration,
+        # None for no limit, see IOLoop.set_write_budget()
+        self.write_quantum = None
+        self.accept_batch_size = self.ACCEPT_BATCH_SIZE
+        # TCP_DEFER_ACCEPT timeout, in seconds, 0 when disabled
+        self.defer_accept = 0
+        self.accepted_connections = 0
+        self.last_accept_log = None
+        # mount path -> MountMetrics
+        self.mounts_metrics = {}
+        # limits.AcceptLimits, if enabled
+        self.accept_limits = None
+        # reason -> number of connections rejected at accept time
+        self.rejected_connections = {}
 
     def create_loop(self):
-        self.loop = looping.IOLoop(self.logger)
+        # Changing the loop backend requires a restart
+        self.loop = looping.IOLoop(self.logger, self.config.loop_backend())
+        self.logger.info('Using the %s loop backend', self.loop.backend)
         self.loop.register(self, looping.POLLIN)
         # Our timeout handler
         self.loop.register(self.timeouts, looping.POLLIN)
@@ -239,10 +382,30 @@ class TCPServer(looping.BaseIOEventHandler):
             self.timeouts = timeouts.Timeouts(self)
             self.io_timeouts = timeouts.IOTimeout(self.timeouts)
 
+    def set_defer_accept(self, defer_accept):
+        """
+        Only get notified of new connections once the client has sent
+        some data (or after defer_accept seconds), so that the request
+        can usually be read right away.
+        """
+        defer_accept = int(defer_accept or 0)
+        if defer_accept == self.defer_accept:
+            return
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT,
+                                 defer_accept)
+        except (AttributeError, socket.error):
+            self.logger.exception('Cannot set TCP_DEFER_ACCEPT:')
+            defer_accept = 0
+        self.defer_accept = defer_accept
+
     def handle_event(self, eventmask):
         if eventmask & looping.POLLIN:
             try:
-                helpers.loop_for_eagain(self.handle_new_incoming)
+                for _ in xrange(self.accept_batch_size):
+                    if not self.handle_new_incoming():
+                        # EAGAIN, no more pending connections
+                        break
             except IOError as exc:
                 if exc.errno in (errno.EMFILE, errno.ENFILE):
                     # Too many open files
@@ -254,6 +417,18 @@ class TCPServer(looping.BaseIOEventHandler):
                     self.sock.listen(self.BACKLOG)
                 else:
                     raise
+            finally:
+                self.log_accepted_connections()
+
+    def log_accepted_connections(self):
+        now = self.loop.now()
+        if self.last_accept_log is None:
+            self.last_accept_log = now
+        elif now - self.last_accept_log >= self.ACCEPT_LOG_INTERVAL:
+            self.logger.info('Accepted %d new connections in the last %d seconds',
+                             self.accepted_connections, now - self.last_accept_log)
+            self.accepted_connections = 0
+            self.last_accept_log = now
 
     def reset_inactivity_timeout(self, handler):
         self.io_timeouts.reset_timeout(
@@ -265,13 +440,45 @@ class TCPServer(looping.BaseIOEventHandler):
         self.io_timeouts.remove_timeout(handler)
 
     def handle_new_incoming(self):
-        client_socket, client_address = self.sock.accept()
-        self.logger.info('New client <fd:%d, id:0x%s>, %s',
-                         client_socket.fileno(), id(client_socket), client_address)
+        accepted = helpers.handle_eagain(self.sock.accept)
+        if accepted is None:
+            return False
+        client_socket, client_address = accepted
+        if self.accept_limits is not None:
+            reason = self.accept_limits.check(client_address[0], self.loop.now())
+            if reason is not None:
+                # Rejected before it costs us anything but the socket
+                client_socket.close()
+                self.rejected_connections[reason] = self.rejected_connections.get(reason, 0) + 1
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('Rejected new client %s: %s', client_address, reason)
+                return True
+        self.accepted_connections += 1
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('New client <fd:%d, id:0x%s>, %s',
+                              client_socket.fileno(), id(client_socket), client_address)
         new_handler = HTTPRequest(self, client_socket, client_address)
         self.reset_inactivity_timeout(new_handler)
 
+        if self.defer_accept:
+            # The request is most likely already there, try to handle
+            # it now rather than waiting for the next loop iteration
+            try:
+                new_handler.handle_read()
+            except Exception:
+                self.logger.exception('Error when handling request from %s:',
+                                      client_address)
+                new_handler.close()
+                return True
+            if new_handler.request_parser is None:
+                # Request routed
+                return True
+            elif new_handler.auth_pending is not None:
+                # Waiting for its authorization, already registered
+                return True
+
         self.loop.register(new_handler, looping.POLLIN)
+        return True
 
     def configure(self):
         self.config.configure()
@@ -288,7 +495,11 @@ class TCPServer(looping.BaseIOEventHandler):
 
     def add_relay(self, url, path, address_info = None, burst_size = None,
                   on_demand = False, keepalive = False):
-        if urlparse.urlparse(url).scheme in ('udp', 'multicast'):
+        scheme = urlparse.urlparse(url).scheme
+        if scheme == 'rtp':
+            tmp_relay = relay.RTPRelay(self, url, path, address_info,
+                                       burst_size)
+        elif scheme in ('udp', 'multicast'):
             tmp_relay = relay.UDPRelay(self, url, path, address_info,
                                        burst_size)
         else:
@@ -317,6 +528,13 @@ class TCPServer(looping.BaseIOEventHandler):
                          source.__class__.__name__, source.path, source.address)
         self.sources.setdefault(source.path, {})[source] = {'source': source,
                                                             'clients': {}}
+        ring_size = self.ring_size(source.path)
+        if ring_size is not None:
+            try:
+                source.ring = buffer_event.MemFDRing(ring_size, source.path)
+            except (IOError, OSError):
+                self.logger.exception('Cannot create memfd ring for %s, '
+                                      'using buffers:', source.path)
         self.reset_inactivity_timeout(source)
         self.loop.register(source, looping.POLLIN)
 
@@ -352,6 +570,11 @@ class TCPServer(looping.BaseIOEventHandler):
 
         keepalive = source.keepalive
 
+        for output in self.mount_outputs(source.path):
+            if output.source is source:
+                # Fed by the next source publishing for this mount
+                output.source = None
+
         # FIXME: client shutdown
         if len(self.sources[source.path]) > 1:
             # There is at least one other source for this path,
@@ -417,10 +640,138 @@ class TCPServer(looping.BaseIOEventHandler):
                                              for source_dict in source.itervalues()
                                              )
 
-    def publish_packet(self, source, packet):
+    def mount_bitrate(self, path):
+        """The ingest bitrate of the mount, in bits/s."""
+        now = self.loop.now()
+        return max([source.ingest.bitrate(10, now) for source
+                    in self.sources.get(path, ())] or [0])
+
+    def estimated_egress_bps(self):
+        """
+        Estimate our outgoing bitrate from the mounts bitrates and
+        listeners, at most once per loop iteration.
+        """
+        now = self.loop.now()
+        if self.egress_estimate_time != now:
+            self.egress_estimate = sum(self.mount_bitrate(path) *
+                                       self.get_mount_metrics(path).listeners
+                                       for path in self.sources)
+            self.egress_estimate_time = now
+        return self.egress_estimate
+
+    def admission_check(self, route, path):
+        """
+        Return why a new streaming client for path should be refused,
+        or None to admit it.
+        """
+        mount_metrics = self.get_mount_metrics(path)
+        mount_limit = self.mount_clients_limits.get(route.path)
+        if self.clients_limit is not None and self.clients_connected >= self.clients_limit:
+            reason = 'clients_limit'
+        elif mount_limit is not None and mount_metrics.listeners >= mount_limit:
+            reason = 'mount_clients_limit'
+        elif self.max_egress_bps is not None:
+            bitrate = self.mount_bitrate(path)
+            if self.estimated_egress_bps() + bitrate > self.max_egress_bps:
+                reason = 'max_egress_bps'
+            else:
+                # Account for this client until the next estimate
+                self.egress_estimate += bitrate
+                return None
+        else:
+            return None
+        mount_metrics.client_rejected(reason)
+        return reason
+
+    def overloaded(self):
+        """Whether we would refuse any new streaming client."""
+        return ((self.clients_limit is not None and
+                 self.clients_connected >= self.clients_limit) or
+                (self.max_egress_bps is not None and
+                 self.estimated_egress_bps() >= self.max_egress_bps))
+
+    def peer_redirect(self, path, requested_path):
+        """
+        Return a redirection to the cluster peer chosen for path, or
+        None if there is none.
+        """
+        if self.cluster is None:
+            return None
+        peer = self.cluster.choose_peer(path)
+        if peer is None:
+            return None
+        return HTTPResponse(302, b'Found', {b'Location': peer.url + requested_path})
+
+    def overload_response(self, route, path, requested_path):
+        redirect = self.overload_redirects.get(route.path, self.overload_redirect)
+        if redirect:
+            return HTTPResponse(302, b'Found',
+                                {b'Location': redirect.rstrip(b'/') + requested_path})
+        return self.peer_redirect(path, requested_path) or self.overload_unavailable
+
+    def get_mount_metrics(self, path):
+        try:
+            return self.mounts_metrics[path]
+        except KeyError:
+            return self.mounts_metrics.setdefault(path, metrics.MountMetrics())
+
+    def lag_policy(self, path):
+        """Return the lag policy of the streaming clients of path."""
+        return self.lag_policies.get(self.routes.find(path).path,
+                                     self.default_lag_policy)
+
+    def socket_options(self, path):
+        """Return the socket options of the streaming clients of path."""
+        return self.client_socket_options.get(self.routes.find(path).path,
+                                              self.default_client_socket_options)
+
+    def mount_outputs(self, path):
+        """Return the UDP outputs of path."""
+        return self.outputs.get(self.routes.find(path).path, ())
+
+    def ring_size(self, path):
+        """
+        Return the memfd ring size of the sources of path, None if
+        they use the buffers output backend.
+        """
+        return self.ring_sizes.get(self.routes.find(path).path, self.default_ring_size)
+
+    def publish_packet(self, source, packet, sync_point = True):
+        self.get_mount_metrics(source.path).packet_published(len(packet))
         packet = buffer_event.make_buffer(packet)
+
+        lag_policy = self.lag_policy(source.path)
+        if lag_policy.max_seconds is not None:
+            max_lag = lag_policy.max_lag(source.ingest.bitrate(10, self.loop.now()))
+        else:
+            max_lag = lag_policy.max_lag(0)
+
+        ring_offset = None
+        if source.ring is not None:
+            try:
+                ring_offset = source.ring.write(packet)
+            except ValueError as exc:
+                # Queued in buffers instead, see StreamClient.add_packet()
+                self.logger.warning('Cannot write to the ring of %s: %s', source.path, exc)
+            # Data sendfile()d to a client may still be read from the
+            # ring by the kernel once queued in its socket buffer, so
+            # keep half of the ring out of reach of lagging clients
+            max_lag = min(max_lag, source.ring.size // 2)
+
+        lagging_clients = []
         for client in self.sources[source.path][source]['clients'].itervalues():
-            client.add_packet(packet)
+            client.add_packet(packet, sync_point, ring_offset)
+            if client.output_buffer.size > max_lag and not client.resyncing:
+                lagging_clients.append(client)
+        for output in self.mount_outputs(source.path):
+            # Each output is fed by a single source of its mount
+            if output.source is None:
+                output.source = source
+            if output.source is source:
+                output.add_packet(packet)
+        # Lagging clients may close, hence leave our clients dict
+        for client in lagging_clients:
+            client.lag_exceeded(lag_policy, max_lag)
 
     def serve_forever(self):
         while (self.state == self.STATE_RUNNING or
@@ -12,6 +12,9 @@ class ShoutcastSource(LowBitrateSource):
                    'notice2')
     FRAME_PARSER_CLASS = None
 
+    # Metadata interval for our clients, whatever our own is
+    ICY_META_INTERVAL = 32 * 2 ** 10
+
     def __init__(self, server, sock, address, content_type,
                  request_parser, path = None, burst_size = None,
                  on_demand = False, keepalive = None):
@@ -40,6 +43,22 @@ class ShoutcastSource(LowBitrateSource):
             self.buffer_metadata = b''
             self.metadata = b''
 
+        self.headers_changed()
+
+    def client_response_headers(self, metadata = False):
+        headers = LowBitrateSource.client_response_headers(self, metadata)
+        for header in self.ICY_HEADERS:
+            if header == 'metaint':
+                continue
+
+            header_value = getattr(self, 'icy_%s' % header)
+            if header_value:
+                headers[b'icy-%s' % header] = header_value
+
+        if metadata:
+            headers[b'icy-metaint'] = b'%s' % self.ICY_META_INTERVAL
+        return headers
+
     def on_demand_deactivate(self):
         LowBitrateSource.on_demand_deactivate(self)
         self.working_buffer = b''
@@ -97,6 +116,22 @@ class ShoutcastSource(LowBitrateSource):
             self.output_buffer_data = b''
 
 
+    def ingest_status(self):
+        status_dict = LowBitrateSource.ingest_status(self)
+        if self.frame_parser is not None:
+            status_dict['parser_resyncs'] = self.frame_parser.resyncs
+            status_dict['parser_last_error'] = self.frame_parser.error_message
+        return status_dict
+
+
+    def memory_status(self):
+        status_dict = LowBitrateSource.memory_status(self)
+        status_dict['parser_bytes'] += len(self.working_buffer)
+        if self.frame_parser is not None:
+            status_dict['parser_bytes'] += len(self.frame_parser.buffer)
+        return status_dict
+
+
 class MP3ShoutcastSource(ShoutcastSource):
     """Shoutcast Source with MP3 frames parsing support."""
     FRAME_PARSER_CLASS = MP3Parser
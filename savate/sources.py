@@ -2,8 +2,11 @@
 
 import socket
 
+from savate import buffer_event
 from savate import helpers
 from savate import looping
+from savate import metrics
+from savate import rtp
 
 
 class StreamSource(looping.BaseIOEventHandler):
@@ -40,6 +43,35 @@ class StreamSource(looping.BaseIOEventHandler):
         self.on_demand = self.RUNNING if on_demand else self.DISABLED
         self.relay = server.relays.get(sock)  # some sources doesn't have relay
 
+        self.ingest = metrics.IngestStatistics(server.loop.now())
+
+        # with metadata -> PrebuiltHTTPResponse, see client_response()
+        self.client_responses = {}
+
+        # buffer_event.MemFDRing our packets are published to, if the
+        # mount uses the memfd output backend, see Server.register_source()
+        self.ring = None
+
+    def client_response_headers(self, metadata = False):
+        return {b'Content-Length': None, b'Content-Type': self.content_type}
+
+    def client_response(self, metadata = False):
+        """
+        Return the HTTP response sent to our clients, with or without
+        in-stream metadata. It is rendered once for all our clients,
+        until headers_changed() is called.
+        """
+        try:
+            return self.client_responses[metadata]
+        except KeyError:
+            response = helpers.PrebuiltHTTPResponse(
+                200, b'OK', self.client_response_headers(metadata))
+            self.client_responses[metadata] = response
+            return response
+
+    def headers_changed(self):
+        self.client_responses = {}
+
     def on_demand_activate(self):
         """Method which reconnects the relay"""
         # activate only if state 1
@@ -75,6 +107,7 @@ class StreamSource(looping.BaseIOEventHandler):
         self.on_demand = self.RUNNING
         self.sock = sock
         self.request_parser = request_parser
+        self.headers_changed()
         self.server.loop.register(self, looping.POLLIN)
 
     def __str__(self):
@@ -94,6 +127,7 @@ class StreamSource(looping.BaseIOEventHandler):
         packet = helpers.handle_eagain(self.sock.recv, buffer_size)
         if packet:
             self.server.update_activity(self)
+            self.ingest.data_in(len(packet), self.server.loop.now())
         return packet
 
     def handle_event(self, eventmask):
@@ -125,7 +159,12 @@ class StreamSource(looping.BaseIOEventHandler):
         # subclasses.
         self.publish_packet(packet)
 
-    def publish_packet(self, packet):
+    def publish_packet(self, packet, sync_point = True):
+        """
+        Send packet to our clients. sync_point tells whether a client
+        can start decoding the stream at this packet, e.g. after some
+        data has been dropped by its lag policy.
+        """
         clients = self.server.sources[self.path][self]['clients']
 
         if not clients and self.on_demand == self.RUNNING:
@@ -137,7 +176,7 @@ class StreamSource(looping.BaseIOEventHandler):
                 self.on_demand_deactivate,
             )
 
-        self.server.publish_packet(self, packet)
+        self.server.publish_packet(self, packet, sync_point)
 
     def new_client(self, client):
         if self.on_demand == self.STOPPED:
@@ -149,6 +188,17 @@ class StreamSource(looping.BaseIOEventHandler):
     def update_burst_size(self, new_burst_size):
         pass
 
+    def ingest_status(self):
+        """Return a dict describing the health of our input."""
+        return self.ingest.as_dict(self.server.loop.now())
+
+    def memory_status(self):
+        """
+        Return the number of bytes we hold for burst data, and as
+        not yet published (parser carry-over) data.
+        """
+        return {'burst_bytes': 0, 'parser_bytes': 0}
+
 
 class BufferedRawSource(StreamSource):
 
@@ -199,6 +249,12 @@ class BufferedRawSource(StreamSource):
         self.burst_size = new_burst_size
         self.burst_packets.maxbytes = new_burst_size
 
+    def memory_status(self):
+        return {
+            'burst_bytes': self.burst_packets.current_size,
+            'parser_bytes': len(self.output_buffer_data),
+            }
+
 
 class FixedPacketSizeSource(BufferedRawSource):
 
@@ -232,6 +288,97 @@ class MPEGTSSource(FixedPacketSizeSource):
     # Socket low water mark
     RECV_LOW_WATER_MARK = 1
 
+    MPEGTS_SYNC_BYTE = 0x47
+    MPEGTS_NULL_PID = 0x1fff
+    MPEGTS_RANDOM_ACCESS_INDICATOR = 0x40
+
+    def __init__(self, server, sock, address, content_type,
+                 request_parser = None, path = None, burst_size = None,
+                 on_demand = False, keepalive = None):
+        FixedPacketSizeSource.__init__(self, server, sock, address,
+                                       content_type, request_parser, path,
+                                       burst_size, on_demand, keepalive)
+        # PID -> last continuity counter
+        self.continuity_counters = {}
+        # PID -> number of continuity counter errors
+        self.cc_errors = {}
+        self.sync_errors = 0
+        # Whether the stream signals its random access points
+        self.random_access_seen = False
+
+    def publish_packet(self, packet, sync_point = True):
+        random_access = self.check_continuity(packet)
+        if random_access is not None:
+            self.random_access_seen = True
+        if not self.random_access_seen:
+            # Any packet boundary is as good as another
+            FixedPacketSizeSource.publish_packet(self, packet)
+        elif random_access is None:
+            FixedPacketSizeSource.publish_packet(self, packet, False)
+        else:
+            # Split our data so that clients can resume at the random
+            # access point
+            packet = buffer_event.make_buffer(packet)
+            if random_access:
+                FixedPacketSizeSource.publish_packet(self, packet[:random_access], False)
+            FixedPacketSizeSource.publish_packet(self, packet[random_access:])
+
+    def check_continuity(self, data):
+        """
+        Check the continuity counters of the (packet-aligned) MPEG-TS
+        data, see ISO/IEC 13818-1, 2.4.3.3. Return the offset of the
+        first packet with its random access indicator set, or None.
+        """
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        counters = self.continuity_counters
+        random_access = None
+        for offset in xrange(0, len(data) - self.PACKET_SIZE + 1, self.PACKET_SIZE):
+            if data[offset] != self.MPEGTS_SYNC_BYTE:
+                self.sync_errors += 1
+                continue
+            pid = ((data[offset + 1] & 0x1f) << 8) | data[offset + 2]
+            flags = data[offset + 3]
+            if (random_access is None and flags & 0x20 and data[offset + 4] and
+                data[offset + 5] & self.MPEGTS_RANDOM_ACCESS_INDICATOR):
+                random_access = offset
+            if pid == self.MPEGTS_NULL_PID or not flags & 0x10:
+                # Null packets and packets without payload do not
+                # increment the continuity counter
+                continue
+            counter = flags & 0x0f
+            last_counter = counters.get(pid)
+            counters[pid] = counter
+            if (last_counter is None or counter == last_counter or
+                counter == (last_counter + 1) & 0x0f):
+                # First packet, duplicate packet or expected counter
+                continue
+            if flags & 0x20 and data[offset + 4] and data[offset + 5] & 0x80:
+                # The discontinuity indicator is set
+                continue
+            self.cc_errors[pid] = self.cc_errors.get(pid, 0) + 1
+        return random_access
+
+    def ingest_status(self):
+        status_dict = FixedPacketSizeSource.ingest_status(self)
+        status_dict['cc_errors'] = self.cc_errors
+        status_dict['sync_errors'] = self.sync_errors
+        return status_dict
+
+    def recv_datagrams(self):
+        """
+        Return the list of datagrams available on our socket, None
+        on EAGAIN.
+        """
+        packet = helpers.handle_eagain(self.sock.recv, self.RECV_BUFFER_SIZE)
+        if packet is None:
+            return None
+        if not packet:
+            return []
+        self.server.update_activity(self)
+        self.ingest.data_in(len(packet), self.server.loop.now())
+        return [packet]
+
 
 class LowBitrateSource(BufferedRawSource):
 
@@ -266,14 +413,11 @@ try:
                                                path, burst_size, on_demand, keepalive)
             self.recv_buffer_count = self.RECV_BUFFER_COUNT_MIN
 
-        def recv_packet(self, _buffer_size = None):
-            # We ignore _buffer_size altogether here
+        def recv_datagrams(self):
             buffers = [bytearray(self.RECV_BUFFER_SIZE) for i in range(self.recv_buffer_count)]
             buffers = helpers.handle_eagain(recvmmsg, self.sock.fileno(), buffers)
-            if buffers is None:
-                return None
             if not buffers:
-                return bytearray()
+                return buffers
             # Automagically grow/shrink the buffer count as needed
             if len(buffers) >= self.recv_buffer_count:
                 self.recv_buffer_count = min(self.recv_buffer_count * 2, self.RECV_BUFFER_COUNT_MAX)
@@ -281,6 +425,15 @@ try:
                 self.recv_buffer_count = max(len(buffers), self.RECV_BUFFER_COUNT_MIN)
 
             self.server.update_activity(self)
+            self.ingest.data_in(sum(len(buff) for buff in buffers),
+                                self.server.loop.now(), len(buffers))
+            return buffers
+
+        def recv_packet(self, _buffer_size = None):
+            # We ignore _buffer_size altogether here
+            buffers = self.recv_datagrams()
+            if buffers is None:
+                return None
             return bytearray().join(buffers)
 
 
@@ -289,6 +442,62 @@ except ImportError:
     pass
 
 
+class RTPMPEGTSSource(MPEGTSSource):
+    """
+    MPEG-TS over RTP (RFC 2250) input class. RTP headers are stripped
+    from each received datagram, and payloads are put back in
+    sequence order (within a small jitter window) before being
+    handled as a regular MPEG-TS stream.
+    """
+
+    # Maximum number of out of order packets we wait for
+    RTP_JITTER_WINDOW = 32
+
+    def __init__(self, server, sock, address, content_type,
+                 request_parser = None, path = None, burst_size = None,
+                 on_demand = False, keepalive = None, rtp_buffer = None):
+        super(RTPMPEGTSSource, self).__init__(server, sock, address,
+                                              content_type, request_parser,
+                                              path, burst_size, on_demand, keepalive)
+        # The relay may hand us its reorder buffer, so that sequence
+        # tracking carries over from the initial buffering
+        self.rtp_buffer = rtp_buffer or rtp.RTPReorderBuffer(self.RTP_JITTER_WINDOW)
+
+    def recv_packet(self, _buffer_size = None):
+        datagrams = self.recv_datagrams()
+        if not datagrams:
+            # EAGAIN or end of stream
+            return None if datagrams is None else b''
+
+        payloads = []
+        for datagram in datagrams:
+            try:
+                sequence, payload = rtp.parse_rtp_packet(datagram)
+            except rtp.RTPError:
+                self.rtp_buffer.invalid += 1
+                continue
+            payloads.extend(self.rtp_buffer.push(sequence, payload))
+
+        if not payloads:
+            # Everything we got is waiting in the reorder buffer,
+            # we'll be called again when more data is available
+            return None
+        return bytearray().join(payloads)
+
+    def ingest_status(self):
+        status_dict = MPEGTSSource.ingest_status(self)
+        status_dict['rtp'] = {
+            'received': self.rtp_buffer.received,
+            'lost': self.rtp_buffer.lost,
+            'reordered': self.rtp_buffer.reordered,
+            'duplicates': self.rtp_buffer.duplicates,
+            'late': self.rtp_buffer.late,
+            'invalid': self.rtp_buffer.invalid,
+            'resyncs': self.rtp_buffer.resyncs,
+            }
+        return status_dict
+
+
 from savate.flv_source import FLVSource
 from savate.shoutcast_source import (
     ShoutcastSource, MP3ShoutcastSource, ADTSShoutcastSource,
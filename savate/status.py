@@ -6,7 +6,17 @@ try:
 except ImportError:
     import simplejson as json
 import pprint
-from savate.helpers import HTTPEventHandler, HTTPResponse
+import resource
+import zlib
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4, and not patched for pytracemalloc
+    tracemalloc = None
+from savate import buffer_event
+from savate.helpers import (HTTPEventHandler, DeferredHTTPEventHandler,
+                            StreamedHTTPEventHandler, HTTPResponse)
+from savate.profiler import SamplingProfiler
 
 
 class BaseStatusClient(object):
@@ -28,24 +38,143 @@ class SimpleStatusClient(BaseStatusClient):
                                 pprint.pformat(self.server.sources)))
 
 
-class JSONStatusClient(BaseStatusClient):
+def memory_accounting(server):
+    """
+    Return a mount path -> dict of bytes held by each subsystem:
+    client queues, burst data, parser carry-over data, keepalived
+    clients queues and memfd rings.
+    """
+    mounts = {}
+    for path in set(server.sources) | set(server.mounts_metrics) | set(server.keepalived):
+        mount_metrics = server.mounts_metrics.get(path)
+        mounts[path] = {
+            'queued_bytes': mount_metrics.queued_bytes if mount_metrics else 0,
+            'burst_bytes': 0,
+            'parser_bytes': 0,
+            'keepalive_bytes': sum(client.output_buffer.queue_size()
+                                   for client in server.keepalived.get(path, ())
+                                   if not client.closed),
+            'ring_bytes': 0,
+            }
+        for source in server.sources.get(path, ()):
+            for key, value in source.memory_status().items():
+                mounts[path][key] += value
+            if source.ring is not None:
+                mounts[path]['ring_bytes'] += source.ring.size
+    return mounts
+
+
+def process_rss():
+    """Return our current resident set size, in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def accepts_gzip(request_parser):
+    """Whether the client accepts a gzip Content-Encoding."""
+    accept_encoding = request_parser.headers.get('Accept-Encoding', '')
+    for coding in accept_encoding.split(','):
+        params = [param.strip().lower() for param in coding.split(';')]
+        if params[0] in ('gzip', 'x-gzip'):
+            for param in params[1:]:
+                try:
+                    if param.startswith('q=') and float(param[2:]) == 0:
+                        return False
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def gzip_compressor(level = 6):
+    # 16 + MAX_WBITS tells zlib to use the gzip format
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class CachedStatusClient(BaseStatusClient):
+    """
+    Base class for status handlers rendering their whole body with
+    render_status(). The rendered body is cached for `cache_ttl`
+    seconds and shared by every request in this interval. If `gzip`
+    is enabled, it is compressed for the clients that accept it.
+    """
+
+    CONTENT_TYPE = b'application/octet-stream'
+
+    def __init__(self, server, server_config, **config_dict):
+        BaseStatusClient.__init__(self, server, server_config, **config_dict)
+        self.cache_ttl = float(config_dict.get('cache_ttl', 0))
+        self.gzip = bool(config_dict.get('gzip', False))
+        self.cache_time = None
+        # Content-Encoding -> HTTPResponse
+        self.cached_responses = {}
+
+    def render_status(self):
+        raise NotImplementedError('Implement in subclass')
+
+    def get_response(self, content_encoding):
+        now = self.server.loop.now()
+        if self.cache_time is None or now - self.cache_time >= self.cache_ttl:
+            self.cached_responses = {}
+            self.cache_time = now
+
+        if content_encoding not in self.cached_responses:
+            headers = {b'Content-Type': self.CONTENT_TYPE}
+            if self.gzip:
+                headers[b'Vary'] = b'Accept-Encoding'
+            if content_encoding == b'identity':
+                body = self.render_status()
+            else:
+                body = self.get_response(b'identity').body
+                compressor = gzip_compressor()
+                body = compressor.compress(body) + compressor.flush()
+                headers[b'Content-Encoding'] = content_encoding
+            self.cached_responses[content_encoding] = HTTPResponse(
+                200, b'OK', headers, body)
+        return self.cached_responses[content_encoding]
 
     def get_status(self, sock, address, request_parser):
+        if self.gzip and accepts_gzip(request_parser):
+            content_encoding = b'gzip'
+        else:
+            content_encoding = b'identity'
+        return HTTPEventHandler(self.server, sock, address, request_parser,
+                                self.get_response(content_encoding))
+
+
+class JSONStatusClient(CachedStatusClient):
+
+    CONTENT_TYPE = b'application/json'
+
+    def __init__(self, server, server_config, **config_dict):
+        CachedStatusClient.__init__(self, server, server_config, **config_dict)
+        self.indent = config_dict.get('indent', 4)
+        # The per-client listing can be left to JSONClientsStatusClient
+        self.list_clients = config_dict.get('list_clients', True)
+
+    def render_status(self):
         sources_dict = {}
+        ingest_dict = {}
         total_clients_number = 0
 
         queue_sizes = []
 
         for path, sources in self.server.sources.items():
             sources_dict[path] = {}
+            ingest_dict[path] = {}
             for source, source_dict in sources.items():
                 source_address = '%s:%s (%s)' % (source.address[0],
                                                  source.address[1], id(source))
                 sources_dict[path][source_address] = {}
+                ingest_dict[path][source_address] = source.ingest_status()
                 for fd, client in source_dict['clients'].items():
-                    sources_dict[path][source_address][fd] = '%s:%s' % client.address
+                    if self.list_clients:
+                        sources_dict[path][source_address][fd] = '%s:%s' % client.address
                     total_clients_number += 1
-                    queue_sizes.append(sum(len(elt) for elt in client.output_buffer.buffer_queue))
+                    queue_sizes.append(client.output_buffer.queue_size())
 
         queue_sizes.sort()
         if not queue_sizes:
@@ -58,11 +187,446 @@ class JSONStatusClient(BaseStatusClient):
             'median_buffer_queue_size': queue_sizes[total_clients_number / 2],
             'average_buffer_queue_size': sum(queue_sizes) / len(queue_sizes),
             'sources': sources_dict,
+            'ingest': ingest_dict,
+            'rejected_connections': self.server.rejected_connections,
+            'outputs': dict((path, [output.status() for output in mount_outputs])
+                            for path, mount_outputs in self.server.outputs.items()),
             }
 
-        return HTTPEventHandler(self.server, sock, address, request_parser,
-                                HTTPResponse(200, b'OK', {b'Content-Type': 'application/json'},
-                                json.dumps(status_dict, indent = 4) + '\n'))
+        return json.dumps(status_dict, indent = self.indent) + '\n'
+
+
+class JSONClientsStatusClient(BaseStatusClient):
+    """
+    Streams the list of connected clients as JSON, `chunk_size`
+    clients at a time, generating each chunk only once the previous
+    one has been sent.
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, server, server_config, **config_dict):
+        BaseStatusClient.__init__(self, server, server_config, **config_dict)
+        self.chunk_size = int(config_dict.get('chunk_size', self.CHUNK_SIZE))
+        self.gzip = bool(config_dict.get('gzip', False))
+
+    def client_dict(self, path, source_address, source_bitrate, fd, client):
+        queue_size = client.output_buffer.queue_size()
+        return {
+            'path': path,
+            'source': source_address,
+            'fd': fd,
+            'address': '%s:%s' % client.address,
+            'connect_time': client.connect_time,
+            'bytes_sent': client.bytes_sent,
+            'queue_size': queue_size,
+            # How far behind the source the client is, None until
+            # the source bitrate is known
+            'lag_seconds': (queue_size * 8. / source_bitrate
+                            if source_bitrate else None),
+            'resyncing': client.resyncing,
+            'resyncs': client.resyncs,
+            'skipped_bytes': client.skipped_bytes,
+            # Data accepted by the kernel but not sent yet, on top of
+            # queue_size
+            'kernel_unsent_bytes': buffer_event.unsent_bytes(client.sock),
+            }
+
+    def iter_clients(self):
+        yield '{"clients": [\n'
+        separator = ''
+        # We only keep references to the clients of the source we're
+        # working on, since clients may come and go between two chunks
+        for path in list(self.server.sources):
+            for source in list(self.server.sources.get(path, ())):
+                source_dict = self.server.sources.get(path, {}).get(source)
+                if source_dict is None:
+                    # Source is gone
+                    continue
+                source_address = '%s:%s (%s)' % (source.address[0],
+                                                 source.address[1], id(source))
+                source_bitrate = source.ingest.bitrate(10, self.server.loop.now())
+                clients = list(source_dict['clients'].items())
+                for index in xrange(0, len(clients), self.chunk_size):
+                    entries = [json.dumps(self.client_dict(path, source_address,
+                                                           source_bitrate, fd, client))
+                               for fd, client in clients[index:index + self.chunk_size]
+                               if not client.closed]
+                    if entries:
+                        yield separator + ',\n'.join(entries)
+                        separator = ',\n'
+        yield '\n]}\n'
+
+    def iter_gzip(self, chunks):
+        compressor = gzip_compressor()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    def get_status(self, sock, address, request_parser):
+        headers = {b'Content-Type': b'application/json', b'Content-Length': None}
+        body_chunks = self.iter_clients()
+        if self.gzip:
+            headers[b'Vary'] = b'Accept-Encoding'
+            if accepts_gzip(request_parser):
+                headers[b'Content-Encoding'] = b'gzip'
+                body_chunks = self.iter_gzip(body_chunks)
+        return StreamedHTTPEventHandler(self.server, sock, address, request_parser,
+                                        HTTPResponse(200, b'OK', headers),
+                                        body_chunks)
+
+
+class PrometheusStatusClient(CachedStatusClient):
+    """
+    Status handler exposing metrics in the Prometheus text exposition
+    format. All the values are maintained incrementally, so a scrape
+    only costs O(mounts).
+    """
+
+    CONTENT_TYPE = b'text/plain; version=0.0.4'
+
+    @staticmethod
+    def escape_label(value):
+        return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    @staticmethod
+    def format_value(value):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value) if isinstance(value, float) else str(value)
+
+    def format_metric(self, name, metric_type, help_string, samples):
+        lines = ['# HELP %s %s' % (name, help_string),
+                 '# TYPE %s %s' % (name, metric_type)]
+        lines.extend(self.format_samples(name, samples))
+        return lines
+
+    def format_samples(self, name, samples):
+        lines = []
+        for labels, value in samples:
+            if labels:
+                labels_string = '{%s}' % ','.join(
+                    '%s="%s"' % (label, self.escape_label(str(label_value)))
+                    for label, label_value in labels)
+            else:
+                labels_string = ''
+            lines.append('%s%s %s' % (name, labels_string, self.format_value(value)))
+        return lines
+
+    def format_histogram(self, name, help_string, samples):
+        lines = self.format_metric(name, 'histogram', help_string, ())
+        for labels, histogram in samples:
+            lines.extend(self.format_samples(
+                name + '_bucket',
+                [(labels + (('le', self.format_value(bound)),), count)
+                 for bound, count in histogram.cumulative()]))
+            lines.extend(self.format_samples(name + '_sum', [(labels, histogram.sum)]))
+            lines.extend(self.format_samples(name + '_count', [(labels, histogram.count)]))
+        return lines
+
+    def render_status(self):
+        now = self.server.loop.now()
+        mounts = sorted(self.server.mounts_metrics.items())
+
+        lines = []
+        lines.extend(self.format_metric(
+            'savate_clients_connected', 'gauge',
+            'Number of connected streaming clients.',
+            [((), self.server.clients_connected)]))
+        lines.extend(self.format_metric(
+            'savate_estimated_egress_bps', 'gauge',
+            'Outgoing bitrate estimated from mounts bitrates and listeners.',
+            [((), self.server.estimated_egress_bps())]))
+        lines.extend(self.format_metric(
+            'savate_rejected_connections_total', 'counter',
+            'Connections rejected at accept time by the accept limits.',
+            [((('reason', reason),), rejected) for reason, rejected
+             in sorted(self.server.rejected_connections.items())]))
+        lines.extend(self.format_metric(
+            'savate_listeners', 'gauge',
+            'Number of connected streaming clients per mount.',
+            [((('mount', path),), mount.listeners) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_sources', 'gauge',
+            'Number of sources per mount.',
+            [((('mount', path),), len(self.server.sources.get(path, ()))) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_bytes_out_total', 'counter',
+            'Bytes sent to streaming clients.',
+            [((('mount', path),), mount.bytes_out) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_bytes_published_total', 'counter',
+            'Bytes published by sources.',
+            [((('mount', path),), mount.bytes_published) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_packets_published_total', 'counter',
+            'Packets published by sources.',
+            [((('mount', path),), mount.packets_published) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_client_queue_bytes', 'gauge',
+            'Bytes queued for streaming clients.',
+            [((('mount', path),), mount.queued_bytes) for path, mount in mounts]))
+        lines.extend(self.format_histogram(
+            'savate_client_queue_size_bytes',
+            'Streaming clients queue sizes.',
+            [((('mount', path),), mount.queue_size_histogram()) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_client_drops_total', 'counter',
+            'Streaming clients dropped by the server.',
+            [((('mount', path), ('reason', reason)), drops)
+             for path, mount in mounts
+             for reason, drops in sorted(mount.drops.items())]))
+        lines.extend(self.format_metric(
+            'savate_client_resyncs_total', 'counter',
+            'Times lagging streaming clients were resynced.',
+            [((('mount', path),), mount.resyncs) for path, mount in mounts]))
+        lines.extend(self.format_metric(
+            'savate_client_rejections_total', 'counter',
+            'Streaming clients refused by admission control.',
+            [((('mount', path), ('reason', reason)), rejections)
+             for path, mount in mounts
+             for reason, rejections in sorted(mount.rejections.items())]))
+
+        ingest_bytes = []
+        ingest_bitrate = []
+        for path, sources in sorted(self.server.sources.items()):
+            ingest_bytes.append(((('mount', path),), sum(
+                source.ingest.bytes_in for source in sources)))
+            ingest_bitrate.append(((('mount', path),), sum(
+                source.ingest.bitrate(10, now) for source in sources)))
+        lines.extend(self.format_metric(
+            'savate_ingest_bytes_total', 'counter',
+            'Bytes received from sources.', ingest_bytes))
+        lines.extend(self.format_metric(
+            'savate_ingest_bitrate_bps', 'gauge',
+            'Ingest bitrate over the last 10 seconds.', ingest_bitrate))
+
+        lines.extend(self.format_metric(
+            'savate_loop_lag_seconds', 'gauge',
+            'Time spent handling events during the last loop iteration.',
+            [((), self.server.loop.lag)]))
+        lines.extend(self.format_metric(
+            'savate_loop_busy_seconds_total', 'counter',
+            'Time spent handling events since startup.',
+            [((), self.server.loop.busy_time)]))
+        lines.extend(self.format_metric(
+            'savate_loop_deferred_writes_total', 'counter',
+            'Writable handlers left for the next iteration by the write budget.',
+            [((), self.server.loop.deferred_writes_total)]))
+
+        memory = sorted(memory_accounting(self.server).items())
+        lines.extend(self.format_metric(
+            'savate_burst_bytes', 'gauge',
+            'Bytes kept by sources as burst data.',
+            [((('mount', path),), mount['burst_bytes']) for path, mount in memory]))
+        lines.extend(self.format_metric(
+            'savate_parser_bytes', 'gauge',
+            'Bytes kept by sources as not yet published data.',
+            [((('mount', path),), mount['parser_bytes']) for path, mount in memory]))
+        lines.extend(self.format_metric(
+            'savate_keepalive_queue_bytes', 'gauge',
+            'Bytes queued for clients waiting for their source to come back.',
+            [((('mount', path),), mount['keepalive_bytes']) for path, mount in memory]))
+        lines.extend(self.format_metric(
+            'savate_ring_bytes', 'gauge',
+            'Bytes of the memfd rings sources publish to.',
+            [((('mount', path),), mount['ring_bytes']) for path, mount in memory]))
+        rss = process_rss()
+        if rss is not None:
+            lines.extend(self.format_metric(
+                'savate_resident_memory_bytes', 'gauge',
+                'Resident set size.', [((), rss)]))
+
+        loop_statistics = self.server.loop.statistics
+        if loop_statistics is not None:
+            lines.extend(self.format_histogram(
+                'savate_loop_iteration_seconds',
+                'Time spent handling events per loop iteration.',
+                [((), loop_statistics.iteration_time)]))
+            lines.extend(self.format_histogram(
+                'savate_loop_events',
+                'Number of events handled per loop iteration.',
+                [((), loop_statistics.events_per_iteration)]))
+            lines.extend(self.format_histogram(
+                'savate_handler_seconds',
+                'Time spent in event handlers, per handler class.',
+                [((('handler', handler_class),), histogram) for handler_class, histogram
+                 in sorted(loop_statistics.handlers_time.items())]))
+            lines.extend(self.format_metric(
+                'savate_slow_callbacks_total', 'counter',
+                'Event handlers slower than the slow callback threshold.',
+                [((), loop_statistics.slow_callbacks)]))
+        return '\n'.join(lines) + '\n'
+
+
+class ClusterStatusClient(CachedStatusClient):
+    """
+    What our cluster peers need to know about us, as compact JSON:
+    our load and the mounts we carry.
+    """
+
+    CONTENT_TYPE = b'application/json'
+
+    def render_status(self):
+        server = self.server
+        return json.dumps({
+            'clients_connected': server.clients_connected,
+            'clients_limit': server.clients_limit,
+            'estimated_egress_bps': server.estimated_egress_bps(),
+            'max_egress_bps': server.max_egress_bps,
+            'overloaded': server.overloaded(),
+            'mounts': sorted(server.sources),
+            }) + '\n'
+
+
+class LoopStatusClient(CachedStatusClient):
+    """
+    Event loop instrumentation, as JSON. Detailed statistics are only
+    available when the loop_statistics option is enabled.
+    """
+
+    CONTENT_TYPE = b'application/json'
+
+    def render_status(self):
+        loop = self.server.loop
+        status_dict = {
+            'backend': loop.backend,
+            'lag': loop.lag,
+            'busy_time': loop.busy_time,
+            'handlers': len(loop.handlers),
+            'write_budget': loop.write_budget,
+            'deferred_writes': loop.deferred_writes_total,
+            'statistics': None,
+            }
+        if loop.statistics is not None:
+            status_dict['statistics'] = loop.statistics.as_dict()
+        return json.dumps(status_dict, indent = 4) + '\n'
+
+
+class MemoryStatusClient(CachedStatusClient):
+    """Memory usage, per mount and per subsystem, as JSON."""
+
+    CONTENT_TYPE = b'application/json'
+
+    def render_status(self):
+        mounts = memory_accounting(self.server)
+        totals = {}
+        for mount in mounts.values():
+            for key, value in mount.items():
+                totals[key] = totals.get(key, 0) + value
+        status_dict = {
+            'rss': process_rss(),
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10,
+            'totals': totals,
+            'mounts': mounts,
+            }
+        return json.dumps(status_dict, indent = 4) + '\n'
+
+
+class TracemallocStatusClient(BaseStatusClient):
+    """
+    Takes a tracemalloc snapshot on each request, and answers with the
+    top allocation sites, compared to the previous snapshot if any.
+    Tracing starts with the first request. Note that tracing has a
+    significant memory and CPU cost, and that taking a snapshot blocks
+    the server for a while.
+    """
+
+    LIMIT = 50
+
+    def __init__(self, server, server_config, **config_dict):
+        BaseStatusClient.__init__(self, server, server_config, **config_dict)
+        self.frames = int(config_dict.get('frames', 1))
+        self.limit = int(config_dict.get('limit', self.LIMIT))
+        self.key_type = config_dict.get('key_type', 'lineno')
+        self.snapshot = None
+
+    def get_status(self, sock, address, request_parser):
+        if tracemalloc is None:
+            response = HTTPResponse(501, b'Not Implemented', {b'Content-Type': b'text/plain'},
+                                    b'tracemalloc is not available\n')
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.snapshot = None
+            response = HTTPResponse(200, b'OK', {b'Content-Type': b'text/plain'},
+                                    b'Started tracing memory allocations\n')
+        else:
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                ))
+            if self.snapshot is None:
+                stats = snapshot.statistics(self.key_type)
+                title = 'Top %d allocation sites' % self.limit
+            else:
+                stats = snapshot.compare_to(self.snapshot, self.key_type)
+                title = 'Top %d allocation differences since previous snapshot' % self.limit
+            self.snapshot = snapshot
+            traced, peak = tracemalloc.get_traced_memory()
+            lines = [title, 'Traced: %d bytes, peak: %d bytes' % (traced, peak), '']
+            lines.extend(str(stat) for stat in stats[:self.limit])
+            response = HTTPResponse(200, b'OK', {b'Content-Type': b'text/plain'},
+                                    '\n'.join(lines) + '\n')
+        return HTTPEventHandler(self.server, sock, address, request_parser, response)
+
+    def close(self):
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.snapshot = None
+
+
+class ProfileStatusClient(BaseStatusClient):
+    """
+    Runs a sampling profiler for `duration` seconds, then answers with
+    the collapsed stacks, ready to be fed to flamegraph.pl. Requests
+    arriving while a profile is running share its result.
+    """
+
+    DURATION = 10
+    MAX_DURATION = 300
+    INTERVAL = 0.005
+
+    def __init__(self, server, server_config, **config_dict):
+        BaseStatusClient.__init__(self, server, server_config, **config_dict)
+        self.duration = min(int(config_dict.get('duration', self.DURATION)),
+                            self.MAX_DURATION)
+        self.interval = float(config_dict.get('interval', self.INTERVAL))
+        self.profiler = None
+        self.waiting_handlers = []
+
+    def get_status(self, sock, address, request_parser):
+        handler = DeferredHTTPEventHandler(self.server, sock, address, request_parser)
+        if self.profiler is None:
+            self.server.logger.info('Starting a %d seconds profile', self.duration)
+            self.profiler = SamplingProfiler(self.interval)
+            self.profiler.start()
+            self.server.timeouts.reset_timeout(
+                self, self.server.loop.now() + self.duration, self.profile_done)
+        self.waiting_handlers.append(handler)
+        return handler
+
+    def respond(self, response):
+        for handler in self.waiting_handlers:
+            if not handler.closed:
+                handler.respond(response)
+        self.waiting_handlers = []
+
+    def profile_done(self):
+        self.profiler.stop()
+        self.server.logger.info('Profile done, %d distinct stacks',
+                                len(self.profiler.samples))
+        response = HTTPResponse(200, b'OK', {b'Content-Type': b'text/plain'},
+                                self.profiler.collapsed())
+        self.profiler = None
+        self.respond(response)
+
+    def close(self):
+        if self.profiler is not None:
+            self.server.timeouts.remove_timeout(self)
+            self.profiler.stop()
+            self.profiler = None
+            self.respond(HTTPResponse(503, b'Service Unavailable',
+                                      {b'Content-Type': b'text/plain'},
+                                      b'Profile interrupted by a reload\n'))
 
 
 class StaticFileStatusClient(BaseStatusClient):
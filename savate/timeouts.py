@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import heapq
+import time
 from functools import partial
 
 from savate.looping import BaseIOEventHandler, POLLIN
@@ -16,10 +18,15 @@ class Timeouts(BaseIOEventHandler):
         self.timeouts = {}
         # A handler -> timestamp dict
         self.handlers_timeouts = {}
+        # A heap of the timestamps in self.timeouts, which may also
+        # hold stale timestamps whose timeouts were all removed
+        self.expirations = []
 
     @property
     def min_expiration(self):
-        return min(self.timeouts)
+        while self.expirations[0] not in self.timeouts:
+            heapq.heappop(self.expirations)
+        return self.expirations[0]
 
     def reset_timeout(self, key_index, expiration, callback, *args, **kwargs):
         """
@@ -35,42 +42,57 @@ class Timeouts(BaseIOEventHandler):
 
         # Do we need to update an existing timeout ?
         if key_index in self.handlers_timeouts:
-            old_expiration = self.handlers_timeouts[key_index]
-            self.timeouts[old_expiration].pop(key_index)
+            self.pop_timeout(self.handlers_timeouts[key_index], key_index)
         # Construct the callback
         if args or kwargs:  # arguments supplied
             callback = partial(callback, *args, **kwargs)
         self.handlers_timeouts[key_index] = expiration
-        self.timeouts.setdefault(expiration, {})[key_index] = callback
+        if expiration not in self.timeouts:
+            self.timeouts[expiration] = {}
+            heapq.heappush(self.expirations, expiration)
+        self.timeouts[expiration][key_index] = callback
 
     def remove_timeout(self, key_index):
         """
         :param object key_index: same as self.reset_timeout
         """
         if key_index in self.handlers_timeouts:
-            expiration = self.handlers_timeouts.pop(key_index)
-            self.timeouts.get(expiration, {}).pop(key_index, None)
+            self.pop_timeout(self.handlers_timeouts.pop(key_index), key_index)
+
+    def pop_timeout(self, expiration, key_index):
+        timeouts = self.timeouts.get(expiration)
+        if timeouts is not None:
+            timeouts.pop(key_index, None)
+            if not timeouts:
+                # Its timestamp is left in self.expirations, and
+                # skipped by min_expiration
+                del self.timeouts[expiration]
 
     def handle_event(self, eventmask):
         if eventmask & POLLIN:
             # Seems we need to "flush" the FD's expiration counter to
             # avoid some strange poll-ability bugs
             self.timer.read()
-            # Timer expired
-            expiration = self.min_expiration
-
-            # We use this instead of iterating on
-            # self.timeouts[expiration] because closing one of the
-            # handlers may close other handlers, and thus remove some
-            # of timeouts we're processing in this call (i.e. when a
-            # source times out any of its clients that was marked as
-            # timed out will be dropped, and removed from the timeouts
-            # list)
-            while self.timeouts[expiration]:
-                key_index, callback = self.timeouts[expiration].popitem()
-                self.handlers_timeouts.pop(key_index)
-                callback()
-            del self.timeouts[expiration]
+            # Timer expired, fire every timeout that is due, not only
+            # the earliest ones
+            now = time.time()
+            while self.timeouts and self.min_expiration <= now:
+                # Left in self.expirations until we're done with it,
+                # callbacks may reset timeouts to that expiration
+                expiration = self.min_expiration
+
+                # We use this instead of iterating on
+                # self.timeouts[expiration] because closing one of the
+                # handlers may close other handlers, and thus remove
+                # some of timeouts we're processing in this call
+                # (i.e. when a source times out any of its clients
+                # that was marked as timed out will be dropped, and
+                # removed from the timeouts list)
+                while self.timeouts.get(expiration):
+                    key_index, callback = self.timeouts[expiration].popitem()
+                    self.handlers_timeouts.pop(key_index)
+                    callback()
+                self.timeouts.pop(expiration, None)
             if self.timeouts:
                 # Reset the timer to the earliest one
                 self.timer.settime(self.min_expiration, flags = TFD_TIMER_ABSTIME)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+cdef extern from 'linux/io_uring.h':
+
+        ctypedef unsigned char __u8
+        ctypedef unsigned short __u16
+        ctypedef int __s32
+        ctypedef unsigned int __u32
+        ctypedef unsigned long long __u64
+        ctypedef long long __s64
+
+        struct __kernel_timespec:
+                __s64 tv_sec
+                long long tv_nsec
+
+        struct io_sqring_offsets:
+                __u32 head
+                __u32 tail
+                __u32 ring_mask
+                __u32 ring_entries
+                __u32 flags
+                __u32 dropped
+                __u32 array
+
+        struct io_cqring_offsets:
+                __u32 head
+                __u32 tail
+                __u32 ring_mask
+                __u32 ring_entries
+                __u32 overflow
+                __u32 cqes
+
+        struct io_uring_params:
+                __u32 sq_entries
+                __u32 cq_entries
+                __u32 flags
+                __u32 features
+                io_sqring_offsets sq_off
+                io_cqring_offsets cq_off
+
+        # Only the fields we use, some of them being in unions
+        struct io_uring_sqe:
+                __u8 opcode
+                __u8 flags
+                __s32 fd
+                __u64 off
+                __u64 addr
+                __u32 len
+                __u16 poll_events
+                __u32 msg_flags
+                __u64 user_data
+
+        struct io_uring_cqe:
+                __u64 user_data
+                __s32 res
+                __u32 flags
+
+        cdef int c_IORING_OP_POLL_ADD "IORING_OP_POLL_ADD"
+        cdef int c_IORING_OP_POLL_REMOVE "IORING_OP_POLL_REMOVE"
+        cdef int c_IORING_OP_TIMEOUT "IORING_OP_TIMEOUT"
+        cdef int c_IORING_OP_ASYNC_CANCEL "IORING_OP_ASYNC_CANCEL"
+        cdef int c_IORING_OP_SEND "IORING_OP_SEND"
+        cdef unsigned long long c_IORING_OFF_SQ_RING "IORING_OFF_SQ_RING"
+        cdef unsigned long long c_IORING_OFF_CQ_RING "IORING_OFF_CQ_RING"
+        cdef unsigned long long c_IORING_OFF_SQES "IORING_OFF_SQES"
+        cdef unsigned int c_IORING_FEAT_SINGLE_MMAP "IORING_FEAT_SINGLE_MMAP"
+        cdef unsigned int c_IORING_FEAT_FAST_POLL "IORING_FEAT_FAST_POLL"
+        cdef unsigned int c_IORING_SETUP_CQSIZE "IORING_SETUP_CQSIZE"
+        cdef unsigned int c_IORING_ENTER_GETEVENTS "IORING_ENTER_GETEVENTS"
+
+cdef extern from 'sys/syscall.h':
+
+        cdef long c_NR_io_uring_setup "__NR_io_uring_setup"
+        cdef long c_NR_io_uring_enter "__NR_io_uring_enter"
+
+cdef extern from 'sys/socket.h':
+
+        enum: MSG_NOSIGNAL
+
+cdef extern from 'unistd.h':
+
+        long syscall(long number, ...) nogil
+        int close(int fd)
+
+cdef extern from 'sys/mman.h':
+
+        cdef int PROT_READ
+        cdef int PROT_WRITE
+        cdef int MAP_SHARED
+        cdef int MAP_POPULATE
+        cdef void *MAP_FAILED
+
+        void *mmap(void *addr, size_t length, int prot, int flags, int fd, long offset)
+        int munmap(void *addr, size_t length)
+
+# The rings indexes are shared with the kernel
+cdef extern from *:
+        """
+        static inline unsigned int uring_load_acquire(unsigned int *p)
+        {
+                return __atomic_load_n(p, __ATOMIC_ACQUIRE);
+        }
+
+        static inline void uring_store_release(unsigned int *p, unsigned int v)
+        {
+                __atomic_store_n(p, v, __ATOMIC_RELEASE);
+        }
+        """
+        unsigned int uring_load_acquire(unsigned int *p)
+        void uring_store_release(unsigned int *p, unsigned int v)
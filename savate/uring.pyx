@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+"""
+An epoll-like poller built on io_uring (Linux >= 5.1).
+
+Sockets are watched with one-shot IORING_OP_POLL_ADD requests, armed
+again after each event, which gives the same level-triggered behaviour
+as epoll. Requests to (re)arm, modify and remove polls are queued, and
+all of them are submitted by the single io_uring_enter() call which
+also waits for the next events, instead of one epoll_ctl() call each.
+
+Sends can be queued the same way, e.g. to every client of a published
+packet, their data being kept until they complete.
+"""
+
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+from libc.string cimport memset
+
+cdef extern from 'errno.h':
+
+        cdef int errno
+        enum: EAGAIN
+        enum: EBUSY
+        enum: EEXIST
+        enum: ENOENT
+
+cdef extern from 'poll.h':
+
+        enum: POLLERR
+
+import os
+import time
+
+from uring cimport *
+
+
+# Sizes of the submission and completion queues: polls are armed for
+# every registered socket, hence a large completion queue
+ENTRIES = 1024
+CQ_ENTRIES = 65536
+
+# User data of our internal requests, i.e. of generation 0
+cdef unsigned long long INTERNAL_DATA = 0
+# Flag of the user data of sends, followed by their sequence number
+cdef unsigned long long SEND_FLAG = 1ULL << 63
+
+
+cdef class SendRequest:
+    """A send in progress, holding its data until it completes."""
+
+    cdef Py_buffer data
+    cdef bint acquired
+    cdef int fd
+    cdef object owner
+
+    def __dealloc__(self):
+        if self.acquired:
+            PyBuffer_Release(&self.data)
+
+
+cdef class Poller:
+    """
+    Provides the register(), modify(), unregister() and poll()
+    methods of select.epoll, for file descriptors only.
+    """
+
+    cdef int ring_fd
+    cdef void *sq_ring
+    cdef void *cq_ring
+    cdef size_t sq_ring_size
+    cdef size_t cq_ring_size
+    cdef io_uring_sqe *sqes
+    cdef size_t sqes_size
+    cdef unsigned int *sq_head
+    cdef unsigned int *sq_tail
+    cdef unsigned int sq_mask
+    cdef unsigned int sq_entries
+    cdef unsigned int *cq_head
+    cdef unsigned int *cq_tail
+    cdef unsigned int cq_mask
+    cdef io_uring_cqe *cqes
+    # Our copy of the submission queue tail, published by submit()
+    cdef unsigned int local_tail
+    cdef __kernel_timespec timeout
+    # Poll requests are tagged with a generation, so that we can tell
+    # the events of a previous registration of the same fd
+    cdef unsigned long long generation
+    # fd -> (generation, eventmask)
+    cdef dict registered
+    # Whether send() may be used: without IORING_FEAT_FAST_POLL, sends
+    # on a full socket would block a kernel worker thread
+    cdef readonly bint batched_sends
+    cdef unsigned long long send_sequence
+    # user data -> SendRequest
+    cdef dict sends
+    # fd -> set of the user data of its sends
+    cdef dict fd_sends
+    # (owner, result) of the sends completed since the last poll()
+    cdef list completed_sends
+
+    def __cinit__(self, unsigned int entries = ENTRIES, unsigned int cq_entries = CQ_ENTRIES):
+        cdef io_uring_params params
+        cdef unsigned int *sq_array
+        cdef unsigned int index
+
+        self.ring_fd = -1
+        self.sq_ring = self.cq_ring = MAP_FAILED
+        self.sqes = <io_uring_sqe *> MAP_FAILED
+        self.registered = {}
+        self.generation = 0
+        self.send_sequence = 0
+        self.sends = {}
+        self.fd_sends = {}
+        self.completed_sends = []
+
+        memset(&params, 0, sizeof(params))
+        params.flags = c_IORING_SETUP_CQSIZE
+        params.cq_entries = cq_entries
+        self.ring_fd = syscall(c_NR_io_uring_setup, entries, &params)
+        if self.ring_fd < 0:
+            raise IOError(errno, os.strerror(errno))
+
+        self.sq_ring_size = params.sq_off.array + params.sq_entries * sizeof(unsigned int)
+        self.cq_ring_size = params.cq_off.cqes + params.cq_entries * sizeof(io_uring_cqe)
+        if params.features & c_IORING_FEAT_SINGLE_MMAP:
+            self.sq_ring_size = self.cq_ring_size = max(self.sq_ring_size, self.cq_ring_size)
+
+        self.sq_ring = mmap(NULL, self.sq_ring_size, PROT_READ | PROT_WRITE,
+                            MAP_SHARED | MAP_POPULATE, self.ring_fd, c_IORING_OFF_SQ_RING)
+        if self.sq_ring == MAP_FAILED:
+            self.close()
+            raise IOError(errno, os.strerror(errno))
+        if params.features & c_IORING_FEAT_SINGLE_MMAP:
+            self.cq_ring = self.sq_ring
+        else:
+            self.cq_ring = mmap(NULL, self.cq_ring_size, PROT_READ | PROT_WRITE,
+                                MAP_SHARED | MAP_POPULATE, self.ring_fd, c_IORING_OFF_CQ_RING)
+            if self.cq_ring == MAP_FAILED:
+                self.close()
+                raise IOError(errno, os.strerror(errno))
+        self.sqes_size = params.sq_entries * sizeof(io_uring_sqe)
+        self.sqes = <io_uring_sqe *> mmap(NULL, self.sqes_size, PROT_READ | PROT_WRITE,
+                                          MAP_SHARED | MAP_POPULATE, self.ring_fd,
+                                          c_IORING_OFF_SQES)
+        if <void *> self.sqes == MAP_FAILED:
+            self.close()
+            raise IOError(errno, os.strerror(errno))
+
+        self.sq_head = <unsigned int *> (<char *> self.sq_ring + params.sq_off.head)
+        self.sq_tail = <unsigned int *> (<char *> self.sq_ring + params.sq_off.tail)
+        self.sq_mask = (<unsigned int *> (<char *> self.sq_ring + params.sq_off.ring_mask))[0]
+        self.sq_entries = params.sq_entries
+        self.local_tail = self.sq_tail[0]
+        # Submission queue entries are always used in order
+        sq_array = <unsigned int *> (<char *> self.sq_ring + params.sq_off.array)
+        for index in range(params.sq_entries):
+            sq_array[index] = index
+        self.cq_head = <unsigned int *> (<char *> self.cq_ring + params.cq_off.head)
+        self.cq_tail = <unsigned int *> (<char *> self.cq_ring + params.cq_off.tail)
+        self.cq_mask = (<unsigned int *> (<char *> self.cq_ring + params.cq_off.ring_mask))[0]
+        self.cqes = <io_uring_cqe *> (<char *> self.cq_ring + params.cq_off.cqes)
+        self.batched_sends = params.features & c_IORING_FEAT_FAST_POLL != 0
+
+    def __dealloc__(self):
+        self.close()
+
+    def close(self):
+        if <void *> self.sqes != MAP_FAILED:
+            munmap(self.sqes, self.sqes_size)
+            self.sqes = <io_uring_sqe *> MAP_FAILED
+        if self.cq_ring != MAP_FAILED and self.cq_ring != self.sq_ring:
+            munmap(self.cq_ring, self.cq_ring_size)
+        self.cq_ring = MAP_FAILED
+        if self.sq_ring != MAP_FAILED:
+            munmap(self.sq_ring, self.sq_ring_size)
+            self.sq_ring = MAP_FAILED
+        if self.ring_fd >= 0:
+            close(self.ring_fd)
+            self.ring_fd = -1
+
+    def fileno(self):
+        return self.ring_fd
+
+    cdef io_uring_sqe *get_sqe(self) except NULL:
+        cdef io_uring_sqe *sqe
+        if self.local_tail - uring_load_acquire(self.sq_head) >= self.sq_entries:
+            # Submission queue full
+            self.submit(0, 0)
+            if self.local_tail - uring_load_acquire(self.sq_head) >= self.sq_entries:
+                raise IOError(EBUSY, os.strerror(EBUSY))
+        sqe = &self.sqes[self.local_tail & self.sq_mask]
+        memset(sqe, 0, sizeof(io_uring_sqe))
+        self.local_tail += 1
+        return sqe
+
+    cdef int submit(self, unsigned int min_complete, unsigned int flags) except -1:
+        cdef long ret
+        cdef unsigned int to_submit
+        uring_store_release(self.sq_tail, self.local_tail)
+        to_submit = self.local_tail - uring_load_acquire(self.sq_head)
+        if to_submit == 0 and min_complete == 0:
+            return 0
+        with nogil:
+            ret = syscall(c_NR_io_uring_enter, self.ring_fd, to_submit, min_complete,
+                          flags, NULL, 0)
+        if ret < 0:
+            if errno == EBUSY or errno == EAGAIN:
+                # The completion queue is full, or the kernel is short
+                # of memory: we'll submit again next time
+                return 0
+            raise IOError(errno, os.strerror(errno))
+        return 0
+
+    cdef int poll_add(self, int fd, unsigned long long generation,
+                      unsigned int eventmask) except -1:
+        cdef io_uring_sqe *sqe = self.get_sqe()
+        sqe.opcode = c_IORING_OP_POLL_ADD
+        sqe.fd = fd
+        sqe.poll_events = eventmask
+        sqe.user_data = (generation << 32) | <unsigned int> fd
+        return 0
+
+    cdef int poll_remove(self, int fd, unsigned long long generation) except -1:
+        cdef io_uring_sqe *sqe = self.get_sqe()
+        sqe.opcode = c_IORING_OP_POLL_REMOVE
+        sqe.fd = -1
+        sqe.addr = (generation << 32) | <unsigned int> fd
+        sqe.user_data = INTERNAL_DATA
+        return 0
+
+    cdef int cancel(self, unsigned long long user_data) except -1:
+        cdef io_uring_sqe *sqe = self.get_sqe()
+        sqe.opcode = c_IORING_OP_ASYNC_CANCEL
+        sqe.fd = -1
+        sqe.addr = user_data
+        sqe.user_data = INTERNAL_DATA
+        return 0
+
+    cdef unsigned long long next_generation(self):
+        self.generation = self.generation % 0x7fffffff + 1
+        return self.generation
+
+    def register(self, int fd, unsigned int eventmask):
+        if fd in self.registered:
+            raise IOError(EEXIST, os.strerror(EEXIST))
+        generation = self.next_generation()
+        self.registered[fd] = (generation, eventmask)
+        self.poll_add(fd, generation, eventmask)
+
+    def modify(self, int fd, unsigned int eventmask):
+        try:
+            generation, previous_eventmask = self.registered[fd]
+        except KeyError:
+            raise IOError(ENOENT, os.strerror(ENOENT))
+        if eventmask == previous_eventmask:
+            return
+        self.poll_remove(fd, generation)
+        generation = self.next_generation()
+        self.registered[fd] = (generation, eventmask)
+        self.poll_add(fd, generation, eventmask)
+
+    def unregister(self, int fd):
+        try:
+            generation, eventmask = self.registered.pop(fd)
+        except KeyError:
+            raise IOError(ENOENT, os.strerror(ENOENT))
+        # This also drops the reference the poll request holds on the
+        # file, which would otherwise keep a closed socket open
+        self.poll_remove(fd, generation)
+        # Same for the sends still waiting for the socket to be
+        # writable, which then complete with -ECANCELED
+        for user_data in self.fd_sends.pop(fd, ()):
+            self.cancel(user_data)
+
+    def send(self, int fd, data, owner):
+        """
+        Queue a send of data (any object supporting the buffer
+        interface) on the socket fd, submitted along with the other
+        queued requests by the next poll(). data is kept until the
+        send completes, and (owner, result) is then returned by
+        send_completions(), result being the number of bytes sent,
+        or minus the error number.
+        """
+        cdef io_uring_sqe *sqe
+        cdef SendRequest request = SendRequest()
+        cdef unsigned long long user_data
+        PyObject_GetBuffer(data, &request.data, PyBUF_SIMPLE)
+        request.acquired = True
+        request.fd = fd
+        request.owner = owner
+
+        sqe = self.get_sqe()
+        self.send_sequence += 1
+        user_data = SEND_FLAG | self.send_sequence
+        sqe.opcode = c_IORING_OP_SEND
+        sqe.fd = fd
+        sqe.addr = <unsigned long long> request.data.buf
+        sqe.len = request.data.len
+        sqe.msg_flags = MSG_NOSIGNAL
+        sqe.user_data = user_data
+        self.sends[user_data] = request
+        self.fd_sends.setdefault(fd, set()).add(user_data)
+
+    def send_completions(self):
+        """
+        Return the (owner, result) of the sends completed since the
+        last call, see send().
+        """
+        completed, self.completed_sends = self.completed_sends, []
+        return completed
+
+    cdef int reap(self, dict events) except -1:
+        cdef unsigned int head = self.cq_head[0]
+        cdef unsigned int tail = uring_load_acquire(self.cq_tail)
+        cdef io_uring_cqe *cqe
+        cdef unsigned long long user_data
+        cdef int res
+        cdef int fd
+        cdef SendRequest request
+
+        while head != tail:
+            cqe = &self.cqes[head & self.cq_mask]
+            user_data = cqe.user_data
+            res = cqe.res
+            head += 1
+            if user_data & SEND_FLAG:
+                request = self.sends.pop(user_data)
+                fd_sends = self.fd_sends.get(request.fd)
+                if fd_sends is not None:
+                    fd_sends.discard(user_data)
+                    if not fd_sends:
+                        del self.fd_sends[request.fd]
+                self.completed_sends.append((request.owner, res))
+                continue
+            if user_data >> 32 == 0:
+                continue
+            fd = <int> (user_data & 0xffffffff)
+            registration = self.registered.get(fd)
+            if registration is None or registration[0] != user_data >> 32:
+                # Removed or modified since
+                continue
+            if res < 0:
+                # Not armed again, let the handler deal with it
+                events[fd] = events.get(fd, 0) | POLLERR
+                continue
+            events[fd] = events.get(fd, 0) | res
+            # Level-triggered, like epoll
+            self.poll_add(fd, registration[0], registration[1])
+        uring_store_release(self.cq_head, head)
+        return 0
+
+    def poll(self, timeout = -1, maxevents = -1):
+        """
+        Wait at most timeout seconds (forever if negative) for events
+        or send completions, return a list of (fd, eventmask).
+        maxevents is ignored.
+        """
+        cdef io_uring_sqe *sqe
+        events = {}
+        self.reap(events)
+        if events or self.completed_sends or timeout == 0:
+            self.submit(0, 0)
+            self.reap(events)
+            return events.items()
+
+        if timeout is not None and timeout > 0:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+        while not events and not self.completed_sends:
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self.timeout.tv_sec = <long long> timeout
+                self.timeout.tv_nsec = <long long> ((timeout - self.timeout.tv_sec) * 1e9)
+                sqe = self.get_sqe()
+                sqe.opcode = c_IORING_OP_TIMEOUT
+                sqe.fd = -1
+                sqe.addr = <unsigned long long> &self.timeout
+                sqe.len = 1
+                # Also completes with the first other completion
+                sqe.off = 1
+                sqe.user_data = INTERNAL_DATA
+            self.submit(1, c_IORING_ENTER_GETEVENTS)
+            # Completions of our internal requests, or of polls which
+            # were removed, may wake us up with no events or sends
+            self.reap(events)
+        return events.items()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+cdef extern from 'sys/uio.h':
+
+        struct iovec:
+                void *iov_base
+                size_t iov_len
+
+cdef extern from 'sys/socket.h':
+
+        ctypedef long socklen_t
+
+        struct msghdr:
+                void *msg_name
+                socklen_t msg_namelen
+                iovec *msg_iov
+                size_t msg_iovlen
+                void *msg_control
+                size_t msg_controllen
+                int msg_flags
+
+        struct cmsghdr:
+                size_t cmsg_len
+                int cmsg_level
+                int cmsg_type
+
+        enum: MSG_ERRQUEUE
+        enum: MSG_DONTWAIT
+        # Exported as Python constants in the .pyx file
+        int c_MSG_ZEROCOPY "MSG_ZEROCOPY"
+        int c_SO_ZEROCOPY "SO_ZEROCOPY"
+
+        cmsghdr *CMSG_FIRSTHDR(msghdr *msgh)
+        cmsghdr *CMSG_NXTHDR(msghdr *msgh, cmsghdr *cmsg)
+        unsigned char *CMSG_DATA(cmsghdr *cmsg)
+
+        ssize_t recvmsg(int fd, msghdr *message, int flags) nogil
+
+cdef extern from 'netinet/in.h':
+
+        enum: SOL_IP
+        enum: SOL_IPV6
+        enum: IP_RECVERR
+        enum: IPV6_RECVERR
+
+cdef extern from 'linux/errqueue.h':
+
+        struct sock_extended_err:
+                unsigned int ee_errno
+                unsigned char ee_origin
+                unsigned char ee_type
+                unsigned char ee_code
+                unsigned char ee_pad
+                unsigned int ee_info
+                unsigned int ee_data
+
+        enum: SO_EE_ORIGIN_ZEROCOPY
+        enum: SO_EE_CODE_ZEROCOPY_COPIED
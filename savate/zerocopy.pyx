@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from libc.string cimport memset
+
+cdef extern from 'errno.h':
+
+        cdef int errno
+        enum: EAGAIN
+
+import os
+
+from zerocopy cimport *
+
+
+MSG_ZEROCOPY = c_MSG_ZEROCOPY
+SO_ZEROCOPY = c_SO_ZEROCOPY
+
+
+def recv_completions(int fd):
+    """
+    Read the MSG_ZEROCOPY completion notifications queued on the
+    error queue of fd. Return a list of (first, last, copied) tuples,
+    meaning the kernel is done with the data of the zero-copy sends
+    first to last (inclusive, counted from 0 for the socket), copied
+    telling whether the kernel had to copy the data anyway.
+    """
+    cdef msghdr message
+    cdef char control[128]
+    cdef cmsghdr *cmsg
+    cdef sock_extended_err *error
+    cdef ssize_t ret
+
+    completions = []
+    while True:
+        memset(&message, 0, sizeof(message))
+        message.msg_control = control
+        message.msg_controllen = sizeof(control)
+
+        with nogil:
+            ret = recvmsg(fd, &message, MSG_ERRQUEUE | MSG_DONTWAIT)
+
+        if ret == -1:
+            global errno
+            if errno == EAGAIN:
+                # Error queue is empty
+                return completions
+            raise IOError(errno, os.strerror(errno))
+
+        cmsg = CMSG_FIRSTHDR(&message)
+        while cmsg != NULL:
+            if ((cmsg.cmsg_level == SOL_IP and cmsg.cmsg_type == IP_RECVERR) or
+                (cmsg.cmsg_level == SOL_IPV6 and cmsg.cmsg_type == IPV6_RECVERR)):
+                error = <sock_extended_err *> CMSG_DATA(cmsg)
+                if error.ee_errno == 0 and error.ee_origin == SO_EE_ORIGIN_ZEROCOPY:
+                    completions.append((error.ee_info, error.ee_data,
+                                        bool(error.ee_code & SO_EE_CODE_ZEROCOPY_COPIED)))
+            cmsg = CMSG_NXTHDR(&message, cmsg)